@@ -0,0 +1,222 @@
+import contextvars
+import importlib
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+import supervisely as sly
+from src.metrics import METRICS
+
+# * Session of the thread that sends annotation chunks, None in other threads
+_local = threading.local()
+
+
+class _PooledRequests:
+    """
+    Stands in for the `requests` module in the SDK API module while annotation chunks are sent.
+    POST and GET requests of chunk threads go through a shared session, so connections
+    are reused, requests of other threads are sent by the `requests` module as before.
+    """
+
+    def __init__(self, module):
+        self._module = module
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+    def post(self, *args, **kwargs):
+        return (getattr(_local, "session", None) or self._module).post(*args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        return (getattr(_local, "session", None) or self._module).get(*args, **kwargs)
+
+
+class AnnotationIO:
+    """
+    Sends annotation, figure and tag requests in chunks of `chunk_size` items,
+    at most `workers` chunks at once over a pooled HTTP session.
+    Failed download and `upload_anns` chunks are sent again up to `retries` times
+    with exponential backoff. Figure and tag requests are not idempotent, so they are sent once,
+    and figures created by other chunks are removed if a chunk fails.
+    The duration of every chunk is recorded in metrics.
+    Results are returned in the order of the items.
+    """
+
+    def __init__(self, chunk_size: int = 50, workers: int = 4, retries: int = 3, backoff=0.5):
+        self.chunk_size = max(chunk_size, 1)
+        self.workers = max(workers, 1)
+        self.retries = retries
+        self.backoff = backoff
+        self._session: Optional[requests.Session] = None
+        self._sdk_requests = None
+        self._runs = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _pooled_requests(self):
+        """
+        Routes SDK requests of chunk threads through the pooled session,
+        the `requests` module of the SDK is restored when no chunks are sent.
+        """
+        # * The SDK sends requests with module functions of `requests`
+        sdk_api = importlib.import_module("supervisely.api.api")
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                # * Several groups or clicks can send chunks at the same time
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4 * self.workers)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session = session
+            if self._runs == 0:
+                self._sdk_requests = sdk_api.requests
+                sdk_api.requests = _PooledRequests(self._sdk_requests)
+            self._runs += 1
+        try:
+            yield self._session
+        finally:
+            with self._lock:
+                self._runs -= 1
+                if self._runs == 0:
+                    sdk_api.requests = self._sdk_requests
+
+    def _run_chunk(
+        self, operation: str, func: Callable, chunk_idx: int, chunk: list, retries: int
+    ):
+        start = time.perf_counter()
+        for attempt in range(retries + 1):
+            try:
+                result = func(chunk)
+                break
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                delay = self.backoff * 2**attempt * random.uniform(1, 1.5)
+                sly.logger.warning(
+                    f"Annotation chunk request failed, retrying in {delay:.1f}s: {e}",
+                    extra={"operation": operation, "chunk": chunk_idx, "attempt": attempt + 1},
+                )
+                time.sleep(delay)
+        seconds = time.perf_counter() - start
+        METRICS.observe_ann_chunk(operation, seconds, attempt)
+        sly.logger.debug(
+            "Annotation chunk is processed",
+            extra={
+                "operation": operation,
+                "chunk": chunk_idx,
+                "size": len(chunk),
+                "seconds": round(seconds, 3),
+                "retries": attempt,
+            },
+        )
+        return result
+
+    def _run_chunks(
+        self, operation: str, func: Callable[[list], list], items: Sequence, retries: int
+    ) -> List[Tuple[Optional[list], Optional[Exception]]]:
+        """
+        Calls `func` for chunks of `items` concurrently.
+        Returns (result, None) or (None, error) for every chunk, all chunks are finished.
+        """
+        items = list(items)
+        chunks = [
+            items[start : start + self.chunk_size]
+            for start in range(0, len(items), self.chunk_size)
+        ]
+
+        def _run(idx: int, chunk: list):
+            _local.session = session
+            try:
+                return self._run_chunk(operation, func, idx, chunk, retries), None
+            except Exception as e:
+                return None, e
+            finally:
+                _local.session = None
+
+        with self._pooled_requests() as session:
+            if len(chunks) <= 1 or self.workers == 1:
+                return [_run(idx, chunk) for idx, chunk in enumerate(chunks)]
+            with ThreadPoolExecutor(min(self.workers, len(chunks))) as executor:
+                futures = [
+                    executor.submit(contextvars.copy_context().run, _run, idx, chunk)
+                    for idx, chunk in enumerate(chunks)
+                ]
+                return [future.result() for future in futures]
+
+    def run(
+        self, operation: str, func: Callable[[list], list], items: Sequence, retry: bool = True
+    ) -> list:
+        """
+        Calls `func` for chunks of `items` concurrently and returns concatenated results.
+        Raises the error of the first failed chunk after all chunks are finished.
+        """
+        results = self._run_chunks(operation, func, items, self.retries if retry else 0)
+        for _, error in results:
+            if error is not None:
+                raise error
+        return [item for result, _ in results for item in (result or [])]
+
+    def download(
+        self, api: sly.Api, dataset_id: int, ids: List[int], meta: sly.ProjectMeta
+    ) -> List[sly.Annotation]:
+        """
+        Downloads annotations of images, every chunk is parsed right after it is downloaded.
+        """
+
+        def _download(chunk: List[int]) -> List[sly.Annotation]:
+            return [
+                sly.Annotation.from_json(ann.annotation, meta)
+                for ann in api.annotation.download_batch(dataset_id, chunk)
+            ]
+
+        return self.run("ann_download", _download, ids)
+
+    def upload(self, api: sly.Api, ids: List[int], anns: List[sly.Annotation]) -> None:
+        """
+        Replaces annotations of images, so failed chunks can be sent again.
+        """
+
+        def _upload(chunk: list) -> None:
+            chunk_ids, chunk_anns = zip(*chunk)
+            api.annotation.upload_anns(list(chunk_ids), list(chunk_anns))
+
+        self.run("ann_upload", _upload, list(zip(ids, anns)))
+
+    def create_figures(self, api: sly.Api, figures_json: List[dict], dataset_id: int) -> List[int]:
+        """
+        Creates figures and returns their ids in the order of `figures_json`.
+        If any chunk fails, figures created by other chunks are removed and the error is raised.
+        """
+        results = self._run_chunks(
+            "figure_upload",
+            lambda chunk: api.image.figure.create_bulk(chunk, dataset_id=dataset_id),
+            figures_json,
+            retries=0,
+        )
+        errors = [error for _, error in results if error is not None]
+        figure_ids = [figure_id for result, _ in results for figure_id in (result or [])]
+        if len(errors) > 0:
+            self.remove_figures(api, figure_ids)
+            raise errors[0]
+        return figure_ids
+
+    def remove_figures(self, api: sly.Api, figure_ids: List[int]) -> None:
+        if len(figure_ids) == 0:
+            return
+        try:
+            api.image.figure.remove_batch(figure_ids)
+        except Exception as e:
+            sly.logger.error(
+                f"Failed to remove created figures: {e}", extra={"figure ids": figure_ids}
+            )
+
+    def add_tags(self, api: sly.Api, project_id: int, tags_json: List[dict]) -> None:
+        def _add_tags(chunk: List[dict]) -> None:
+            api.image.tag.add_to_objects(project_id, chunk)
+
+        self.run("tag_upload", _add_tags, tags_json, retry=False)
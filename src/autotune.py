@@ -0,0 +1,185 @@
+import math
+import threading
+from typing import Dict, List, NamedTuple, Optional
+
+import supervisely as sly
+
+RESIZE_OPTIONS = (1024, 768, 640, 512, 384, 256, 192, 128)
+KEYPOINTS_OPTIONS = (2048, 1024, 512, 256, 128)
+# * LightGlue early exit: (depth_confidence, width_confidence), -1 disables it
+PRUNING_OPTIONS = {
+    "off": (-1, -1),
+    "default": (0.95, 0.99),
+    "aggressive": (0.9, 0.95),
+}
+# * Small preference for more accurate settings when several of them fit into the budget
+PRUNING_PENALTY = {"off": 0.0, "default": 0.05, "aggressive": 0.15}
+
+# * Priors used until the first click on the device is measured
+PRIORS = {
+    "cpu": {"extract": 5e-7, "match": 1.5e-7, "overhead": 0.05},
+    "cuda": {"extract": 2e-8, "match": 1e-8, "overhead": 0.03},
+}
+PRUNING_SPEEDUP = {"off": 1.0, "default": 0.7, "aggressive": 0.5}
+KEYPOINTS_DENSITY = 0.02  # * keypoints per pixel of the processed image
+
+
+class TuningChoice(NamedTuple):
+    resize: Optional[int]
+    max_keypoints: int
+    pruning: str
+    group_size: int
+    processed_area: float
+    predicted: float
+
+    @property
+    def matcher_conf(self) -> Dict[str, float]:
+        depth_confidence, width_confidence = PRUNING_OPTIONS[self.pruning]
+        return {"depth_confidence": depth_confidence, "width_confidence": width_confidence}
+
+
+class LatencyTuner:
+    """
+    Picks resize, keypoints cap and LightGlue early exit so matching of a group fits into
+    a latency budget. The cost model is measured per device and updated after every click:
+
+    - extraction time of an image is proportional to the area of the processed image
+    - matching time of a pair is proportional to the squared number of keypoints
+    - download and other work adds a constant time per image
+
+    Among the settings that fit into the budget, the one with the largest processed area
+    and keypoints count is chosen, the fastest one is chosen if none of them fit.
+    Images are never upsampled, resize is None when images are not larger than it.
+    Keypoints cap and early exit are kept from the previous click while they still fit and use
+    at least `keep_ratio` of the budget, as changing them loads other models into the pool.
+    """
+
+    def __init__(self, smoothing: float = 0.3, keep_ratio: float = 0.6):
+        self.smoothing = smoothing
+        self.keep_ratio = keep_ratio
+        self._models: Dict[str, Dict[str, float]] = {}
+        self._last: Dict[str, TuningChoice] = {}
+        self._lock = threading.Lock()
+
+    def _model(self, device: str) -> Dict[str, float]:
+        device_type = "cpu" if str(device).startswith("cpu") else "cuda"
+        if device not in self._models:
+            model = dict(PRIORS[device_type])
+            model["density"] = KEYPOINTS_DENSITY
+            model.update({f"speedup_{name}": value for name, value in PRUNING_SPEEDUP.items()})
+            self._models[device] = model
+        return self._models[device]
+
+    @staticmethod
+    def _processed_area(width: int, height: int, resize: Optional[int]) -> float:
+        long_side, short_side = max(width, height), min(width, height)
+        if resize is not None and resize < long_side:
+            return resize * resize * short_side / long_side
+        return float(long_side * short_side)
+
+    def _predict(self, model: dict, group_size: int, area: float, max_keypoints: int, pruning):
+        keypoints = min(max_keypoints, model["density"] * area)
+        extract = group_size * model["extract"] * area
+        match = (group_size - 1) * model["match"] * model[f"speedup_{pruning}"] * keypoints**2
+        return extract + match + group_size * model["overhead"], keypoints
+
+    def choose(
+        self, device: str, budget: float, image_infos: List[sly.ImageInfo]
+    ) -> TuningChoice:
+        """
+        Returns settings for matching the group on the device within `budget` seconds.
+        """
+        width = max(info.width or 0 for info in image_infos) or 1024
+        height = max(info.height or 0 for info in image_infos) or 768
+        group_size = len(image_infos)
+        long_side = max(width, height)
+        # * Images are not upsampled: resizes not smaller than the image mean the full size
+        resizes = [resize for resize in RESIZE_OPTIONS if resize < long_side]
+        if len(resizes) < len(RESIZE_OPTIONS):
+            resizes.insert(0, None)
+        with self._lock:
+            model = dict(self._model(device))
+            last = self._last.get(device)
+
+        candidates = []
+        for resize in resizes:
+            area = self._processed_area(width, height, resize)
+            for max_keypoints in KEYPOINTS_OPTIONS:
+                for pruning in PRUNING_OPTIONS:
+                    predicted, keypoints = self._predict(
+                        model, group_size, area, max_keypoints, pruning
+                    )
+                    score = math.log(area * max(keypoints, 1)) - PRUNING_PENALTY[pruning]
+                    choice = TuningChoice(
+                        resize, max_keypoints, pruning, group_size, area, predicted
+                    )
+                    candidates.append((score, choice))
+
+        fitting = [item for item in candidates if item[1].predicted <= budget]
+        if last is not None:
+            kept = [
+                item
+                for item in fitting
+                if (item[1].max_keypoints, item[1].pruning) == (last.max_keypoints, last.pruning)
+                and item[1].predicted >= self.keep_ratio * budget
+            ]
+            fitting = kept or fitting
+        if len(fitting) > 0:
+            # * Ties are broken toward the smaller resize
+            choice = max(fitting, key=lambda item: (item[0], -(item[1].resize or long_side)))[1]
+        else:
+            choice = min(candidates, key=lambda item: item[1].predicted)[1]
+        with self._lock:
+            self._last[device] = choice
+        sly.logger.info(
+            "Settings are chosen for the latency budget",
+            extra={
+                "budget": budget,
+                "predicted": round(choice.predicted, 3),
+                "resize": choice.resize,
+                "max keypoints": choice.max_keypoints,
+                "early exit": choice.pruning,
+            },
+        )
+        return choice
+
+    def _blend(self, model: dict, key: str, value: float) -> None:
+        model[key] = (1 - self.smoothing) * model[key] + self.smoothing * value
+
+    def update(self, device: str, choice: TuningChoice, trace_summary: dict) -> None:
+        """
+        Updates the cost model of the device with stage timings and counters of the click.
+        Overhead is updated only if all group images were downloaded and extracted in the click.
+        """
+        stages = trace_summary.get("stages_ms", {})
+        extracted = trace_summary.get("images extracted", 0)
+        pairs = trace_summary.get("pairs matched", 0)
+        keypoints = trace_summary.get("keypoints", 0)
+        # * Clicks with cached images or features skip download or extraction,
+        # * their overhead is not the one of the images the model predicts
+        cold = extracted >= choice.group_size and trace_summary.get("images cache hit", 0) == 0
+        extract_time = stages.get("extract", 0) / 1000
+        match_time = stages.get("match", 0) / 1000
+        total_time = trace_summary.get("total_ms", 0) / 1000
+
+        with self._lock:
+            model = self._model(device)
+            if extracted > 0:
+                mean_keypoints = keypoints / extracted
+                self._blend(model, "extract", extract_time / (extracted * choice.processed_area))
+                # * Capped keypoints counts say nothing about the density
+                if mean_keypoints < 0.9 * choice.max_keypoints:
+                    self._blend(model, "density", mean_keypoints / choice.processed_area)
+            if pairs > 0 and extracted > 0 and keypoints > 0:
+                speedup = model[f"speedup_{choice.pruning}"]
+                self._blend(model, "match", match_time / (pairs * speedup * mean_keypoints**2))
+            if choice.group_size > 0 and cold:
+                overhead = max(total_time - extract_time - match_time, 0) / choice.group_size
+                self._blend(model, "overhead", overhead)
+            sly.logger.debug(
+                "Latency model is updated",
+                extra={"device": device, "predicted": choice.predicted, "measured": total_time},
+            )
+
+
+AUTOTUNER = LatencyTuner()
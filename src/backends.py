@@ -0,0 +1,224 @@
+import os
+import threading
+from typing import Optional, Tuple
+
+import torch
+import supervisely as sly
+
+# * Batch and shard worker processes import this module, so it must not import src.globals
+
+BACKENDS = ("eager", "compile", "onnx")
+
+_threads_lock = threading.Lock()
+_threads_configured = False
+
+
+def configure_threads(num_threads: int) -> None:
+    """
+    Sets the number of intra-op threads of torch once, 0 keeps the default.
+    """
+    global _threads_configured
+    with _threads_lock:
+        if _threads_configured or num_threads <= 0:
+            return
+        torch.set_num_threads(num_threads)
+        _threads_configured = True
+        sly.logger.debug("Intra-op threads are set", extra={"threads": num_threads})
+
+
+def quantize_matcher(matcher: torch.nn.Module, device: str) -> torch.nn.Module:
+    """
+    Replaces linear layers of LightGlue with dynamically quantized int8 ones, CPU only.
+    """
+    if not str(device).startswith("cpu"):
+        sly.logger.warning("Int8 quantization is supported only on CPU, the matcher is not changed")
+        return matcher
+    return torch.ao.quantization.quantize_dynamic(matcher, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def compile_module(module: torch.nn.Module) -> torch.nn.Module:
+    """
+    Compiles the forward of the module with dynamic shapes, parts that can't be compiled
+    (or the whole module if compilation fails) run eagerly.
+    """
+    import torch._dynamo
+
+    torch._dynamo.config.suppress_errors = True
+    module.forward = torch.compile(module.forward, dynamic=True)
+    return module
+
+
+class _SuperPointExport(torch.nn.Module):
+    def __init__(self, extractor: torch.nn.Module):
+        super().__init__()
+        self.extractor = extractor
+
+    def forward(self, image: torch.Tensor):
+        features = self.extractor({"image": image})
+        return features["keypoints"], features["keypoint_scores"], features["descriptors"]
+
+
+class OnnxExtractor:
+    """
+    SuperPoint network run by ONNX Runtime on CPU. Keeps the interface of the torch extractor:
+    `extract` and preprocessing are taken from it, the forward pass is run in the ONNX session.
+    Images are run one by one, so a batch with different keypoint counts raises RuntimeError
+    when stacked, the same as the torch extractor does.
+    The network is exported without the keypoint limit, as a traced top-k expects at least
+    `max_num_keypoints` detections, and the limit is applied to the outputs in torch.
+    """
+
+    def __init__(self, extractor: torch.nn.Module, model_path: str, num_threads: int = 0):
+        import onnxruntime as ort
+
+        self.extractor = extractor
+        self.preprocess_conf = extractor.preprocess_conf
+        self.conf = extractor.conf
+        options = ort.SessionOptions()
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            model_path, options, providers=["CPUExecutionProvider"]
+        )
+
+    @staticmethod
+    def export(extractor: torch.nn.Module, model_path: str) -> None:
+        sample = torch.rand(1, 3, 480, 640)
+        max_num_keypoints = extractor.conf.max_num_keypoints
+        extractor.conf.max_num_keypoints = None
+        try:
+            torch.onnx.export(
+                _SuperPointExport(extractor).eval(),
+                (sample,),
+                model_path,
+                input_names=["image"],
+                output_names=["keypoints", "keypoint_scores", "descriptors"],
+                dynamic_axes={
+                    "image": {2: "height", 3: "width"},
+                    "keypoints": {1: "num_keypoints"},
+                    "keypoint_scores": {1: "num_keypoints"},
+                    "descriptors": {1: "num_keypoints"},
+                },
+                opset_version=17,
+            )
+        finally:
+            extractor.conf.max_num_keypoints = max_num_keypoints
+
+    def _top_k(self, keypoints, scores, descriptors):
+        """
+        Keeps `max_num_keypoints` keypoints with the highest scores, like SuperPoint does.
+        Descriptors are sampled for every keypoint separately, so they are selected the same way.
+        """
+        k = self.conf.max_num_keypoints
+        if k is None or k >= len(keypoints):
+            return keypoints, scores, descriptors
+        scores, indices = torch.topk(scores, k, dim=0, sorted=True)
+        return keypoints[indices], scores, descriptors[indices]
+
+    def forward(self, data: dict) -> dict:
+        outputs = []
+        for image in data["image"]:
+            image = image[None].detach().cpu().numpy()
+            keypoints, scores, descriptors = [
+                torch.from_numpy(output[0]) for output in self.session.run(None, {"image": image})
+            ]
+            outputs.append(self._top_k(keypoints, scores, descriptors))
+        keypoints, scores, descriptors = [
+            torch.stack([output[idx] for output in outputs]) for idx in range(3)
+        ]
+        return {"keypoints": keypoints, "keypoint_scores": scores, "descriptors": descriptors}
+
+    def __call__(self, data: dict) -> dict:
+        return self.forward(data)
+
+    def extract(self, img: torch.Tensor, **conf) -> dict:
+        return type(self.extractor).extract(self, img, **conf)
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
+
+
+def _onnx_extractor(extractor: torch.nn.Module, model_dir: str, num_threads: int) -> object:
+    onnx_dir = os.path.join(model_dir, "onnx")
+    os.makedirs(onnx_dir, exist_ok=True)
+    # * The keypoint limit is applied in torch, so one model is used for all limits
+    model_path = os.path.join(onnx_dir, "superpoint.onnx")
+    if not os.path.exists(model_path):
+        sly.logger.info("Exporting SuperPoint to ONNX", extra={"path": model_path})
+        tmp_path = f"{model_path}.tmp"
+        try:
+            OnnxExtractor.export(extractor, tmp_path)
+            os.replace(tmp_path, model_path)
+        finally:
+            sly.fs.silent_remove(tmp_path)
+    return OnnxExtractor(extractor, model_path, num_threads)
+
+
+def apply_backend(
+    extractor: torch.nn.Module,
+    matcher: torch.nn.Module,
+    device: str,
+    backend: str,
+    quantize: bool,
+    model_dir: str,
+    num_threads: int = 0,
+) -> Tuple[object, torch.nn.Module]:
+    """
+    Returns (extractor, matcher) prepared for the inference backend:
+    "eager" keeps the models as they are, "compile" compiles them with torch.compile,
+    "onnx" runs SuperPoint in ONNX Runtime (CPU only) and keeps LightGlue in torch,
+    as its outputs are lists of tensors of different sizes.
+    If `quantize` is set, LightGlue linear layers are quantized to int8 on CPU.
+    A backend that can't be used falls back to "eager" with a warning.
+    ONNX models are exported to `model_dir`, `num_threads` are intra-op threads (0 is default).
+    """
+    configure_threads(num_threads)
+    if backend not in BACKENDS:
+        sly.logger.warning(f"Unknown inference backend '{backend}', using 'eager'")
+        backend = "eager"
+
+    # * Quantization copies the matcher, so it goes before compilation
+    if quantize:
+        matcher = quantize_matcher(matcher, device)
+
+    if backend == "compile":
+        extractor = compile_module(extractor)
+        matcher = compile_module(matcher)
+    elif backend == "onnx":
+        if not str(device).startswith("cpu"):
+            sly.logger.warning("ONNX backend is used only on CPU, using 'eager'")
+        else:
+            try:
+                extractor = _onnx_extractor(extractor, model_dir, num_threads)
+            except Exception as e:
+                sly.logger.warning(f"ONNX backend is not available, using 'eager': {e}")
+    return extractor, matcher
+
+
+def load_models(
+    device: str,
+    max_num_keypoints: Optional[int],
+    filter_threshold: float,
+    model_dir: str,
+    backend: str = "eager",
+    quantize: bool = False,
+    num_threads: int = 0,
+    **matcher_conf,
+) -> Tuple[object, torch.nn.Module]:
+    """
+    Loads SuperPoint and LightGlue from `model_dir` and prepares them for the inference backend.
+    """
+    from lightglue import LightGlue, SuperPoint
+
+    extractor = SuperPoint(max_num_keypoints=max_num_keypoints, model_dir=model_dir)
+    matcher = LightGlue(
+        features="superpoint",
+        filter_threshold=filter_threshold,
+        model_dir=model_dir,
+        **matcher_conf,
+    )
+    extractor, matcher = extractor.eval().to(device), matcher.eval().to(device)
+    return apply_backend(extractor, matcher, device, backend, quantize, model_dir, num_threads)
@@ -0,0 +1,350 @@
+"""
+Headless batch matching for a whole project or dataset.
+
+Boxes from the reference image of every multiview group are propagated to the other images
+of the group, the same way as the MATCH BBOXES button does it in the labeling tool.
+
+    python -m src.batch --project-id 123 [--dataset-id 456] [--workers 2]
+
+All server calls go through the `api` argument of `run_batch`, so any object that implements
+the used `api.project`, `api.dataset`, `api.image` and `api.annotation` methods can replace it.
+The API is created from the environment (and `local.env` and `~/supervisely.env` files).
+This module and its worker processes don't import `src.globals`, as it starts the advanced
+debug mode and app caches on import, settings are passed explicitly instead.
+"""
+
+import argparse
+import multiprocessing
+import os
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from dotenv import load_dotenv
+import supervisely as sly
+from supervisely.api.annotation_api import ApiField as AF
+import src.image_io as image_io
+from src.ann_io import AnnotationIO
+from src.backends import BACKENDS, load_models
+from src.box_tags import BoxTagger
+from src.matching import match_decoded_images, transpose_bboxes
+
+# * Models of the worker process, loaded once by `_init_worker`
+_worker_models = None
+
+
+class Group(NamedTuple):
+    dataset_id: int
+    tag_value: str
+    image_infos: List[sly.ImageInfo]
+
+    @property
+    def key(self) -> str:
+        return f"{self.dataset_id}:{self.tag_value}"
+
+
+class GroupData(NamedTuple):
+    group: Group
+    image_infos: List[sly.ImageInfo]  # reference image info is first
+    anns: List[sly.Annotation]
+    images_bytes: List[bytes]
+
+
+class BatchState:
+    """
+    Keys of processed groups. The file is rewritten after every group,
+    so an interrupted run continues from the first unprocessed group.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.done = set()
+        if path is not None and os.path.exists(path):
+            self.done = set(sly.json.load_json_file(path)["done"])
+
+    def mark_done(self, key: str) -> None:
+        self.done.add(key)
+        if self.path is None:
+            return
+        tmp_path = f"{self.path}.tmp"
+        sly.json.dump_json_file({"done": sorted(self.done)}, tmp_path)
+        os.replace(tmp_path, self.path)
+
+
+def prepare_project_meta(api: sly.Api, project_id: int, tagger: BoxTagger) -> sly.ProjectMeta:
+    """
+    Returns project meta with settings, adding match tag metas to the project if needed.
+    """
+    meta = sly.ProjectMeta.from_json(api.project.get_meta(project_id, True))
+    updated_meta = meta
+    for tag_meta in [tagger.type_tag_meta, tagger.id_tag_meta]:
+        if updated_meta.get_tag_meta(tag_meta.name) is None:
+            updated_meta = updated_meta.add_tag_meta(tag_meta)
+    if updated_meta is not meta:
+        api.project.update_meta(project_id, updated_meta)
+        meta = sly.ProjectMeta.from_json(api.project.get_meta(project_id, True))
+    return meta
+
+
+def enumerate_groups(
+    api: sly.Api, project_id: int, meta: sly.ProjectMeta, dataset_ids: List[int] = None
+) -> Iterator[Group]:
+    """
+    Lists dataset images once and groups them by the value of the multiview tag.
+    """
+    tag_id = meta.project_settings.multiview_tag_id
+    if dataset_ids is None:
+        dataset_ids = [dataset.id for dataset in api.dataset.get_list(project_id)]
+    for dataset_id in dataset_ids:
+        groups = defaultdict(list)
+        for info in api.image.get_list(dataset_id):
+            for tag in info.tags:
+                if tag[AF.TAG_ID] == tag_id:
+                    groups[tag[AF.VALUE]].append(info)
+                    break
+        for tag_value, image_infos in groups.items():
+            if len(image_infos) > 1:
+                yield Group(dataset_id, tag_value, image_infos)
+
+
+def download_group(
+    api: sly.Api, group: Group, meta: sly.ProjectMeta, tagger: BoxTagger, ann_io: AnnotationIO
+) -> Optional[GroupData]:
+    """
+    Downloads group annotations, picks the first image with unprocessed boxes as reference
+    and downloads image bytes. Returns None if the group has nothing to match.
+    """
+    ids = [info.id for info in group.image_infos]
+    anns = ann_io.download(api, group.dataset_id, ids, meta)
+    ref_idx = next(
+        (
+            idx
+            for idx, ann in enumerate(anns)
+            if len(tagger.select_reference_bbox_labels(ann, None)) > 0
+        ),
+        None,
+    )
+    if ref_idx is None:
+        return None
+
+    order = [ref_idx] + [idx for idx in range(len(ids)) if idx != ref_idx]
+    image_infos = [group.image_infos[idx] for idx in order]
+    anns = [anns[idx] for idx in order]
+    images_bytes = api.image.download_bytes(group.dataset_id, [info.id for info in image_infos])
+    return GroupData(group, image_infos, anns, images_bytes)
+
+
+def _init_worker(params: dict, model_dir: str, num_threads: int) -> None:
+    """
+    Loads models of the worker process once, they are used for all groups.
+    """
+    global _worker_models
+    _worker_models = load_models(
+        params.get("device", "cpu"),
+        params.get("max_num_keypoints"),
+        params.get("filter_threshold", 0.3),
+        model_dir,
+        params.get("backend") or "eager",
+        bool(params.get("quantize")),
+        num_threads,
+    )
+
+
+def _match_group(
+    image_infos: List[sly.ImageInfo], images_bytes: List[bytes], resize: Optional[int], device
+):
+    """
+    Runs in a worker process with models loaded by `_init_worker`.
+    """
+    images = [
+        image_io.decode_image(data, image_io.get_reduction(info.width, info.height, resize))
+        for info, data in zip(image_infos, images_bytes)
+    ]
+    extractor, matcher = _worker_models
+    return match_decoded_images(extractor, matcher, images, image_infos, resize, device)
+
+
+def upload_group(
+    api: sly.Api, data: GroupData, results, tagger: BoxTagger, ann_io: AnnotationIO
+) -> int:
+    """
+    Transposes reference boxes with matched points and uploads changed annotations.
+    Returns the number of matched images.
+    """
+    ref_ann = data.anns[0]
+    ref_boxes_labels = tagger.select_reference_bbox_labels(ref_ann, None)
+    id_to_ann = {info.id: ann for info, ann in zip(data.image_infos, data.anns)}
+    group_ids = [img_id for img_id, _, _ in results]
+    points_list = [(ref_pts, img_pts) for _, ref_pts, img_pts in results]
+
+    new_bbox_labels = transpose_bboxes(ref_boxes_labels, points_list)
+    new_ref_ann, anns = tagger.merge_matched_labels(
+        ref_ann, ref_boxes_labels, [id_to_ann[img_id] for img_id in group_ids], new_bbox_labels
+    )
+    ann_io.upload(api, [data.image_infos[0].id] + group_ids, [new_ref_ann] + anns)
+    return len(group_ids)
+
+
+def run_batch(
+    api: sly.Api,
+    project_id: int,
+    dataset_ids: List[int] = None,
+    params: dict = None,
+    num_workers: int = 1,
+    threads_per_worker: Optional[int] = None,
+    io_workers: int = 4,
+    max_in_flight: int = None,
+    state_path: Optional[str] = None,
+    model_dir: str = "./checkpoints",
+    ann_io: AnnotationIO = None,
+) -> Dict[str, int]:
+    """
+    Matches all multiview groups of the project (or datasets).
+    `params` are max_num_keypoints, resize, filter_threshold, device, backend and quantize.
+    Groups are downloaded, matched in `num_workers` processes (in-process if 0) and uploaded
+    concurrently, at most `max_in_flight` groups are held in memory at once.
+    """
+    params = params or {}
+    max_in_flight = max_in_flight or max(2 * num_workers, 2)
+    ann_io = ann_io or AnnotationIO()
+    tagger = BoxTagger()
+    meta = prepare_project_meta(api, project_id, tagger)
+    if not meta.project_settings.multiview_enabled or meta.project_settings.multiview_tag_id is None:
+        raise ValueError("Multiview is not enabled in the project settings")
+
+    state = BatchState(state_path)
+    groups = enumerate_groups(api, project_id, meta, dataset_ids)
+    stats = {"groups": 0, "skipped": 0, "failed": 0, "matched images": 0, "resumed": 0}
+
+    initargs = (params, model_dir, threads_per_worker or 0)
+    if num_workers > 0:
+        matcher_pool = ProcessPoolExecutor(
+            num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=initargs,
+        )
+    else:
+        matcher_pool = ThreadPoolExecutor(1, initializer=_init_worker, initargs=initargs)
+    downloader = ThreadPoolExecutor(io_workers)
+    # * Single uploader keeps box ID tags consistent
+    uploader = ThreadPoolExecutor(1)
+
+    in_flight = {}
+
+    def _fill():
+        while len(in_flight) < max_in_flight:
+            group = next(groups, None)
+            if group is None:
+                return
+            if group.key in state.done:
+                stats["resumed"] += 1
+                continue
+            future = downloader.submit(download_group, api, group, meta, tagger, ann_io)
+            in_flight[future] = ("download", group, None)
+
+    try:
+        _fill()
+        while len(in_flight) > 0:
+            done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, group, data = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    sly.logger.error(f"Group '{group.key}' failed on {stage} stage: {e}")
+                    stats["failed"] += 1
+                    continue
+
+                if stage == "download":
+                    if result is None:
+                        stats["skipped"] += 1
+                        state.mark_done(group.key)
+                        continue
+                    future = matcher_pool.submit(
+                        _match_group,
+                        result.image_infos,
+                        result.images_bytes,
+                        params.get("resize"),
+                        params.get("device", "cpu"),
+                    )
+                    in_flight[future] = ("match", group, result)
+                elif stage == "match":
+                    future = uploader.submit(upload_group, api, data, result, tagger, ann_io)
+                    in_flight[future] = ("upload", group, None)
+                else:
+                    stats["groups"] += 1
+                    stats["matched images"] += result
+                    state.mark_done(group.key)
+                    sly.logger.info(
+                        f"Group '{group.key}' is processed", extra={"matched images": result}
+                    )
+            _fill()
+    finally:
+        for executor in (downloader, matcher_pool, uploader):
+            executor.shutdown(wait=True)
+    return stats
+
+
+def main():
+    load_dotenv("local.env")
+    load_dotenv(os.path.expanduser("~/supervisely.env"))
+    parser = argparse.ArgumentParser(description="Match boxes in all multiview groups")
+    parser.add_argument("--project-id", type=int, default=sly.env.project_id(False))
+    parser.add_argument("--dataset-id", type=int, action="append", dest="dataset_ids")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--max-keypoints", type=int, default=1024)
+    parser.add_argument("--resize", type=int, default=256)
+    parser.add_argument("--filter-threshold", type=float, default=0.3)
+    parser.add_argument(
+        "--backend", default=os.environ.get("INFERENCE_BACKEND", "eager"), choices=BACKENDS
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        default=os.environ.get("QUANTIZE_MATCHER", "false").lower() in ("1", "true"),
+        help="Int8 quantization of LightGlue",
+    )
+    parser.add_argument("--model-dir", default="./checkpoints")
+    parser.add_argument("--state", default=None, help="Path to the file with processed groups")
+    parser.add_argument(
+        "--ann-chunk-size", type=int, default=int(os.environ.get("ANN_CHUNK_SIZE", 50))
+    )
+    parser.add_argument("--ann-workers", type=int, default=int(os.environ.get("ANN_IO_WORKERS", 4)))
+    args = parser.parse_args()
+    if args.project_id is None:
+        parser.error("--project-id is required")
+    ann_io = AnnotationIO(
+        args.ann_chunk_size,
+        args.ann_workers,
+        int(os.environ.get("ANN_IO_RETRIES", 3)),
+        float(os.environ.get("ANN_IO_BACKOFF", 0.5)),
+    )
+
+    params = {
+        "max_num_keypoints": args.max_keypoints or None,
+        "resize": args.resize or None,
+        "filter_threshold": args.filter_threshold,
+        "device": args.device,
+        "backend": args.backend,
+        "quantize": args.quantize,
+    }
+    state_path = args.state or f"batch_state_{args.project_id}.json"
+    stats = run_batch(
+        sly.Api.from_env(),
+        args.project_id,
+        args.dataset_ids,
+        params,
+        args.workers,
+        args.threads_per_worker,
+        state_path=state_path,
+        model_dir=args.model_dir,
+        ann_io=ann_io,
+    )
+    sly.logger.info("Batch matching is finished", extra=stats)
+
+
+if __name__ == "__main__":
+    main()
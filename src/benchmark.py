@@ -0,0 +1,1068 @@
+"""
+Offline benchmark of matching speed and accuracy on synthetic multiview groups.
+
+Every group is made from one generated (or given) source image: the reference image is the
+source itself, other images are its copies warped with random homographies, cropped and with
+changed lighting. Ground truth boxes of the group images are reference boxes warped with the
+same homographies, so the box IoU of matched boxes can be measured.
+
+    python -m src.benchmark [--group-sizes 4 8] [--boxes 1 5] [--resize 256 512]
+                            [--max-keypoints 512 1024] [--baseline benchmark_baseline.json]
+
+For every case the benchmark runs `apply_lightglue` and `transpose_bboxes` directly and then
+the whole match flow of the app (`main.run_match_job`) against `FakeApi`, an in-memory
+stand-in for the server. No requests are sent to Supervisely.
+With `--baseline`, the results are compared with the stored ones and the process exits
+with code 1 if any case regressed. `--save-baseline` writes the current results there instead.
+With `--check-backend` (and/or `--check-quantize`), points matched with that inference backend
+are compared with the eager ones, also on low texture images with a small resize,
+and the run fails if less than `--min-parity` of them match.
+`--check-shards N` checks that matching in N worker processes gives exactly the same points
+as the serial path with eager models.
+`--check-batch` runs headless batch matching (`batch.run_batch`) over two copies of the group
+with an interrupted upload and checks that the rerun resumes and that uploaded boxes are tagged.
+`--check-startup` measures app startup in a fresh process with mocked API requests instead:
+the time until the UI can be served (it fails if it exceeds `--startup-budget` or torch is
+imported before it) and the time until models are loaded in background.
+"""
+
+import os
+
+# * Benchmark works without a Supervisely instance, API is replaced by FakeApi
+os.environ["ENV"] = "production"
+os.environ.setdefault("TASK_ID", "0")
+os.environ.setdefault("SERVER_ADDRESS", "http://localhost")
+os.environ.setdefault("API_TOKEN", "0" * 128)
+
+import argparse
+import itertools
+import json
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Set, Tuple
+
+import cv2
+import numpy as np
+import torch
+import supervisely as sly
+from supervisely.api.annotation_api import ApiField as AF
+import src.globals as g
+from src.globals import CACHE
+import src.batch as batch
+import src.image_io as image_io
+from src.ann_io import AnnotationIO
+import src.process_funcs as process
+from src.feature_store import FEATURE_STORE, MATCH_STORE
+from src.model_pool import MODEL_POOL
+from src.backends import BACKENDS
+
+PROJECT_ID = 1
+DATASET_ID = 1
+GROUP_TAG_VALUE = "group"
+# * Resize of the low texture parity check, fewer keypoints than the limit are detected there
+SPARSE_PARITY_RESIZE = 160
+
+
+class SyntheticGroup:
+    """
+    Reference image with boxes and its warped copies with ground truth boxes.
+    `gt_boxes[i][j]` is the box j on the target image i, None if it is mostly out of the image.
+    """
+
+    def __init__(
+        self,
+        images: List[np.ndarray],
+        ref_boxes: List[Tuple[int, int, int, int]],
+        gt_boxes: List[List[Optional[Tuple[float, float, float, float]]]],
+    ):
+        self.images = images
+        self.ref_boxes = ref_boxes
+        self.gt_boxes = gt_boxes
+
+
+def make_source_image(rng: np.random.Generator, width: int, height: int) -> np.ndarray:
+    """
+    Draws random shapes, lines and text, so the image has enough corners for keypoints.
+    """
+    image = np.empty((height, width, 3), np.uint8)
+    image[:] = rng.integers(0, 256, 3)
+    for _ in range(int(width * height / 2500)):
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        size = int(rng.integers(5, max(width, height) // 12))
+        kind = rng.integers(0, 4)
+        if kind == 0:
+            cv2.rectangle(image, (x, y), (x + size, y + size // 2), color, -1)
+        elif kind == 1:
+            cv2.circle(image, (x, y), size // 2, color, -1)
+        elif kind == 2:
+            end = (x + int(rng.integers(-size, size)), y + int(rng.integers(-size, size)))
+            cv2.line(image, (x, y), end, color, int(rng.integers(1, 4)))
+        else:
+            text = "".join(chr(c) for c in rng.integers(65, 91, 3))
+            cv2.putText(image, text, (x, y), cv2.FONT_HERSHEY_SIMPLEX, size / 40, color, 2)
+    noise = rng.normal(0, 6, image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def random_homography(
+    rng: np.random.Generator, width: int, height: int, strength: float
+) -> np.ndarray:
+    """
+    Rotation, scale and perspective distortion around the image center.
+    """
+    corners = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+    center = corners.mean(axis=0)
+    angle = np.deg2rad(rng.uniform(-15, 15) * strength)
+    scale = 1 + rng.uniform(-0.2, 0.2) * strength
+    rotation = scale * np.float32(
+        [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    )
+    dst = (corners - center) @ rotation.T + center
+    dst += rng.uniform(-0.08, 0.08, dst.shape) * strength * np.float32([width, height])
+    return cv2.getPerspectiveTransform(corners, dst.astype(np.float32))
+
+
+def change_lighting(rng: np.random.Generator, image: np.ndarray) -> np.ndarray:
+    contrast = rng.uniform(0.75, 1.25)
+    brightness = rng.uniform(-30, 30)
+    gamma = rng.uniform(0.8, 1.25)
+    image = np.clip(image.astype(np.float32) * contrast + brightness, 0, 255) / 255
+    return (np.power(image, gamma) * 255).astype(np.uint8)
+
+
+def warp_box(
+    box: Tuple[int, int, int, int], homography: np.ndarray, width: int, height: int
+) -> Optional[Tuple[float, float, float, float]]:
+    top, left, bottom, right = box
+    corners = np.float32([[[left, top], [right, top], [right, bottom], [left, bottom]]])
+    warped = cv2.perspectiveTransform(corners, homography)[0]
+    x0, y0 = warped.min(axis=0)
+    x1, y1 = warped.max(axis=0)
+    cx0, cy0 = max(x0, 0), max(y0, 0)
+    cx1, cy1 = min(x1, width - 1), min(y1, height - 1)
+    if cx1 <= cx0 or cy1 <= cy0:
+        return None
+    # * Boxes that are mostly out of the image are not expected to be matched
+    if (cx1 - cx0) * (cy1 - cy0) < 0.5 * (x1 - x0) * (y1 - y0):
+        return None
+    return (cy0, cx0, cy1, cx1)
+
+
+def make_group(
+    rng: np.random.Generator,
+    group_size: int,
+    boxes_count: int,
+    width: int = 1280,
+    height: int = 960,
+    strength: float = 1.0,
+    source: Optional[np.ndarray] = None,
+) -> SyntheticGroup:
+    if source is None:
+        source = make_source_image(rng, width, height)
+    height, width = source.shape[:2]
+
+    ref_boxes = []
+    for _ in range(boxes_count):
+        box_w = int(rng.uniform(0.08, 0.2) * width)
+        box_h = int(rng.uniform(0.08, 0.2) * height)
+        left = int(rng.integers(width // 6, width * 5 // 6 - box_w))
+        top = int(rng.integers(height // 6, height * 5 // 6 - box_h))
+        ref_boxes.append((top, left, top + box_h, left + box_w))
+
+    images, gt_boxes = [source], []
+    for _ in range(group_size - 1):
+        homography = random_homography(rng, width, height, strength)
+        # * Random crop is a translation after the warp
+        crop_w = int(width * rng.uniform(0.85, 1.0))
+        crop_h = int(height * rng.uniform(0.85, 1.0))
+        crop_x = int(rng.integers(0, width - crop_w + 1))
+        crop_y = int(rng.integers(0, height - crop_h + 1))
+        shift = np.float64([[1, 0, -crop_x], [0, 1, -crop_y], [0, 0, 1]])
+        homography = shift @ homography
+        image = cv2.warpPerspective(
+            source, homography, (crop_w, crop_h), borderMode=cv2.BORDER_REFLECT
+        )
+        images.append(change_lighting(rng, image))
+        gt_boxes.append([warp_box(box, homography, crop_w, crop_h) for box in ref_boxes])
+    return SyntheticGroup(images, ref_boxes, gt_boxes)
+
+
+def box_iou(a: Tuple[float, ...], b: Tuple[float, ...]) -> float:
+    top, left = max(a[0], b[0]), max(a[1], b[1])
+    bottom, right = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(bottom - top, 0) * max(right - left, 0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def rect_to_box(rect: sly.Rectangle) -> Tuple[float, float, float, float]:
+    return (rect.top, rect.left, rect.bottom, rect.right)
+
+
+def score_boxes(
+    group: SyntheticGroup,
+    predicted: Dict[int, Dict[int, Tuple[float, ...]]],
+    box_idx: Optional[int] = None,
+) -> Dict[str, float]:
+    """
+    `predicted` is target index -> reference box index -> box.
+    Missing predictions of visible boxes count as zero IoU.
+    If `box_idx` is set, only this reference box is scored.
+    """
+    ious = []
+    for target_idx, gt_boxes in enumerate(group.gt_boxes):
+        for idx, gt_box in enumerate(gt_boxes):
+            if gt_box is None or (box_idx is not None and idx != box_idx):
+                continue
+            box = predicted.get(target_idx, {}).get(idx)
+            ious.append(0.0 if box is None else box_iou(gt_box, box))
+    if len(ious) == 0:
+        return {"mean_iou": 0.0, "recall@0.5": 0.0}
+    return {
+        "mean_iou": float(np.mean(ious)),
+        "recall@0.5": float(np.mean(np.array(ious) >= 0.5)),
+    }
+
+
+class PeakMemory:
+    """
+    Samples process RSS in background and reports its peak (and peak CUDA memory) in MB.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    def _rss(self) -> int:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * self._page_size
+        except OSError:
+            import resource
+
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak_rss = max(self.peak_rss, self._rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self.peak_rss = self._rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, self._rss())
+
+    def result(self) -> Dict[str, float]:
+        result = {"peak_rss_mb": self.peak_rss / 1024**2}
+        if torch.cuda.is_available():
+            result["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 1024**2
+        return result
+
+
+def make_image_info(image_id: int, image: np.ndarray, **fields) -> sly.ImageInfo:
+    info = sly.ImageInfo(*([None] * len(sly.ImageInfo._fields)))
+    return info._replace(
+        id=image_id,
+        name=f"{image_id}.jpg",
+        width=image.shape[1],
+        height=image.shape[0],
+        dataset_id=DATASET_ID,
+        project_id=PROJECT_ID,
+        **fields,
+    )
+
+
+class FakeApi:
+    """
+    In-memory stand-in for `sly.Api` with the methods used by the match flow.
+    Every call is timed, and `latency` seconds are added to it to simulate the network.
+    Created figures are kept in `created_figures` and tags added to figures in `figure_tags`.
+    The first reference box has an attribute tag, which matched boxes must copy.
+    Like the server, figures with ids and tags of unknown metas or figures are rejected.
+    With `groups` > 1, the dataset has copies of the group with other multiview tag values.
+    Uploaded annotations replace the stored ones, ids of their images are kept in `uploaded_ids`,
+    and uploads that include `fail_upload_ids` fail.
+    """
+
+    def __init__(self, group: SyntheticGroup, latency: float = 0.0, groups: int = 1):
+        self.latency = latency
+        self.calls_time = 0.0
+        self.created_figures: List[dict] = []
+        self.figure_tags: Dict[int, List[dict]] = {}
+        self.uploaded_ids: List[int] = []
+        self.fail_upload_ids: Set[int] = set()
+        self._next_id = 1000
+
+        self.box_class = sly.ObjClass("box", sly.Rectangle, sly_id=1)
+        group_tag_meta = sly.TagMeta("multiview", sly.TagValueType.ANY_STRING, sly_id=2)
+        settings = sly.ProjectSettings(
+            multiview_enabled=True, multiview_tag_name=group_tag_meta.name, multiview_tag_id=2
+        )
+        self.attribute_tag_meta = sly.TagMeta("attribute", sly.TagValueType.ANY_STRING, sly_id=3)
+        self.meta = sly.ProjectMeta(
+            obj_classes=[self.box_class],
+            tag_metas=[group_tag_meta, self.attribute_tag_meta],
+            project_settings=settings,
+        )
+
+        self.images_bytes, self.infos, self.anns = {}, {}, {}
+        for group_idx, (idx, image) in itertools.product(range(groups), enumerate(group.images)):
+            image_id = group_idx * len(group.images) + idx + 1
+            tag_value = GROUP_TAG_VALUE if group_idx == 0 else f"{GROUP_TAG_VALUE}-{group_idx}"
+            data = cv2.imencode(".jpg", cv2.cvtColor(image, cv2.COLOR_RGB2BGR))[1].tobytes()
+            self.images_bytes[image_id] = data
+            self.infos[image_id] = make_image_info(
+                image_id,
+                image,
+                hash=f"synthetic-{id(group)}-{image_id}",
+                tags=[{AF.TAG_ID: 2, AF.VALUE: tag_value}],
+            )
+            labels = []
+            if idx == 0:
+                attribute_tag = sly.Tag(self.attribute_tag_meta, "reference")
+                labels = [
+                    sly.Label(
+                        sly.Rectangle(*box),
+                        self.box_class,
+                        tags=[attribute_tag] if box_idx == 0 else None,
+                        description=str(box_idx),
+                        sly_id=self._new_id(),
+                    )
+                    for box_idx, box in enumerate(group.ref_boxes)
+                ]
+            self.figure_tags.update({label.sly_id: [] for label in labels})
+            self.anns[image_id] = sly.Annotation(image.shape[:2], labels).to_json()
+
+        self.project = SimpleNamespace(
+            get_meta=self._timed(self._get_meta), update_meta=self._timed(self._update_meta)
+        )
+        self.dataset = SimpleNamespace(
+            get_list=self._timed(lambda project_id: [SimpleNamespace(id=DATASET_ID)])
+        )
+        self.annotation = SimpleNamespace(
+            download=self._timed(self._download_ann),
+            download_batch=self._timed(self._download_anns),
+            upload_anns=self._timed(self._upload_anns),
+        )
+        self.image = SimpleNamespace(
+            get_list=self._timed(lambda dataset_id: list(self.infos.values())),
+            get_info_by_id=self._timed(lambda image_id: self.infos[image_id]),
+            download_bytes=self._timed(self._download_bytes),
+            download_path=self._timed(self._download_path),
+            download_paths=self._timed(self._download_paths),
+            figure=SimpleNamespace(
+                create_bulk=self._timed(self._create_figures),
+                remove_batch=self._timed(self._remove_figures),
+            ),
+            tag=SimpleNamespace(add_to_objects=self._timed(self._add_tags)),
+        )
+
+    def _new_id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    def _timed(self, func):
+        def _call(*args, **kwargs):
+            start = time.perf_counter()
+            if self.latency > 0:
+                time.sleep(self.latency)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.calls_time += time.perf_counter() - start
+
+        return _call
+
+    def _get_meta(self, project_id, with_settings=False):
+        return self.meta.to_json()
+
+    def _update_meta(self, project_id, meta):
+        tag_metas = [
+            tag_meta if tag_meta.sly_id is not None else tag_meta.clone(sly_id=self._new_id())
+            for tag_meta in meta.tag_metas
+        ]
+        self.meta = meta.clone(tag_metas=tag_metas)
+        return self.meta
+
+    def _download_ann(self, image_id):
+        return SimpleNamespace(image_id=image_id, annotation=self.anns[image_id])
+
+    def _download_anns(self, dataset_id, image_ids):
+        return [self._download_ann(image_id) for image_id in image_ids]
+
+    def _upload_anns(self, image_ids, anns):
+        if len(self.fail_upload_ids.intersection(image_ids)) > 0:
+            raise RuntimeError("Connection is lost")
+        for image_id, ann in zip(image_ids, anns):
+            self.anns[image_id] = ann.to_json()
+        self.uploaded_ids.extend(image_ids)
+
+    def _download_bytes(self, dataset_id, image_ids):
+        return [self.images_bytes[image_id] for image_id in image_ids]
+
+    def _download_path(self, image_id, path):
+        with open(path, "wb") as f:
+            f.write(self.images_bytes[image_id])
+
+    def _download_paths(self, dataset_id, image_ids, paths):
+        for image_id, path in zip(image_ids, paths):
+            self._download_path(image_id, path)
+
+    def _create_figures(self, figures_json, entity_id=None, dataset_id=None):
+        if any(AF.ID in figure_json for figure_json in figures_json):
+            raise ValueError("New figures must not have ids")
+        figure_ids = [self._new_id() for _ in figures_json]
+        for figure_id, figure_json in zip(figure_ids, figures_json):
+            self.created_figures.append({**figure_json, AF.ID: figure_id})
+            self.figure_tags[figure_id] = []
+        return figure_ids
+
+    def _remove_figures(self, ids, progress_cb=None, batch_size=50):
+        ids = set(ids)
+        self.created_figures = [f for f in self.created_figures if f[AF.ID] not in ids]
+        for figure_id in ids:
+            self.figure_tags.pop(figure_id, None)
+
+    def _add_tags(self, project_id, tags_json):
+        tag_ids = {tag_meta.sly_id for tag_meta in self.meta.tag_metas}
+        for tag_json in tags_json:
+            if tag_json[AF.TAG_ID] not in tag_ids:
+                raise KeyError(f"Unknown tag meta id {tag_json[AF.TAG_ID]}")
+            self.figure_tags[tag_json[AF.FIGURE_ID]].append(tag_json)
+        return []
+
+    def check_copied_tags(self) -> None:
+        """
+        Raises RuntimeError if a box matched with the first reference box has no attribute tag.
+        """
+        for figure in self.created_figures:
+            tag_ids = [tag[AF.TAG_ID] for tag in self.figure_tags[figure[AF.ID]]]
+            if figure["description"] == "0" and self.attribute_tag_meta.sly_id not in tag_ids:
+                raise RuntimeError("Tags of the reference box are not copied to matched boxes")
+
+
+def reset_caches() -> None:
+    g.IMAGE_CACHE.clear()
+    FEATURE_STORE.clear()
+    MATCH_STORE.clear()
+    CACHE.project_metas.clear()
+    CACHE.invalidate_group_index()
+
+
+def run_lightglue_stages(
+    group: SyntheticGroup, work_dir: str, params: dict
+) -> Tuple[Dict[str, float], Dict[str, float]]:
+    """
+    Runs `apply_lightglue` over group images on disk and `transpose_bboxes` over its results.
+    Returns stage timings in seconds and box scores.
+    """
+    paths = []
+    for idx, image in enumerate(group.images):
+        path = os.path.join(work_dir, f"{idx}.jpg")
+        cv2.imwrite(path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+        paths.append(path)
+    path_to_idx = {path: idx - 1 for idx, path in enumerate(paths)}
+    box_class = sly.ObjClass("box", sly.Rectangle)
+    ref_labels = [
+        sly.Label(sly.Rectangle(*box), box_class, description=str(idx))
+        for idx, box in enumerate(group.ref_boxes)
+    ]
+
+    start = time.perf_counter()
+    points_list = list(
+        process.apply_lightglue(
+            paths,
+            params["max_keypoints"],
+            params["resize"],
+            params["filter_threshold"],
+            params["device"],
+            batch_size=params["batch_size"],
+        )
+    )
+    lightglue_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new_labels = process.transpose_bboxes(ref_labels, points_list)
+    transpose_time = time.perf_counter() - start
+
+    # * apply_lightglue removes the reference and failed images from `paths`
+    predicted = {
+        path_to_idx[path]: {int(label.description): rect_to_box(label.geometry) for label in labels}
+        for path, labels in zip(paths, new_labels)
+    }
+    return {"lightglue": lightglue_time, "transpose": transpose_time}, score_boxes(
+        group, predicted
+    )
+
+
+def import_app():
+    """
+    Imports the app module in development mode, so UI updates are not sent to the server.
+    Globals are already imported in production mode, which skips the debug connection setup.
+    """
+    os.environ["ENV"] = "development"
+    import src.main as main
+
+    return main
+
+
+def run_match_flow(
+    group: SyntheticGroup,
+    params: dict,
+    latency: float,
+    box_idx: Optional[int] = None,
+    reset: bool = True,
+) -> Tuple[Dict[str, float], Dict[str, float]]:
+    """
+    Runs the whole match flow of the app, as after the MATCH BBOXES click, with FakeApi.
+    If `box_idx` is set, only this box is selected, as after the click on a single figure.
+    Without `reset`, features and matches cached by previous runs are used.
+    Returns stage timings in seconds and scores of uploaded boxes.
+    """
+    from src.jobs import MatchJob
+
+    main = import_app()
+
+    fake_api = FakeApi(group, latency)
+    g.api = fake_api
+    if reset:
+        reset_caches()
+    # * Every FakeApi is a new server, tag metas added to the previous one are unknown to it
+    CACHE.project_metas.clear()
+    figure_id = None
+    if box_idx is not None:
+        figure_id = fake_api.anns[1]["objects"][box_idx]["id"]
+    CACHE.project_id, CACHE.dataset_id, CACHE.image_id, CACHE.figure_id = (
+        PROJECT_ID,
+        DATASET_ID,
+        1,
+        figure_id,
+    )
+    CACHE.cache_project_meta(PROJECT_ID)
+
+    job = MatchJob(1, DATASET_ID, figure_id, params, PROJECT_ID)
+    start = time.perf_counter()
+    main.run_match_job(job)
+    total_time = time.perf_counter() - start
+    fake_api.check_copied_tags()
+
+    predicted = {}
+    for figure in fake_api.created_figures:
+        box = rect_to_box(sly.Rectangle.from_json(figure))
+        predicted.setdefault(figure[AF.ENTITY_ID] - 2, {})[int(figure["description"])] = box
+    scores = score_boxes(group, predicted, box_idx)
+    return {"end_to_end": total_time, "api": fake_api.calls_time}, scores
+
+
+def run_single_box_flows(
+    group: SyntheticGroup, params: dict, latency: float, roi_margin: float
+) -> Tuple[Dict[str, float], Dict[str, float]]:
+    """
+    Matches the first box alone: with whole images, with the region of interest
+    and with the region of interest narrowed by matches cached by the first run.
+    Returns (end-to-end timings in seconds, scores) with prefixed keys.
+    """
+    timings, scores = {}, {}
+    runs = (
+        ("single", {"roi_margin": None}, True),
+        ("roi_narrow", {"roi_margin": roi_margin, "roi_narrow": True}, False),
+        ("roi", {"roi_margin": roi_margin, "roi_narrow": False}, True),
+    )
+    for prefix, run_params, reset in runs:
+        run_times, run_scores = run_match_flow(
+            group, {**params, **run_params}, latency, box_idx=0, reset=reset
+        )
+        timings[f"{prefix}_end_to_end"] = run_times["end_to_end"]
+        scores.update({f"{prefix}_{key}": value for key, value in run_scores.items()})
+    return timings, scores
+
+
+def run_case(
+    case: dict,
+    repeats: int,
+    seed: int,
+    work_dir: str,
+    latency: float,
+    device: str,
+    source: Optional[np.ndarray] = None,
+    parity: Optional[dict] = None,
+    roi_margin: Optional[float] = None,
+    shard_workers: Optional[int] = None,
+    batch_check: bool = False,
+) -> Dict[str, float]:
+    rng = np.random.default_rng(seed)
+    group = make_group(rng, case["group_size"], case["boxes"], source=source)
+    params = {
+        "device": device,
+        "max_keypoints": case["max_keypoints"],
+        "resize": case["resize"],
+        "filter_threshold": 0.3,
+        "batch_size": case["batch_size"],
+    }
+    MODEL_POOL.get(device, params["max_keypoints"], params["filter_threshold"])
+
+    timings, scores, memory = {}, {}, {}
+    # * The first run is a warm-up and is not measured
+    for run_idx in range(repeats + 1):
+        reset_caches()
+        with PeakMemory() as peak_memory:
+            stage_times, scores = run_lightglue_stages(group, work_dir, params)
+            flow_times, flow_scores = run_match_flow(group, params, latency)
+            if roi_margin is not None:
+                single_times, single_scores = run_single_box_flows(
+                    group, params, latency, roi_margin
+                )
+                flow_times.update(single_times)
+                flow_scores.update(single_scores)
+        if run_idx == 0:
+            continue
+        for stage, seconds in {**stage_times, **flow_times}.items():
+            timings.setdefault(stage, []).append(seconds)
+        for key, value in peak_memory.result().items():
+            memory[key] = max(memory.get(key, 0), value)
+
+    result = {f"{stage}_ms": statistics.median(values) * 1000 for stage, values in timings.items()}
+    result["images_per_sec"] = (case["group_size"] - 1) / statistics.median(timings["end_to_end"])
+    result.update(memory)
+    result.update(scores)
+    result.update({f"flow_{key}": value for key, value in flow_scores.items()})
+    if parity is not None:
+        result.update(check_backend_parity(group, case, device, **parity))
+    if shard_workers is not None:
+        result.update(check_shard_parity(group, case, shard_workers))
+    if batch_check:
+        result.update(check_batch(group, case, device))
+    return result
+
+
+def matches_parity(
+    baseline: Tuple[np.ndarray, np.ndarray],
+    matches: Tuple[np.ndarray, np.ndarray],
+    tolerance: float,
+) -> float:
+    """
+    Returns the fraction of baseline matches that have a match within `tolerance` pixels
+    in both the reference and the target image.
+    """
+    (base_ref, base_img), (ref, img) = baseline, matches
+    if len(base_ref) == 0:
+        return 1.0
+    if len(ref) == 0:
+        return 0.0
+    ref_dist = np.linalg.norm(base_ref[:, None] - ref[None], axis=-1)
+    img_dist = np.linalg.norm(base_img[:, None] - img[None], axis=-1)
+    return float(((ref_dist <= tolerance) & (img_dist <= tolerance)).any(axis=1).mean())
+
+
+def low_texture_images(images: List[np.ndarray]) -> List[np.ndarray]:
+    """
+    Blurred copies of images with low contrast, so few keypoints are detected on them.
+    """
+    return [
+        cv2.addWeighted(cv2.GaussianBlur(image, (0, 0), 8), 0.2, image, 0, 100)
+        for image in images
+    ]
+
+
+def check_backend_parity(
+    group: SyntheticGroup,
+    case: dict,
+    device: str,
+    backend: str,
+    quantize: bool,
+    tolerance: float,
+) -> Dict[str, float]:
+    """
+    Matches the group with eager models and with the given backend,
+    returns the lowest and mean parity of matched points over group images and timings.
+    The group is also matched in low texture and small resize, where fewer keypoints than
+    `max_keypoints` are detected, and its lowest parity is counted in the lowest one.
+    """
+    infos = [make_image_info(idx + 1, image) for idx, image in enumerate(group.images)]
+    runs = {
+        "": (group.images, case["resize"]),
+        "sparse_": (low_texture_images(group.images), SPARSE_PARITY_RESIZE),
+    }
+    result, all_ratios = {}, []
+    for prefix, (images, resize) in runs.items():
+        results, timings = {}, {}
+        for name, (run_backend, run_quantize) in {
+            "eager": ("eager", False),
+            "backend": (backend, quantize),
+        }.items():
+            args = (case["max_keypoints"], resize, 0.3, device, run_backend, run_quantize)
+            # * The first run loads (and exports or compiles) the models and is not measured
+            process.match_decoded_group(images, infos, *args)
+            start = time.perf_counter()
+            matched = process.match_decoded_group(images, infos, *args)
+            timings[f"{name}_ms"] = (time.perf_counter() - start) * 1000
+            results[name] = {image_id: (ref, img) for image_id, ref, img in matched}
+
+        ratios = [
+            matches_parity(matches, results["backend"][image_id], tolerance)
+            if image_id in results["backend"]
+            else 0.0
+            for image_id, matches in results["eager"].items()
+        ]
+        all_ratios.extend(ratios)
+        result[f"parity_{prefix}min"] = min(ratios, default=1.0)
+        result[f"parity_{prefix}mean"] = float(np.mean(ratios)) if len(ratios) > 0 else 1.0
+        if prefix == "":
+            result.update({f"parity_{key}": value for key, value in timings.items()})
+    result["parity_min"] = min(all_ratios, default=1.0)
+    return result
+
+
+def check_shard_parity(group: SyntheticGroup, case: dict, workers: int) -> Dict[str, float]:
+    """
+    Matches the group on CPU in the app process and in `workers` worker processes,
+    returns the lowest and mean parity of matched points over group images and timings.
+    Workers have eager models, so the serial path is run with them too and points must be equal.
+    """
+    g.api = FakeApi(group)
+    backend, quantize = g.INFERENCE_BACKEND, g.QUANTIZE_MATCHER
+    g.INFERENCE_BACKEND, g.QUANTIZE_MATCHER = "eager", False
+    infos = list(g.api.infos.values())
+    args = (case["max_keypoints"], case["resize"], 0.3)
+    runs = {
+        "serial": lambda: process.stream_lightglue(infos, *args, "cpu"),
+        "sharded": lambda: process.shard_lightglue(infos, *args, shard_workers=workers),
+    }
+    results, timings = {}, {}
+    try:
+        for name, run in runs.items():
+            # * The first run starts workers and loads the models and is not measured
+            for _ in range(2):
+                reset_caches()
+                start = time.perf_counter()
+                matched = list(run())
+            timings[f"{name}_ms"] = (time.perf_counter() - start) * 1000
+            results[name] = {image_id: (ref, img) for image_id, ref, img in matched}
+    finally:
+        g.INFERENCE_BACKEND, g.QUANTIZE_MATCHER = backend, quantize
+
+    ratios = [
+        matches_parity(matches, results["sharded"][image_id], 0.0)
+        if image_id in results["sharded"]
+        else 0.0
+        for image_id, matches in results["serial"].items()
+    ]
+    return {
+        "shard_parity_min": min(ratios, default=1.0),
+        "shard_parity_mean": float(np.mean(ratios)) if len(ratios) > 0 else 1.0,
+        **{f"shard_{key}": value for key, value in timings.items()},
+    }
+
+
+def check_batch_anns(api: FakeApi, image_ids: List[int]) -> List[str]:
+    """
+    Returns problems of uploaded annotations of the group: reference boxes must have
+    the "reference" type tag, matched boxes the "matched" one and the attribute tag
+    of the first reference box, and all of them the ID tag.
+    """
+    meta = sly.ProjectMeta.from_json(api.meta.to_json())
+    problems = []
+    matched = 0
+    for idx, image_id in enumerate(image_ids):
+        ann = sly.Annotation.from_json(api.anns[image_id], meta)
+        expected_type = "reference" if idx == 0 else "matched"
+        matched += int(idx > 0 and len(ann.labels) > 0)
+        for label in ann.labels:
+            type_tag = label.tags.get(CACHE.type_tag_meta.name)
+            if type_tag is None or type_tag.value != expected_type:
+                problems.append(f"image {image_id}: box is not tagged as {expected_type}")
+            if label.tags.get(CACHE.id_tag_meta.name) is None:
+                problems.append(f"image {image_id}: box has no ID tag")
+            copied = label.tags.get(api.attribute_tag_meta.name) is not None
+            if label.description == "0" and not copied:
+                problems.append(f"image {image_id}: tags of the reference box are not copied")
+    if matched == 0:
+        problems.append(f"images {image_ids}: no boxes are matched")
+    return problems
+
+
+def check_batch(group: SyntheticGroup, case: dict, device: str) -> Dict[str, float]:
+    """
+    Runs batch matching in process over two copies of the group, the upload of the second
+    one fails at first. Checks that the rerun continues from the state file without matching
+    the first group again and the uploaded annotations. Returns timings.
+    Raises RuntimeError if any check fails.
+    """
+    api = FakeApi(group, groups=2)
+    group_ids = [list(api.infos)[: len(group.images)], list(api.infos)[len(group.images) :]]
+    api.fail_upload_ids = set(group_ids[1])
+    params = {
+        "max_num_keypoints": case["max_keypoints"],
+        "resize": case["resize"],
+        "filter_threshold": 0.3,
+        "device": device,
+    }
+    state_dir = tempfile.mkdtemp(prefix="batch_")
+    kwargs = dict(
+        params=params,
+        num_workers=0,
+        state_path=os.path.join(state_dir, "state.json"),
+        model_dir=g.MODEL_DIR,
+        ann_io=AnnotationIO(retries=0),
+    )
+    try:
+        start = time.perf_counter()
+        interrupted = batch.run_batch(api, PROJECT_ID, **kwargs)
+        batch_time = time.perf_counter() - start
+        api.fail_upload_ids.clear()
+        uploaded = len(api.uploaded_ids)
+        resumed = batch.run_batch(api, PROJECT_ID, **kwargs)
+    finally:
+        sly.fs.remove_dir(state_dir)
+
+    problems = []
+    if interrupted["groups"] != 1 or interrupted["failed"] != 1:
+        problems.append(f"interrupted run: {interrupted}")
+    if resumed["groups"] != 1 or resumed["resumed"] != 1:
+        problems.append(f"resumed run: {resumed}")
+    if sorted(api.uploaded_ids[uploaded:]) != group_ids[1]:
+        problems.append("resumed run uploaded processed groups again")
+    for image_ids in group_ids:
+        problems.extend(check_batch_anns(api, image_ids))
+    if len(problems) > 0:
+        raise RuntimeError(f"Batch matching check failed: {'; '.join(problems)}")
+    return {"batch_ms": batch_time * 1000}
+
+
+# * Runs in a fresh process, as the benchmark itself has already imported torch.
+# * API requests are answered with empty responses and counted, no requests reach the server.
+STARTUP_SCRIPT = """
+import json, os, sys, time
+from unittest import mock
+start = time.perf_counter()
+import supervisely
+sdk_loaded = time.perf_counter()
+api_requests = []
+def fake_request(api, method, *args, **kwargs):
+    api_requests.append(method)
+    return mock.Mock(status_code=200, **{"json.return_value": {}})
+supervisely.Api.post = supervisely.Api.get = fake_request
+import src.globals
+os.environ["ENV"] = "development"
+import src.main as main
+ui_ready = time.perf_counter()
+torch_before_ui = "torch" in sys.modules
+main.STARTUP.wait(float(sys.argv[1]))
+print(json.dumps({
+    "sdk_import": sdk_loaded - start,
+    "ui_ready": ui_ready - sdk_loaded,
+    "models_ready": time.perf_counter() - start,
+    "torch_before_ui": float(torch_before_ui),
+    "startup_failed": float(main.STARTUP.error is not None or not main.STARTUP.is_ready()),
+    "api_requests": float(len(api_requests)),
+}))
+"""
+
+
+def measure_startup(timeout: float = 600) -> Dict[str, float]:
+    """
+    Imports the app in a fresh process, as `uvicorn src.main:app` does, with requests of
+    the API mocked. Returns seconds to import the SDK, then seconds until the UI can be served,
+    seconds from the start until models are loaded and the number of API requests.
+    """
+    import subprocess
+
+    env = dict(os.environ, ENV="production", SLY_APP_DATA_DIR=tempfile.mkdtemp())
+    output = subprocess.run(
+        [sys.executable, "-c", STARTUP_SCRIPT, str(timeout)],
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=timeout + 60,
+        check=True,
+    ).stdout
+    sly.fs.remove_dir(env["SLY_APP_DATA_DIR"])
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def case_name(case: dict) -> str:
+    return ",".join(f"{key}={value}" for key, value in case.items())
+
+
+def compare_with_baseline(
+    results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float, iou_tolerance: float
+) -> List[str]:
+    """
+    Returns descriptions of regressions: slower stages, lower throughput, more memory
+    (relative `tolerance`) and lower box scores (absolute `iou_tolerance`).
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for key, value in result.items():
+            if key not in base:
+                continue
+            old = base[key]
+            if key.endswith("_ms") or key.endswith("_mb"):
+                failed = value > old * (1 + tolerance)
+            elif key == "images_per_sec":
+                failed = value < old * (1 - tolerance)
+            else:
+                failed = value < old - iou_tolerance
+            if failed:
+                regressions.append(f"{name}: {key} {old:.3f} -> {value:.3f}")
+    return regressions
+
+
+def print_report(results: Dict[str, dict]) -> None:
+    keys = sorted({key for result in results.values() for key in result})
+    width = max(len(name) for name in results)
+    print(" | ".join(["case".ljust(width)] + keys))
+    for name, result in results.items():
+        values = [f"{result.get(key, float('nan')):.3f}".rjust(len(key)) for key in keys]
+        print(" | ".join([name.ljust(width)] + values))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark matching on synthetic groups")
+    parser.add_argument("--group-sizes", type=int, nargs="+", default=[4])
+    parser.add_argument("--boxes", type=int, nargs="+", default=[3])
+    parser.add_argument("--resize", type=int, nargs="+", default=[256], help="0 for no resize")
+    parser.add_argument("--max-keypoints", type=int, nargs="+", default=[1024])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--source-image", default=None, help="Image to warp instead of generated")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0)
+    parser.add_argument("--output", default=None, help="Path to save results as JSON")
+    parser.add_argument("--baseline", default=None, help="Path to the baseline results JSON")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--iou-tolerance", type=float, default=0.05)
+    parser.add_argument("--check-backend", default=None, choices=BACKENDS)
+    parser.add_argument("--check-quantize", action="store_true")
+    parser.add_argument("--parity-tolerance", type=float, default=2.0, help="Pixels")
+    parser.add_argument("--min-parity", type=float, default=0.9)
+    parser.add_argument(
+        "--roi-margin",
+        type=float,
+        default=None,
+        help="Also match the first box alone, with and without the region of interest",
+    )
+    parser.add_argument(
+        "--check-shards",
+        type=int,
+        default=None,
+        help="Compare matching in this number of worker processes with the serial one on CPU",
+    )
+    parser.add_argument(
+        "--check-batch", action="store_true", help="Check headless batch matching and resuming"
+    )
+    parser.add_argument("--check-startup", action="store_true", help="Measure app startup only")
+    parser.add_argument("--startup-budget", type=float, default=1.0, help="Seconds")
+    args = parser.parse_args()
+
+    if args.check_startup:
+        timings = [measure_startup() for _ in range(args.repeats)]
+        result = {key: statistics.median(t[key] for t in timings) for key in timings[0]}
+        print_report({"startup": result})
+        if result["ui_ready"] > args.startup_budget or result["torch_before_ui"] > 0:
+            sly.logger.error(
+                "Regression: UI is not ready within the startup budget", extra=result
+            )
+            sys.exit(1)
+        sly.logger.info("Startup check is finished without regressions")
+        return
+
+    # * Matched points of the checked backend are compared with the eager ones
+    parity = None
+    if args.check_backend is not None or args.check_quantize:
+        parity = {
+            "backend": args.check_backend or "eager",
+            "quantize": args.check_quantize,
+            "tolerance": args.parity_tolerance,
+        }
+
+    # * Images of the direct LightGlue stages are written to a temporary directory
+    work_dir = tempfile.mkdtemp(prefix="benchmark_")
+    source = None
+    if args.source_image is not None:
+        source = image_io.read_image(args.source_image)
+
+    results = {}
+    grid = itertools.product(
+        args.group_sizes, args.boxes, args.resize, args.max_keypoints, args.batch_sizes
+    )
+    for group_size, boxes, resize, max_keypoints, batch_size in grid:
+        case = {
+            "group_size": group_size,
+            "boxes": boxes,
+            "resize": resize or None,
+            "max_keypoints": max_keypoints or None,
+            "batch_size": batch_size,
+        }
+        name = case_name(case)
+        sly.logger.info(f"Benchmarking {name}")
+        results[name] = run_case(
+            case,
+            args.repeats,
+            args.seed,
+            work_dir,
+            args.api_latency_ms / 1000,
+            args.device,
+            source,
+            parity,
+            args.roi_margin,
+            args.check_shards,
+            args.check_batch,
+        )
+    sly.fs.remove_dir(work_dir)
+
+    print_report(results)
+    if args.output is not None:
+        sly.json.dump_json_file(results, args.output, indent=2)
+
+    failures = []
+    if parity is not None:
+        failures.extend(
+            f"{name}: parity {result['parity_min']:.3f} < {args.min_parity}"
+            for name, result in results.items()
+            if result["parity_min"] < args.min_parity
+        )
+    if args.check_shards is not None:
+        failures.extend(
+            f"{name}: shard parity {result['shard_parity_min']:.3f} < 1"
+            for name, result in results.items()
+            if result["shard_parity_min"] < 1.0
+        )
+    if args.baseline is not None and args.save_baseline:
+        sly.json.dump_json_file(results, args.baseline, indent=2)
+        sly.logger.info(f"Baseline is saved to {args.baseline}")
+    elif args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failures.extend(
+            compare_with_baseline(results, baseline, args.tolerance, args.iou_tolerance)
+        )
+    if len(failures) > 0:
+        for failure in failures:
+            sly.logger.error(f"Regression: {failure}")
+        sys.exit(1)
+    sly.logger.info("Benchmark is finished without regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+from typing import List, Literal, Optional, Tuple
+
+import supervisely as sly
+
+# * Batch matching imports this module, so it must not import src.globals
+
+
+class BoxTagger:
+    """
+    Selects reference boxes and tags reference and matched boxes: the type tag marks boxes
+    as "reference" or "matched", and the ID tag with the same value links a reference box
+    with the boxes matched from it.
+    """
+
+    def __init__(self):
+        self.type_tag_meta = sly.TagMeta(
+            "bbox match type", sly.TagValueType.ONEOF_STRING, ["reference", "matched"]
+        )
+        self.id_tag_meta = sly.TagMeta("matched bbox ID", sly.TagValueType.ANY_NUMBER)
+        self.box_id = 0
+
+    def select_reference_bbox_labels(
+        self, image_ann: sly.Annotation, figure_id: Optional[int]
+    ) -> List[sly.Label]:
+        if figure_id is not None:
+            label = image_ann.get_label_by_id(figure_id)
+            if label is None:
+                sly.logger.warning(f"Figure (id: {figure_id}) not found in the image annotation")
+                return []
+            if label.tags.get(self.type_tag_meta.name) is not None:
+                return []
+            return [label]
+        return [
+            label
+            for label in image_ann.labels
+            if (isinstance(label.geometry, sly.Rectangle))
+            and label.tags.get(self.type_tag_meta.name) is None
+        ]
+
+    def add_type_tag_to_labels(
+        self, labels: List[sly.Label], value: Literal["reference", "matched"]
+    ) -> List[sly.Label]:
+        type_tag = sly.Tag(self.type_tag_meta, value)
+        res_labels = []
+        for label in labels:
+            if label.tags.get(self.type_tag_meta.name) is None:
+                label = label.add_tag(type_tag)
+            res_labels.append(label)
+        return res_labels
+
+    def tag_matched_labels(
+        self,
+        ref_labels: List[sly.Label],
+        ref_boxes_labels: List[sly.Label],
+        new_bbox_labels: List[List[sly.Label]],
+    ) -> Tuple[List[sly.Label], List[List[sly.Tag]], List[List[sly.Label]]]:
+        """
+        Adds type and ID tags to reference and matched boxes.
+        Returns new reference labels, tags added to each reference label and new group labels.
+        """
+        # * Add type tag to reference boxes
+        new_ref_labels, ref_added_tags = [], []
+        for label in ref_labels:
+            added_tags = []
+            if label in ref_boxes_labels:
+                label = self.add_type_tag_to_labels([label], "reference")[0]
+                added_tags.append(sly.Tag(self.type_tag_meta, "reference"))
+            new_ref_labels.append(label)
+            ref_added_tags.append(added_tags)
+
+        # * Add ID tag to boxes
+        id_tags = []
+        for idx, ref_box in enumerate(new_ref_labels):
+            tag = sly.Tag(self.id_tag_meta, self.box_id)
+            new_ref_labels[idx] = ref_box.add_tag(tag)
+            ref_added_tags[idx].append(tag)
+            id_tags.append(tag)
+            self.box_id += 1
+        res_bbox_labels = self.tag_group_labels(new_bbox_labels, id_tags)
+        return new_ref_labels, ref_added_tags, res_bbox_labels
+
+    def tag_group_labels(
+        self, new_bbox_labels: List[List[sly.Label]], id_tags: List[sly.Tag]
+    ) -> List[List[sly.Label]]:
+        """
+        Adds type tag and ID tags of reference labels (by label index) to matched boxes,
+        so matched boxes of a group can be tagged in parts.
+        """
+        res_bbox_labels = [
+            self.add_type_tag_to_labels((box_list), "matched") for box_list in new_bbox_labels
+        ]
+        for idx, tag in enumerate(id_tags):
+            for image_boxes in res_bbox_labels:
+                if idx < len(image_boxes):
+                    image_boxes[idx] = image_boxes[idx].add_tag(tag)
+        return res_bbox_labels
+
+    def merge_matched_labels(
+        self,
+        ref_ann: sly.Annotation,
+        ref_boxes_labels: List[sly.Label],
+        orig_anns: List[sly.Annotation],
+        new_bbox_labels: List[List[sly.Label]],
+    ) -> Tuple[sly.Annotation, List[sly.Annotation]]:
+        """
+        Adds type and ID tags to reference and matched boxes and merges matched boxes
+        into the original annotations of group images.
+        Returns new reference annotation and new group annotations.
+        """
+        new_ref_labels, _, res_bbox_labels = self.tag_matched_labels(
+            ref_ann.labels, ref_boxes_labels, new_bbox_labels
+        )
+        anns = [ann.add_labels(box_labels) for ann, box_labels in zip(orig_anns, res_bbox_labels)]
+        return ref_ann.clone(labels=new_ref_labels), anns
@@ -0,0 +1,122 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+import numpy as np
+import supervisely as sly
+import src.globals as g
+
+
+Features = Dict[str, np.ndarray]
+
+
+def _features_nbytes(features: Features) -> int:
+    return sum(arr.nbytes for arr in features.values())
+
+
+class FeatureStore:
+    """
+    LRU store of extracted SuperPoint features (keypoints, scores, descriptors).
+
+    Entries are kept in memory up to `max_bytes`. When `spill_dir` is set, entries evicted
+    from memory are written to .npy files and read back as memory-mapped arrays,
+    the disk part is limited by `max_spill_bytes`.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 512 * 1024**2,
+        spill_dir: Optional[str] = None,
+        max_spill_bytes: int = 2 * 1024**3,
+    ):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self._memory: Dict[Hashable, Features] = OrderedDict()
+        self._memory_bytes = 0
+        self._spilled: Dict[Hashable, Dict[str, str]] = OrderedDict()
+        self._spilled_sizes: Dict[Hashable, int] = {}
+        self._spilled_bytes = 0
+        self._lock = threading.Lock()
+        if self.spill_dir is not None:
+            sly.fs.mkdir(self.spill_dir, remove_content_if_exists=True)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._memory or key in self._spilled
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._memory) + len(self._spilled)
+
+    def get(self, key: Hashable) -> Optional[Features]:
+        with self._lock:
+            features = self._memory.get(key)
+            if features is not None:
+                self._memory.move_to_end(key)
+                return features
+            paths = self._spilled.get(key)
+            if paths is not None:
+                self._spilled.move_to_end(key)
+                return {name: np.load(path, mmap_mode="r") for name, path in paths.items()}
+        return None
+
+    def put(self, key: Hashable, features: Features) -> None:
+        nbytes = _features_nbytes(features)
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= _features_nbytes(self._memory.pop(key))
+            self._remove_spilled(key)
+            if nbytes > self.max_bytes:
+                self._spill(key, features)
+                return
+            self._memory[key] = features
+            self._memory_bytes += nbytes
+            while self._memory_bytes > self.max_bytes:
+                old_key, old_features = self._memory.popitem(last=False)
+                self._memory_bytes -= _features_nbytes(old_features)
+                self._spill(old_key, old_features)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            for key in list(self._spilled):
+                self._remove_spilled(key)
+
+    def _spill(self, key: Hashable, features: Features) -> None:
+        if self.spill_dir is None:
+            return
+        nbytes = _features_nbytes(features)
+        if nbytes > self.max_spill_bytes:
+            return
+        while self._spilled and self._spilled_bytes + nbytes > self.max_spill_bytes:
+            self._remove_spilled(next(iter(self._spilled)))
+
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        paths = {}
+        for arr_name, arr in features.items():
+            path = os.path.join(self.spill_dir, f"{name}_{arr_name}.npy")
+            mmap = np.lib.format.open_memmap(path, mode="w+", dtype=arr.dtype, shape=arr.shape)
+            mmap[...] = arr
+            mmap.flush()
+            del mmap
+            paths[arr_name] = path
+        self._spilled[key] = paths
+        self._spilled_sizes[key] = nbytes
+        self._spilled_bytes += nbytes
+
+    def _remove_spilled(self, key: Hashable) -> None:
+        paths = self._spilled.pop(key, None)
+        if paths is None:
+            return
+        self._spilled_bytes -= self._spilled_sizes.pop(key)
+        for path in paths.values():
+            sly.fs.silent_remove(path)
+
+
+FEATURE_STORE = FeatureStore(g.FEATURES_CACHE_MB * 1024**2, g.FEATURES_SPILL_DIR)
+# * Matched point pairs of (reference, target) images are stored the same way as features
+MATCH_STORE = FeatureStore(g.MATCHES_CACHE_MB * 1024**2)
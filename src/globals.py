@@ -1,9 +1,17 @@
 import os
+import threading
+import time
+from collections import defaultdict
 from dotenv import load_dotenv
 import supervisely as sly
 from supervisely.api.annotation_api import ApiField as AF
+from supervisely.annotation.label import LabelJsonFields
 import supervisely.app.development as development
-from typing import List, Dict, Literal
+from typing import List, Dict, Optional, Set, Tuple
+from src.metrics import METRICS
+from src.image_cache import ImageCache
+from src.ann_io import AnnotationIO
+from src.box_tags import BoxTagger
 
 # # * Advanced debug mode
 if sly.is_development():
@@ -15,14 +23,55 @@ else:
 
 # * Creating an instance of the supervisely API according to the environment variables.
 api = sly.Api.from_env()
-box_id = 0
 
 # * Directories that will be used for checkpoints & temporary image storage
 SLY_APP_DATA = sly.app.get_data_dir()
-sly.fs.clean_dir(SLY_APP_DATA)
 MODEL_DIR = "./checkpoints"
 
-class Cache:
+# * Downloaded images are kept between clicks, the least recently used ones are evicted
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", os.path.join(SLY_APP_DATA, "images"))
+IMAGE_CACHE_MB = int(os.environ.get("IMAGE_CACHE_MB", 2048))
+IMAGE_CACHE = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MB * 1024**2)
+
+# * Extracted features cache: in-memory budget and optional directory to spill evicted features to
+FEATURES_CACHE_MB = int(os.environ.get("FEATURES_CACHE_MB", 512))
+FEATURES_SPILL_DIR = os.environ.get("FEATURES_SPILL_DIR")
+# * Matched point pairs cache budget
+MATCHES_CACHE_MB = int(os.environ.get("MATCHES_CACHE_MB", 128))
+
+# * Number of group images downloaded concurrently
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 4))
+# * Annotations, figures and tags are sent in chunks of this size, several chunks at once
+ANN_CHUNK_SIZE = int(os.environ.get("ANN_CHUNK_SIZE", 50))
+ANN_IO_WORKERS = int(os.environ.get("ANN_IO_WORKERS", 4))
+# * Attempts and initial delay in seconds to resend a failed chunk
+ANN_IO_RETRIES = int(os.environ.get("ANN_IO_RETRIES", 3))
+ANN_IO_BACKOFF = float(os.environ.get("ANN_IO_BACKOFF", 0.5))
+ANN_IO = AnnotationIO(ANN_CHUNK_SIZE, ANN_IO_WORKERS, ANN_IO_RETRIES, ANN_IO_BACKOFF)
+
+# * Inference backend of SuperPoint and LightGlue: "eager", "compile" or "onnx"
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "eager")
+# * Dynamic int8 quantization of LightGlue linear layers (CPU only)
+QUANTIZE_MATCHER = os.environ.get("QUANTIZE_MATCHER", "false").lower() in ("1", "true")
+# * Number of intra-op threads on CPU, 0 keeps the default
+INTRA_OP_THREADS = int(os.environ.get("INTRA_OP_THREADS", 0))
+# * Memory-bounded mode: number of group images matched and uploaded at once, 0 matches all
+MATCH_WINDOW = int(os.environ.get("MATCH_WINDOW", 0))
+# * Resident memory ceiling in MB for the memory-bounded mode, windows shrink when it is exceeded
+MEMORY_CEILING_MB = int(os.environ.get("MEMORY_CEILING_MB", 0))
+# * Keep descriptors of cached features in half precision
+FP16_DESCRIPTORS = os.environ.get("FP16_DESCRIPTORS", "false").lower() in ("1", "true")
+# * Number of worker processes that match group images on CPU, 0 or 1 matches in the app process
+SHARD_WORKERS = int(os.environ.get("SHARD_WORKERS", 0))
+
+# * Seconds after which images updated since the last listing are added to the group index
+GROUP_INDEX_TTL = float(os.environ.get("GROUP_INDEX_TTL", 300))
+# * Seconds after which the label index of the selected image is downloaded again
+LABEL_INDEX_TTL = float(os.environ.get("LABEL_INDEX_TTL", 60))
+# * Labeling tool events that come within this time are handled once
+EVENT_DEBOUNCE_MS = float(os.environ.get("EVENT_DEBOUNCE_MS", 150))
+
+class Cache(BoxTagger):
 
     def __init__(self):
         # * Attributes that will be cached from events later
@@ -35,15 +84,22 @@ class Cache:
         self.project_metas: Dict[str, sly.ProjectMeta] = {}
         self.project_meta: sly.ProjectMeta = None
         self.project_settings = None
-        self.ann_needs_update: bool = False
 
         # * Attributes needed for processing
         self.image_ann: sly.Annotation = None
+        # * Label index of the selected image, updated from event payloads between full downloads:
+        # * figure id -> label (None if it is known only from an event), unprocessed rectangle ids
+        self.label_index: Dict[int, Optional[sly.Label]] = {}
+        self.unprocessed_bbox_ids: Set[int] = set()
+        self.label_index_image_id: int = None
+        self.label_index_time: float = 0.0
+        self.label_index_lock = threading.Lock()
         self.path_to_id: Dict[str, int] = {}
-        self.type_tag_meta = sly.TagMeta(
-            "bbox match type", sly.TagValueType.ONEOF_STRING, ["reference", "matched"]
-        )
-        self.id_tag_meta = sly.TagMeta("matched bbox ID", sly.TagValueType.ANY_NUMBER)
+        self.path_to_info: Dict[str, sly.ImageInfo] = {}
+        # * Dataset id -> index of multiview groups: tag value -> image infos, image id -> tag value
+        self.group_index: Dict[int, dict] = {}
+        self.group_index_lock = threading.Lock()
+        super().__init__()
 
     def __setattr__(self, name, value):
         self.__dict__[name] = value
@@ -59,8 +115,10 @@ class Cache:
             self.project_metas[project_id] = project_meta
             self.project_settings = project_meta.project_settings
             self.project_meta = project_meta
+            # * Grouping settings could have been changed, so groups are resolved again
+            self.invalidate_group_index()
 
-    def cache_image_ann(self, image_id: int) -> None:
+    def download_image_ann(self, image_id: int) -> sly.Annotation:
         try:
             ann = sly.Annotation.from_json(
                 api.annotation.download(image_id).annotation, self.project_meta
@@ -72,16 +130,56 @@ class Cache:
             ann = sly.Annotation.from_json(
                 api.annotation.download(image_id).annotation, self.project_meta
             )
+        return ann
+
+    def cache_image_ann(self, image_id: int) -> None:
+        ann = self.download_image_ann(image_id)
         if ann is None:
             sly.logger.error("Failed to download annotation.")
             return
-        self.image_ann = ann
+        with self.label_index_lock:
+            self.image_ann = ann
+            self.label_index = {label.sly_id: label for label in ann.labels}
+            self.unprocessed_bbox_ids = {
+                label.sly_id for label in self.select_reference_bbox_labels(ann, None)
+            }
+            self.label_index_image_id = image_id
+            self.label_index_time = time.monotonic()
+
+    def invalidate_label_index(self) -> None:
+        with self.label_index_lock:
+            self.label_index_image_id = None
+
+    def apply_figure_event(self, event) -> bool:
+        """
+        Updates the label index of the image from the event payload.
+        Returns False if the payload is not enough for it, or the index is of another image
+        or stale, so the annotation has to be downloaded again.
+        """
+        with self.label_index_lock:
+            if (
+                self.label_index_image_id != event.image_id
+                or time.monotonic() - self.label_index_time > LABEL_INDEX_TTL
+            ):
+                return False
+            if event.figure_id is None:
+                # * Selection is cleared
+                return not isinstance(event, sly.Event.FigureCreated)
+            if isinstance(event, sly.Event.FigureCreated):
+                # * New figures have no tags yet, so new rectangles are not processed
+                self.label_index[event.figure_id] = None
+                if event.tool == "rectangle":
+                    self.unprocessed_bbox_ids.add(event.figure_id)
+                return True
+            return event.figure_id in self.label_index
 
     @sly.timeit
     def cache_event(self, event: sly.Event.ManualSelected.FigureChanged) -> None:
         self.cache_project_meta(event.project_id)
-        if self.image_id != event.image_id or self.ann_needs_update:
-            self.cache_image_ann(event.image_id)
+        applied = self.apply_figure_event(event)
+        METRICS.count_cache("labels", applied)
+        if not applied:
+            self.invalidate_label_index()
 
         attrs_to_cache = ["project_id", "dataset_id", "image_id", "figure_id"]
         for k, v in event.__dict__.items():
@@ -100,70 +198,142 @@ class Cache:
         cache = {k: v for k, v in self.__dict__.items() if k in attrs_to_log}
         sly.logger.debug(f"CACHE", extra=cache)
 
-    def _get_group_imageinfos(self, tag_id, tag_value):
-        filters = [
-            {
-                AF.TYPE: "images_tag",
-                AF.DATA: {
-                    AF.TAG_ID: tag_id,
-                    AF.INCLUDE: True,
-                    AF.VALUE: tag_value,
-                },
-            }
-        ]
-        return api.image.get_filtered_list(self.dataset_id, filters)
+    def _get_group_tag_value(self, image_info: sly.ImageInfo, tag_id: int):
+        for tag in image_info.tags:
+            if tag[AF.TAG_ID] == tag_id:
+                return tag[AF.VALUE]
+        return None
 
-    @sly.timeit
-    def download_group_images(self) -> List[str]:
-        ref_img_info = api.image.get_info_by_id(self.image_id)
-        group_tag_value = None
-        for tag in ref_img_info.tags:
-            if tag[AF.TAG_ID] == self.project_settings.multiview_tag_id:
-                group_tag_value = tag[AF.VALUE]
-                break
+    def _build_group_index(self, dataset_id: int, tag_id: int) -> dict:
+        index = {
+            "tag_id": tag_id,
+            "refreshed_at": time.monotonic(),
+            "groups": {},
+            "image_to_value": {},
+            "image_ids": set(),
+            "updated_at": "",
+        }
+        for info in api.image.get_list(dataset_id):
+            self._update_group_index(index, info)
+        sly.logger.debug(
+            "Group index is built",
+            extra={
+                "dataset_id": dataset_id,
+                "groups": len(index["groups"]),
+                "images": len(index["image_to_value"]),
+            },
+        )
+        return index
 
-        # to make sure reference image info is always first
-        image_infos = [ref_img_info] + [
-            info
-            for info in self._get_group_imageinfos(
-                self.project_settings.multiview_tag_id, group_tag_value
-            )
-            if info.id != self.image_id
-        ]
+    def _refresh_group_index(self, dataset_id: int, index: dict) -> dict:
+        """
+        Adds images updated since the last listing to the index.
+        The index is built again if the dataset has other number of images, e.g. some were removed.
+        """
+        if index["updated_at"] == "":
+            return self._build_group_index(dataset_id, index["tag_id"])
+        filters = [{"field": AF.UPDATED_AT, "operator": ">=", "value": index["updated_at"]}]
+        updated = api.image.get_list(dataset_id, filters=filters)
+        for info in updated:
+            self._update_group_index(index, info)
+        if api.dataset.get_info_by_id(dataset_id).images_count != len(index["image_ids"]):
+            return self._build_group_index(dataset_id, index["tag_id"])
+        index["refreshed_at"] = time.monotonic()
+        sly.logger.debug(
+            "Group index is refreshed", extra={"dataset_id": dataset_id, "images": len(updated)}
+        )
+        return index
 
-        path_to_id = {f"{SLY_APP_DATA}/{info.name}": info.id for info in image_infos}
-        self.path_to_id = path_to_id
-
-        ids = list(path_to_id.values())
-        paths = list(path_to_id.keys())
-
-        api.image.download_paths(self.dataset_id, ids, paths)
-        return paths
-
-    def get_reference_bbox_labels(self) -> List[sly.Label]:
-        if self.figure_id is not None:
-            label = self.image_ann.get_label_by_id(self.figure_id)
-            if label is None:
-                sly.logger.warning(
-                    f"Figure (id: {self.figure_id}) not found in the image annotation"
-                )
-                return []
-            if label.tags.get(self.type_tag_meta.name) is not None:
-                return []
-            return [label]
-        return [
-            label
-            for label in self.image_ann.labels
-            if (isinstance(label.geometry, sly.Rectangle))
-            and label.tags.get(self.type_tag_meta.name) is None
-        ]
+    def _get_group_index(self, dataset_id: int) -> dict:
+        tag_id = self.project_settings.multiview_tag_id
+        with self.group_index_lock:
+            index = self.group_index.get(dataset_id)
+            if index is None or index["tag_id"] != tag_id:
+                index = self._build_group_index(dataset_id, tag_id)
+            elif time.monotonic() - index["refreshed_at"] > GROUP_INDEX_TTL:
+                index = self._refresh_group_index(dataset_id, index)
+            self.group_index[dataset_id] = index
+            return index
+
+    def _update_group_index(self, index: dict, image_info: sly.ImageInfo) -> None:
+        index["image_ids"].add(image_info.id)
+        index["updated_at"] = max(index["updated_at"], image_info.updated_at or "")
+        old_value = index["image_to_value"].pop(image_info.id, None)
+        if old_value is not None:
+            group = [info for info in index["groups"][old_value] if info.id != image_info.id]
+            index["groups"][old_value] = group
+        value = self._get_group_tag_value(image_info, index["tag_id"])
+        if value is not None:
+            index["groups"].setdefault(value, []).append(image_info)
+            index["image_to_value"][image_info.id] = value
+
+    def refresh_group_index_image(self, image_id: int, dataset_id: int) -> None:
+        """
+        Updates the image in the group index of the dataset, if the index was built.
+        """
+        with self.group_index_lock:
+            index = self.group_index.get(dataset_id)
+        if index is None:
+            return
+        image_info = api.image.get_info_by_id(image_id)
+        with self.group_index_lock:
+            self._update_group_index(index, image_info)
+
+    def invalidate_group_index(self, dataset_id: int = None) -> None:
+        with self.group_index_lock:
+            if dataset_id is None:
+                self.group_index.clear()
+            else:
+                self.group_index.pop(dataset_id, None)
+
+    def get_group_image_infos(
+        self, image_id: int = None, dataset_id: int = None
+    ) -> List[sly.ImageInfo]:
+        image_id = image_id or self.image_id
+        dataset_id = dataset_id or self.dataset_id
+        index = self._get_group_index(dataset_id)
+        with self.group_index_lock:
+            value = index["image_to_value"].get(image_id)
+        if value is None:
+            # * Image was added or grouped after the index was built
+            ref_img_info = api.image.get_info_by_id(image_id)
+            with self.group_index_lock:
+                self._update_group_index(index, ref_img_info)
+                value = index["image_to_value"].get(image_id)
+            if value is None:
+                return [ref_img_info]
+
+        with self.group_index_lock:
+            group = list(index["groups"][value])
+        # to make sure reference image info is always first
+        ref_img_info = next(info for info in group if info.id == image_id)
+        return [ref_img_info] + [info for info in group if info.id != image_id]
 
     @sly.timeit
-    def download_anns(self, ids: List[int]) -> List[sly.Annotation]:
-        return [
-            sly.Annotation.from_json(ann.annotation, self.project_meta)
-            for ann in api.annotation.download_batch(self.dataset_id, ids)
-        ]
+    def download_group_images(
+        self, image_infos: List[sly.ImageInfo] = None, skip_ids: Set[int] = None
+    ) -> List[str]:
+        """
+        Downloads group images to the image cache and returns their paths,
+        reference image path is always first. Images that are already cached are not downloaded.
+        Images with ids in `skip_ids` are not downloaded, but their paths are still returned.
+        """
+        if image_infos is None:
+            image_infos = self.get_group_image_infos()
+        skip_ids = skip_ids or set()
+
+        path_to_info = {IMAGE_CACHE.path(info): info for info in image_infos}
+        self.path_to_info = path_to_info
+        self.path_to_id = {path: info.id for path, info in path_to_info.items()}
+
+        # * Images are downloaded from their own datasets, not the one selected now
+        to_download = defaultdict(list)
+        for info in image_infos:
+            if info.id not in skip_ids:
+                to_download[info.dataset_id].append(info)
+        for dataset_id, infos in to_download.items():
+            IMAGE_CACHE.download(api, dataset_id, infos)
+        return list(path_to_info.keys())
 
     def grouping_is_on(self) -> bool:
         return (
@@ -172,15 +342,38 @@ class Cache:
         )
 
     def image_has_unprocessed_bboxes(self) -> bool:
-        if len(self.get_reference_bbox_labels()) == 0:
+        """
+        Checks the label index of the selected image (and figure), the annotation is downloaded
+        only if the index was invalidated by an event or is stale.
+        """
+        image_id, figure_id = self.image_id, self.figure_id
+        with self.label_index_lock:
+            synced = (
+                self.label_index_image_id == image_id
+                and time.monotonic() - self.label_index_time <= LABEL_INDEX_TTL
+            )
+        if not synced:
+            self.cache_image_ann(image_id)
+        with self.label_index_lock:
+            if figure_id is not None:
+                has_bboxes = figure_id in self.unprocessed_bbox_ids
+            else:
+                has_bboxes = len(self.unprocessed_bbox_ids) > 0
+        if not has_bboxes:
             sly.logger.debug(
                 "Selected image has no bbox labels, or all boxes on it are already processed"
             )
             return False
         return True
 
-    def add_tags_to_projmeta(self) -> None:
-        project_meta = self.project_meta
+    def add_tags_to_projmeta(self, project_id: int) -> None:
+        """
+        Adds type and ID tag metas to the meta of the project, if they are missing.
+        """
+        project_meta = self.project_metas.get(project_id)
+        if project_meta is None:
+            project_meta = sly.ProjectMeta.from_json(api.project.get_meta(project_id, True))
+            self.project_metas[project_id] = project_meta
         tag_metas = [self.type_tag_meta, self.id_tag_meta]
         meta_needs_update = False
         for tag_meta in tag_metas:
@@ -189,18 +382,94 @@ class Cache:
                 meta_needs_update = True
 
         if meta_needs_update:
-            self.project_meta = api.project.update_meta(self.project_id, project_meta)
-
-    def add_type_tag_to_labels(
-        self, labels: List[sly.Label], value: Literal["reference", "matched"]
-    ) -> List[sly.Label]:
-        type_tag = sly.Tag(self.type_tag_meta, value)
-        res_labels = []
-        for label in labels:
-            if label.tags.get(self.type_tag_meta.name) is None:
-                label = label.add_tag(type_tag)
-            res_labels.append(label)
-        return res_labels
+            project_meta = api.project.update_meta(project_id, project_meta)
+            self.project_metas[project_id] = project_meta
+            if project_id == self.project_id:
+                self.project_meta = project_meta
+
+    def get_tag_meta_ids(self, project_id: int, names: Set[str]) -> Dict[str, int]:
+        """
+        Returns server ids of tag metas by names, refetching project meta if they are unknown.
+        Raises ValueError if a tag meta is not in the project.
+        """
+        meta = self.project_metas.get(project_id)
+        tag_metas = [None] if meta is None else [meta.get_tag_meta(name) for name in names]
+        if any(tag_meta is None or tag_meta.sly_id is None for tag_meta in tag_metas):
+            meta = sly.ProjectMeta.from_json(api.project.get_meta(project_id, True))
+            self.project_metas[project_id] = meta
+            if project_id == self.project_id:
+                self.project_meta = meta
+        tag_ids = {}
+        for name in names:
+            tag_meta = meta.get_tag_meta(name)
+            if tag_meta is None or tag_meta.sly_id is None:
+                raise ValueError(f"Tag meta '{name}' is not found in project (id: {project_id})")
+            tag_ids[name] = tag_meta.sly_id
+        return tag_ids
+
+    def upload_matched_labels(
+        self,
+        project_id: int,
+        dataset_id: int,
+        ref_labels: List[sly.Label],
+        ref_added_tags: List[List[sly.Tag]],
+        group_ids: List[int],
+        res_bbox_labels: List[List[sly.Label]],
+    ) -> List[int]:
+        """
+        Uploads only the changes made by matching: matched boxes are created as new figures
+        in bulk requests, and then their tags and new tags of reference boxes are added,
+        all in concurrent chunks. If any of them fails, created figures are removed.
+        Other figures of group images are not touched.
+        `ref_labels` are the labels of downloaded reference annotation, as they keep figure ids.
+        Matched boxes keep all tags of their reference boxes, so ids of all their tag metas
+        are resolved before figures are created.
+        Returns ids of created figures.
+        """
+        names = {self.type_tag_meta.name, self.id_tag_meta.name}
+        for labels in res_bbox_labels:
+            names.update(tag.meta.name for label in labels for tag in label.tags)
+        tag_ids = self.get_tag_meta_ids(project_id, names)
+        meta = self.project_metas[project_id]
+
+        figures_json, figure_labels = [], []
+        for image_id, labels in zip(group_ids, res_bbox_labels):
+            for label in labels:
+                figure_json = label.to_json()
+                # * Matched labels are clones of reference ones, they have their figure id
+                figure_json.pop(LabelJsonFields.ID, None)
+                figure_json.pop(LabelJsonFields.TAGS, None)
+                figure_json[AF.ENTITY_ID] = image_id
+                if AF.CLASS_ID not in figure_json:
+                    figure_json[AF.CLASS_ID] = meta.get_obj_class(label.obj_class.name).sly_id
+                figure_json[AF.GEOMETRY] = label.geometry.to_json()
+                figures_json.append(figure_json)
+                figure_labels.append(label)
+        figure_ids = ANN_IO.create_figures(api, figures_json, dataset_id)
+
+        def _tags_json(tags, figure_id):
+            tags_json = []
+            for tag in tags:
+                tag_json = {AF.TAG_ID: tag_ids[tag.meta.name], AF.FIGURE_ID: figure_id}
+                if tag.value is not None:
+                    tag_json[AF.VALUE] = tag.value
+                tags_json.append(tag_json)
+            return tags_json
+
+        matched_tags_json, ref_tags_json = [], []
+        for figure_id, label in zip(figure_ids, figure_labels):
+            matched_tags_json.extend(_tags_json(label.tags, figure_id))
+        for label, added_tags in zip(ref_labels, ref_added_tags):
+            ref_tags_json.extend(_tags_json(added_tags, label.sly_id))
+        # * Tag requests are not retried, so created figures are removed if they fail,
+        # * reference boxes are tagged last, so they stay unprocessed in that case
+        try:
+            ANN_IO.add_tags(api, project_id, matched_tags_json)
+            ANN_IO.add_tags(api, project_id, ref_tags_json)
+        except Exception:
+            ANN_IO.remove_figures(api, figure_ids)
+            raise
+        return figure_ids
 
 
 CACHE = Cache()
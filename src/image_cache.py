@@ -0,0 +1,133 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+import supervisely as sly
+from src.metrics import METRICS
+
+
+class ImageCache:
+    """
+    Content-addressed LRU cache of original group images on local disk.
+
+    Files are named by image id and hash, so images with the same name from different datasets
+    don't collide, and images changed on the server are downloaded again.
+    The least recently used files are removed when the total size exceeds `max_bytes`.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._sizes: Dict[str, int] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        # * Files left by the previous run are kept, the oldest ones are evicted first
+        entries = [entry for entry in os.scandir(cache_dir) if entry.is_file()]
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            if entry.name.endswith(".tmp"):
+                sly.fs.silent_remove(entry.path)
+                continue
+            self._sizes[entry.path] = entry.stat().st_size
+            self._bytes += entry.stat().st_size
+        with self._lock:
+            self._evict()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sizes)
+
+    def path(self, image_info: sly.ImageInfo) -> str:
+        """
+        Returns path of the image in the cache, whether it is cached or not
+        """
+        digest = hashlib.sha1(f"{image_info.id}:{image_info.hash}".encode()).hexdigest()[:16]
+        ext = sly.fs.get_file_ext(image_info.name or "") or ".img"
+        return os.path.join(self.cache_dir, f"{image_info.id}_{digest}{ext}")
+
+    def get(self, image_info: sly.ImageInfo) -> Optional[str]:
+        """
+        Returns path of the cached image and marks it as recently used, None if it is not cached
+        """
+        path = self.path(image_info)
+        with self._lock:
+            cached = path in self._sizes
+            if cached:
+                self._sizes.move_to_end(path)
+        METRICS.count_cache("images", cached)
+        return path if cached else None
+
+    def add(self, image_info: sly.ImageInfo) -> None:
+        """
+        Registers the image file written to its cache path and evicts old files if needed
+        """
+        path = self.path(image_info)
+        size = os.path.getsize(path)
+        with self._lock:
+            self._bytes -= self._sizes.pop(path, 0)
+            self._sizes[path] = size
+            self._bytes += size
+            self._evict()
+
+    def read_bytes(self, image_info: sly.ImageInfo) -> Optional[bytes]:
+        path = self.get(image_info)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            # * File was evicted by another thread
+            return None
+
+    def put_bytes(self, image_info: sly.ImageInfo, data: bytes) -> None:
+        if self.max_bytes <= 0:
+            return
+        path = self.path(image_info)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.add(image_info)
+
+    def download(
+        self, api: sly.Api, dataset_id: int, image_infos: List[sly.ImageInfo]
+    ) -> List[str]:
+        """
+        Downloads images that are not cached yet, returns cache paths of all images
+        """
+        missing = [info for info in image_infos if self.get(info) is None]
+        if len(missing) > 0:
+            with METRICS.span("download"):
+                api.image.download_paths(
+                    dataset_id, [info.id for info in missing], [self.path(info) for info in missing]
+                )
+            with self._lock:
+                for info in missing:
+                    path = self.path(info)
+                    self._bytes -= self._sizes.pop(path, 0)
+                    self._sizes[path] = os.path.getsize(path)
+                    self._bytes += self._sizes[path]
+                # * Images of the group are not evicted before they are used
+                self._evict(keep={self.path(info) for info in image_infos})
+        return [self.path(info) for info in image_infos]
+
+    def clear(self) -> None:
+        with self._lock:
+            for path in self._sizes:
+                sly.fs.silent_remove(path)
+            self._sizes.clear()
+            self._bytes = 0
+
+    def _evict(self, keep: Optional[Set[str]] = None) -> None:
+        # * The last added file is kept even if it is larger than the budget
+        keep = keep or set()
+        for path in list(self._sizes):
+            if self._bytes <= self.max_bytes or len(self._sizes) <= 1:
+                break
+            if path in keep:
+                continue
+            self._bytes -= self._sizes.pop(path)
+            sly.fs.silent_remove(path)
@@ -0,0 +1,68 @@
+import cv2
+import numpy as np
+import supervisely as sly
+from typing import Optional
+from src.image_cache import ImageCache
+from src.metrics import METRICS
+
+# * OpenCV flags for JPEG decoding with DCT scaling, other formats are resized after decoding
+REDUCED_READ_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def get_reduction(width: Optional[int], height: Optional[int], resize: Optional[int]) -> int:
+    """
+    Returns the largest decoding reduction factor that keeps the long image side
+    not smaller than `resize`.
+    """
+    if resize is None or not width or not height:
+        return 1
+    long_side = max(width, height)
+    for reduction in (8, 4, 2):
+        if long_side / reduction >= resize:
+            return reduction
+    return 1
+
+
+def decode_image(data: bytes, reduction: int = 1) -> np.ndarray:
+    """
+    Decodes image bytes in memory to RGB numpy array.
+    """
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), REDUCED_READ_FLAGS[reduction])
+    if image is None:
+        raise ValueError("Failed to decode image bytes")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def read_image(path: str, reduction: int = 1) -> np.ndarray:
+    """
+    Reads image from disk to RGB numpy array.
+    """
+    image = cv2.imread(path, REDUCED_READ_FLAGS[reduction])
+    if image is None:
+        raise ValueError(f"Failed to read image: {path}")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def download_image(
+    api: sly.Api,
+    image_info: sly.ImageInfo,
+    reduction: int = 1,
+    cache: Optional[ImageCache] = None,
+) -> np.ndarray:
+    """
+    Downloads image as bytes and decodes it in memory.
+    Bytes are taken from the image `cache` if the image was downloaded before, and saved to it.
+    """
+    data = None if cache is None else cache.read_bytes(image_info)
+    if data is None:
+        with METRICS.span("download"):
+            data = api.image.download_bytes(image_info.dataset_id, [image_info.id])[0]
+        if cache is not None:
+            cache.put_bytes(image_info, data)
+    with METRICS.span("decode"):
+        return decode_image(data, reduction)
@@ -0,0 +1,161 @@
+import threading
+from collections import deque
+from typing import Callable, Deque, Optional, Tuple
+
+import supervisely as sly
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class MatchJob:
+    """
+    Match request for the image (and figure) that was selected when the button was pressed.
+    `params` are LightGlue parameters read from the UI at the same moment.
+    """
+
+    def __init__(
+        self,
+        image_id: int,
+        dataset_id: int,
+        figure_id: Optional[int],
+        params: dict,
+        project_id: Optional[int] = None,
+    ):
+        self.project_id = project_id
+        self.image_id = image_id
+        self.dataset_id = dataset_id
+        self.figure_id = figure_id
+        self.params = params
+        # * Settings chosen for the latency budget, if it is set and the whole images are matched
+        self.tuning = None
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+
+    @property
+    def key(self):
+        return (self.image_id, self.figure_id)
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def check_cancelled(self) -> None:
+        """
+        Raises JobCancelled if the job was cancelled, called between processing stages.
+        """
+        if self.cancelled.is_set():
+            raise JobCancelled(f"Matching for image (id: {self.image_id}) is cancelled")
+
+
+class JobQueue:
+    """
+    Runs match jobs one by one on a background worker thread.
+
+    A job with the same image and figure as a pending or running one is coalesced with it.
+    A job for another image cancels pending and running jobs of other images.
+    """
+
+    def __init__(self, handler: Callable[[MatchJob], None]):
+        self.handler = handler
+        self._pending: Deque[MatchJob] = deque()
+        self._running: Optional[MatchJob] = None
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def _ensure_started(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="match-jobs", daemon=True)
+            self._thread.start()
+
+    def submit(self, job: MatchJob) -> MatchJob:
+        """
+        Adds the job to the queue and returns it, or returns an equal job that is already queued.
+        """
+        with self._cond:
+            running = self._running
+            if running is not None and running.key == job.key and not running.cancelled.is_set():
+                sly.logger.debug("Same match request is already running", extra={"key": job.key})
+                return running
+            for pending in self._pending:
+                if pending.key == job.key:
+                    sly.logger.debug("Same match request is already queued", extra={"key": job.key})
+                    return pending
+
+            # * Requests for other images are stale now
+            for pending in list(self._pending):
+                if pending.image_id != job.image_id:
+                    pending.cancel()
+                    self._pending.remove(pending)
+                    pending.finished.set()
+            if running is not None and running.image_id != job.image_id:
+                sly.logger.info(f"Cancelling matching for image (id: {running.image_id})")
+                running.cancel()
+
+            self._pending.append(job)
+            self._cond.notify()
+        self._ensure_started()
+        return job
+
+    def is_busy(self) -> bool:
+        with self._cond:
+            return self._running is not None or len(self._pending) > 0
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while len(self._pending) == 0:
+                    self._cond.wait()
+                job = self._pending.popleft()
+                self._running = job
+            try:
+                job.check_cancelled()
+                self.handler(job)
+            except JobCancelled as e:
+                sly.logger.info(str(e))
+            except Exception as e:
+                sly.logger.error(f"Match job failed: {e}", exc_info=True)
+            finally:
+                with self._cond:
+                    self._running = None
+                job.finished.set()
+
+
+class Debouncer:
+    """
+    Runs the last submitted call once no other call was submitted for `delay` seconds,
+    so a burst of events is handled once. Calls run one at a time on a timer thread,
+    with zero delay they run right away in the calling thread.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._call: Optional[Tuple[Callable, tuple]] = None
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+
+    def submit(self, fn: Callable, *args) -> None:
+        if self.delay <= 0:
+            with self._run_lock:
+                fn(*args)
+            return
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._call = (fn, args)
+            self._timer = threading.Timer(self.delay, self._run)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _run(self) -> None:
+        with self._run_lock:
+            with self._lock:
+                call, self._call = self._call, None
+            if call is None:
+                return
+            fn, args = call
+            try:
+                fn(*args)
+            except Exception as e:
+                sly.logger.error(f"Debounced call failed: {e}", exc_info=True)
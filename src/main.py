@@ -1,36 +1,99 @@
+import gc
+import sys
+from typing import List, Optional, Tuple
+from src.startup import STARTUP
 import supervisely as sly
 import src.ui.layout as layout
 import src.globals as g
 from src.globals import CACHE
-import src.process_funcs as process
+from src.jobs import Debouncer, JobCancelled, JobQueue, MatchJob
+from src.metrics import METRICS, rss_mb
+from src.autotune import AUTOTUNER
+from fastapi.responses import PlainTextResponse
+
+# * Modules that import torch, cv2 and LightGlue (process_funcs, model_pool, prefetch, sharding)
+# * are imported in functions, they are loaded on the startup thread before the app is ready
 
 app = sly.Application(layout=layout.layout_card, show_header=False)
+server = app.get_server()
 
 
-@app.event(sly.Event.FigureCreated)
-def figure_created_cb(api: sly.Api, event: sly.Event.FigureCreated):
-    if event.tool == "rectangle":
-        CACHE.ann_needs_update = True
+def shutdown_workers():
+    # * Shard workers can be started only if the module was imported
+    sharding = sys.modules.get("src.sharding")
+    if sharding is not None:
+        sharding.SHARD_POOL.shutdown()
 
-    CACHE.cache_event(event)
 
-    if CACHE.image_has_unprocessed_bboxes() and CACHE.grouping_is_on():
-        layout.match_bbox_button.enable()
+app.call_before_shutdown(shutdown_workers)
+
+
+@server.get("/metrics")
+def metrics():
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+
+def get_lightglue_params():
+    """
+    Returns (device, max_keypoints, resize, filter_threshold) from UI widget values
+    """
+    resize_value = None
+    if layout.resize_check.is_checked():
+        resize_value = layout.resize_inputnum.get_value()
+
+    max_keypoints = layout.max_keypoints_inputnum.get_value()
+    if max_keypoints == 0:
+        max_keypoints = None
+    filter_threshold = layout.filter_threshold.get_value()
+
+    device = layout.device_selector.get_device()
+    if device is None:
+        sly.logger.error("No processing device found, trying to run on CPU...")
+        device = "cpu"
+    return device, max_keypoints, resize_value, filter_threshold
+
+
+def prepare_models():
+    """
+    Imports processing modules, lists devices and loads models with default settings,
+    so the first click doesn't wait for them. Runs on the startup thread.
+    """
+    import src.process_funcs  # noqa: F401
+    from src.model_pool import MODEL_POOL
+    from src.sharding import SHARD_POOL
+
+    layout.device_selector.refresh()
+    device, max_keypoints, _, filter_threshold = get_lightglue_params()
+    if device == "cpu" and g.SHARD_WORKERS > 1:
+        SHARD_POOL.warmup(g.SHARD_WORKERS, g.MODEL_DIR, g.INTRA_OP_THREADS)
+    MODEL_POOL.warmup(device, max_keypoints, filter_threshold).join()
+
+
+def startup_finished():
+    if STARTUP.error is None:
+        layout.startup_status.set("Models are loaded", "success")
     else:
-        if not CACHE.grouping_is_on():
-            layout.grouping_warning.show()
-        else:
-            layout.grouping_warning.hide()
-        layout.match_bbox_button.disable()
+        layout.startup_status.set(
+            "Models will be loaded on the first click, see logs for details", "warning"
+        )
+    BUTTON_DEBOUNCER.submit(update_match_button)
 
 
-@app.event(sly.Event.ManualSelected.FigureChanged)
-def figure_changed_cb(api: sly.Api, event: sly.Event.ManualSelected.FigureChanged):
-    CACHE.cache_event(event)
+# * Bursts of labeling tool events update the button once, after the last event of the burst
+BUTTON_DEBOUNCER = Debouncer(g.EVENT_DEBOUNCE_MS / 1000)
+# * Group index is refreshed for the last selected image of a burst, off the event handler
+GROUP_INDEX_DEBOUNCER = Debouncer(g.EVENT_DEBOUNCE_MS / 1000)
+
+
+def update_match_button(rectangle_tool: bool = True) -> None:
+    if CACHE.project_id is None:
+        # * Nothing is selected in the labeling tool yet
+        return
     if (
-        CACHE.image_has_unprocessed_bboxes()
+        STARTUP.is_ready()
+        and rectangle_tool
         and CACHE.grouping_is_on()
-        and event.tool == "rectangle"
+        and CACHE.image_has_unprocessed_bboxes()
     ):
         layout.match_bbox_button.enable()
     else:
@@ -41,37 +104,103 @@ def figure_changed_cb(api: sly.Api, event: sly.Event.ManualSelected.FigureChange
         layout.match_bbox_button.disable()
 
 
+@app.event(sly.Event.FigureCreated)
+def figure_created_cb(api: sly.Api, event: sly.Event.FigureCreated):
+    # * New figure is added to the label index from the event, without downloading the annotation
+    CACHE.cache_event(event)
+    BUTTON_DEBOUNCER.submit(update_match_button)
+
+
+@app.event(sly.Event.ManualSelected.FigureChanged)
+def figure_changed_cb(api: sly.Api, event: sly.Event.ManualSelected.FigureChanged):
+    CACHE.cache_event(event)
+    BUTTON_DEBOUNCER.submit(update_match_button, event.tool == "rectangle")
+
+
 @app.event(sly.Event.ManualSelected.ImageChanged)
 def image_changed_cb(api: sly.Api, event: sly.Event.ManualSelected.ImageChanged):
     CACHE.cache_event(event)
+    if CACHE.grouping_is_on():
+        # * Keep group index up to date for the selected image
+        GROUP_INDEX_DEBOUNCER.submit(
+            CACHE.refresh_group_index_image, event.image_id, event.dataset_id
+        )
 
-    if CACHE.image_has_unprocessed_bboxes() and CACHE.grouping_is_on():
-        layout.match_bbox_button.enable()
+    # * Prefetching starts with the next selected image if models are not loaded yet
+    if STARTUP.is_ready():
+        update_prefetch(event)
+
+    BUTTON_DEBOUNCER.submit(update_match_button)
+
+
+def update_prefetch(event: sly.Event.ManualSelected.ImageChanged) -> None:
+    from src.prefetch import PREFETCHER
+
+    if layout.prefetch_check.is_checked() and CACHE.grouping_is_on():
+        device, max_keypoints, resize_value, filter_threshold = get_lightglue_params()
+        params = {
+            "max_num_keypoints": max_keypoints,
+            "resize": resize_value,
+            "filter_threshold": filter_threshold,
+            "device": device,
+        }
+        PREFETCHER.submit(
+            event.image_id, event.dataset_id, params, layout.prefetch_matches_check.is_checked()
+        )
     else:
-        if not CACHE.grouping_is_on():
-            layout.grouping_warning.show()
-        else:
-            layout.grouping_warning.hide()
-        layout.match_bbox_button.disable()
+        PREFETCHER.cancel()
 
 
 @layout.match_bbox_button.click
-@sly.timeit
 def match_click_cb():
-    # * Get UI widget values
-    resize_value = None
-    if layout.resize_check.is_checked():
-        resize_value = layout.resize_inputnum.get_value()
+    # * Get UI widget values at the moment of the click, processing runs in background
+    device, max_keypoints, resize_value, filter_threshold = get_lightglue_params()
+    params = {
+        "device": device,
+        "max_keypoints": max_keypoints,
+        "resize": resize_value,
+        "filter_threshold": filter_threshold,
+        "batch_size": layout.batch_size_inputnum.get_value(),
+        "latency_budget": None,
+        "roi_margin": None,
+        "roi_narrow": layout.roi_narrow_check.is_checked(),
+    }
+    if layout.latency_budget_check.is_checked():
+        params["latency_budget"] = layout.latency_budget_inputnum.get_value()
+    if layout.roi_check.is_checked():
+        params["roi_margin"] = layout.roi_margin_inputnum.get_value()
+    job = MatchJob(CACHE.image_id, CACHE.dataset_id, CACHE.figure_id, params, CACHE.project_id)
+    MATCH_QUEUE.submit(job)
 
-    max_keypoints = layout.max_keypoints_inputnum.get_value()
-    if max_keypoints == 0:
-        max_keypoints = None
-    filter_threshold = layout.filter_threshold.get_value()
 
-    device = layout.device_selector.get_device()
-    if device is None:
-        sly.logger.error("No processing device found, trying to run on CPU...")
-        device = "cpu"
+def run_match_job(job: MatchJob):
+    STARTUP.wait()
+    from src.prefetch import PREFETCHER
+
+    # * Background prefetching waits until the job is processed
+    with PREFETCHER.paused(), METRICS.trace(
+        job.params["device"], image_id=job.image_id, figure_id=job.figure_id
+    ) as trace:
+        try:
+            match_bboxes(job)
+        finally:
+            # * Reference boxes are tagged and new boxes are created, so the index is stale
+            CACHE.invalidate_label_index()
+        if job.tuning is not None:
+            # * Measured timings correct the latency model for the next click
+            AUTOTUNER.update(job.params["device"], job.tuning, trace.summary())
+
+
+@sly.timeit
+def match_bboxes(job: MatchJob):
+    import src.process_funcs as process
+
+    device = job.params["device"]
+    max_keypoints = job.params["max_keypoints"]
+    resize_value = job.params["resize"]
+    filter_threshold = job.params["filter_threshold"]
+    batch_size = job.params["batch_size"]
+    matcher_conf = {}
 
     sly.logger.debug(
         "Matching with LightGlue params",
@@ -80,21 +209,21 @@ def match_click_cb():
             "resize": resize_value,
             "max keypoints": max_keypoints,
             "filter threshold": filter_threshold,
+            "batch size": batch_size,
         },
     )
 
-    image_id = CACHE.image_id
-    id_tag_meta = CACHE.id_tag_meta
+    image_id = job.image_id
 
     # * Add tag metas to project meta to later add tags to matched boxes
-    CACHE.add_tags_to_projmeta()
+    with METRICS.span("meta_fetch"):
+        CACHE.add_tags_to_projmeta(job.project_id or CACHE.project_id)
 
     # * Get latest reference image annotation, as it could have been updated since it was last retrieved
-    CACHE.cache_image_ann(image_id)
-    image_ann = CACHE.image_ann
+    with METRICS.span("ann_fetch"):
+        image_ann = CACHE.download_image_ann(image_id)
 
-    ref_ann_labels = image_ann.labels
-    ref_boxes_labels = CACHE.get_reference_bbox_labels()
+    ref_boxes_labels = CACHE.select_reference_bbox_labels(image_ann, job.figure_id)
     # to handle the case when there were boxes, but got deleted before processing
     if len(ref_boxes_labels) == 0:
         sly.logger.error(
@@ -103,71 +232,240 @@ def match_click_cb():
         return
 
     try:
-        # * Download images from grouping
-        image_paths = CACHE.download_group_images()
-        sly.logger.info(
-            f"Appying lightglue for {len(image_paths)} images on '{device.upper()}' device",
-            extra={"reference bboxes count": len(ref_boxes_labels)},
+        # * Get group image infos, reference image info is always first
+        with METRICS.span("group_resolve"):
+            image_infos = CACHE.get_group_image_infos(image_id, job.dataset_id)
+    except Exception as e:
+        sly.logger.error(f"An error occured while processing bboxes: {e}")
+        return
+    process_image_cnt = len(image_infos)
+
+    # * Only the selected box is matched, so only the region around it can be processed
+    roi = None
+    if job.params.get("roi_margin") is not None and job.figure_id is not None:
+        roi = process.get_roi(
+            ref_boxes_labels[0].geometry,
+            job.params["roi_margin"],
+            image_infos[0].width,
+            image_infos[0].height,
         )
+    if job.params.get("latency_budget") is not None:
+        tuning = AUTOTUNER.choose(device, job.params["latency_budget"], image_infos)
+        resize_value, max_keypoints = tuning.resize, tuning.max_keypoints
+        matcher_conf = tuning.matcher_conf
+        # * Timings of regions don't fit the latency model of whole images
+        job.tuning = None if roi is not None else tuning
+    sly.logger.info(
+        f"Appying lightglue for {process_image_cnt} images on '{device.upper()}' device",
+        extra={"reference bboxes count": len(ref_boxes_labels)},
+    )
 
-        # * Apply lightglue to group images
-        process_image_cnt = len(image_paths)
-        points_list = [
-            pts
-            for pts in process.apply_lightglue(
-                image_paths, max_keypoints, resize_value, filter_threshold, device
-            )
-        ]
+    # * In memory-bounded mode, group images are matched and uploaded in windows
+    target_infos = image_infos[1:]
+    window_size = g.MATCH_WINDOW if g.MATCH_WINDOW > 0 else max(len(target_infos), 1)
+    windows_cnt, failed_imgs_cnt, peak_rss = 0, 0, 0.0
+    ref_added_tags, id_tags = None, None
+    with layout.match_progress(
+        message="Matching group images", total=process_image_cnt - 1
+    ) as pbar:
+        start = 0
+        while True:
+            window_infos = target_infos[start : start + window_size]
+            start += len(window_infos)
+            windows_cnt += 1
+            try:
+                group_ids, points_list = match_window(
+                    job,
+                    image_infos[:1] + window_infos,
+                    pbar,
+                    device,
+                    max_keypoints,
+                    resize_value,
+                    filter_threshold,
+                    batch_size,
+                    matcher_conf,
+                    roi,
+                )
+            except JobCancelled:
+                raise
+            except Exception as e:
+                sly.logger.error(f"An error occured while processing bboxes: {e}")
+                return
+            failed_imgs_cnt += len(window_infos) - len(points_list)
+
+            # * Transpose reference boxes to group images using matching keypoints
+            with METRICS.span("transpose"):
+                new_bbox_labels = process.transpose_bboxes(ref_boxes_labels, points_list)
+            METRICS.count_boxes(sum(len(labels) for labels in new_bbox_labels))
+            del points_list
+
+            # * Add type and ID tags, annotations of group images are not needed for it.
+            # * Reference boxes are tagged with the first window, next windows reuse their ID tags
+            if ref_added_tags is None:
+                _, ref_added_tags, res_bbox_labels = CACHE.tag_matched_labels(
+                    image_ann.labels, ref_boxes_labels, new_bbox_labels
+                )
+                id_tags = [tags[-1] for tags in ref_added_tags]
+                window_ref_tags = ref_added_tags
+            else:
+                res_bbox_labels = CACHE.tag_group_labels(new_bbox_labels, id_tags)
+                window_ref_tags = [[] for _ in image_ann.labels]
 
-        # * Check if any images failed matching, and print a log if so
-        failed_imgs_cnt = (process_image_cnt - 1) - len(points_list)
-        if failed_imgs_cnt > 0:
-            sly.logger.warning(
-                f"Matching failed for {failed_imgs_cnt} image(s). They will be skipped."
+            # * Upload only new figures and tags
+            job.check_cancelled()
+            sly.logger.info(
+                f"Uploading {sum(len(labels) for labels in res_bbox_labels)} matched boxes "
+                f"to {len(group_ids)} images..."
             )
-    except Exception as e:
-        sly.logger.error(f"An error occured while processing bboxes: {e}")
-        sly.fs.clean_dir(g.SLY_APP_DATA)
-        return
-    finally:
-        sly.logger.debug(f"Cleaning {g.SLY_APP_DATA} directory from paths")
-        sly.fs.clean_dir(g.SLY_APP_DATA)
-
-    # * Transpose reference boxes to group images using matching keypoints
-    new_bbox_labels = [
-        process.transpose_bbox_with_keypoints(ref_boxes_labels, ref_pts, img_pts)
-        for ref_pts, img_pts in points_list
-    ]
-
-    # * Download original annotations and add new labels to them
-    group_ids = [CACHE.path_to_id[path] for path in image_paths]
-    orig_anns = CACHE.download_anns(group_ids)
-    res_bbox_labels = [
-        CACHE.add_type_tag_to_labels((box_list), "matched") for box_list in new_bbox_labels
-    ]
-
-    # * Add type tag to reference boxes
-    new_ref_ann_labels = []
-    for label in ref_ann_labels:
-        if label in ref_boxes_labels:
-            label = CACHE.add_type_tag_to_labels([label], "reference")[0]
-        new_ref_ann_labels.append(label)
-
-    # * Add ID tag to boxes
-    for idx, ref_box in enumerate(new_ref_ann_labels):
-        tag = sly.Tag(id_tag_meta, g.box_id)
-        new_ref_ann_labels[idx] = ref_box.add_tag(tag)
-        for image_boxes in res_bbox_labels:
-            if idx < len(image_boxes):
-                image_boxes[idx] = image_boxes[idx].add_tag(tag)
-        g.box_id += 1
-
-    # * Merge new and original annotations
-    anns = [ann.add_labels(box_labels) for ann, box_labels in zip(orig_anns, res_bbox_labels)]
-    new_ref_ann = image_ann.clone(labels=new_ref_ann_labels)
-
-    # * Upload annotations
-    ids_to_upload = [image_id] + group_ids
-    anns_to_upload = [new_ref_ann] + anns
-    sly.logger.info(f"Uploading {len(anns_to_upload)} annotations...")
-    g.api.annotation.upload_anns(ids_to_upload, anns_to_upload)
+            with METRICS.span("upload"):
+                CACHE.upload_matched_labels(
+                    job.project_id or CACHE.project_id,
+                    job.dataset_id,
+                    image_ann.labels,
+                    window_ref_tags,
+                    group_ids,
+                    res_bbox_labels,
+                )
+            del new_bbox_labels, res_bbox_labels
+
+            if g.MATCH_WINDOW > 0:
+                peak_rss = max(peak_rss, rss_mb())
+                window_size = check_memory_ceiling(window_size, windows_cnt)
+            if start >= len(target_infos):
+                break
+
+    # * Check if any images failed matching, and print a log if so
+    METRICS.count_failed_pairs(failed_imgs_cnt)
+    if failed_imgs_cnt > 0:
+        sly.logger.warning(f"Matching failed for {failed_imgs_cnt} image(s). They will be skipped.")
+    if g.MATCH_WINDOW > 0:
+        sly.logger.info(
+            "Memory-bounded matching is finished",
+            extra={
+                "windows": windows_cnt,
+                "peak window rss mb": round(peak_rss, 1),
+                "ceiling mb": g.MEMORY_CEILING_MB or None,
+            },
+        )
+
+
+def check_memory_ceiling(window_size: int, window_idx: int) -> int:
+    """
+    Logs memory after the window is processed and returns the size of the next window,
+    which is halved if resident memory exceeds MEMORY_CEILING_MB.
+    """
+    rss = rss_mb()
+    if g.MEMORY_CEILING_MB > 0 and rss > g.MEMORY_CEILING_MB:
+        # * Objects of the window may be kept by reference cycles
+        gc.collect()
+        rss = rss_mb()
+    sly.logger.debug(
+        "Window is processed",
+        extra={"window": window_idx, "window size": window_size, "rss mb": round(rss, 1)},
+    )
+    if g.MEMORY_CEILING_MB > 0 and rss > g.MEMORY_CEILING_MB and window_size > 1:
+        window_size = max(window_size // 2, 1)
+        sly.logger.warning(
+            "Memory ceiling is exceeded, the window is reduced",
+            extra={
+                "rss mb": round(rss, 1),
+                "ceiling mb": g.MEMORY_CEILING_MB,
+                "window size": window_size,
+            },
+        )
+    return window_size
+
+
+def match_window(
+    job: MatchJob,
+    image_infos: List[sly.ImageInfo],
+    pbar,
+    device: str,
+    max_keypoints: Optional[int],
+    resize_value: Optional[int],
+    filter_threshold: float,
+    batch_size: int,
+    matcher_conf: dict,
+    roi: Optional[Tuple[int, int, int, int]] = None,
+) -> Tuple[List[int], List[Tuple]]:
+    """
+    Matches group images with the reference image (first image info).
+    Returns ids of matched images and their (ref_matched_pts, img_matched_pts).
+    """
+    import src.process_funcs as process
+
+    if roi is not None:
+        matched = process.roi_lightglue(
+            image_infos,
+            roi,
+            job.params["roi_margin"],
+            job.params.get("roi_narrow", True),
+            max_keypoints,
+            resize_value,
+            filter_threshold,
+            device,
+            g.DOWNLOAD_WORKERS,
+            matcher_conf,
+        )
+    elif batch_size > 1:
+        # * Download images from grouping, skipping the ones with cached features or matches
+        cached_ids = process.get_cached_feature_ids(image_infos, resize_value, max_keypoints)
+        cached_ids |= process.get_cached_match_ids(
+            image_infos,
+            resize_value,
+            max_keypoints,
+            filter_threshold,
+            process.get_batch_matcher_conf(matcher_conf),
+        )
+        image_paths = CACHE.download_group_images(image_infos, skip_ids=cached_ids)
+
+        # * Apply lightglue to group images in batches
+        points_list = []
+        for pts in process.apply_lightglue(
+            image_paths,
+            max_keypoints,
+            resize_value,
+            filter_threshold,
+            device,
+            CACHE.path_to_info,
+            batch_size,
+            matcher_conf,
+        ):
+            job.check_cancelled()
+            points_list.append(pts)
+            pbar.update(1)
+        return [CACHE.path_to_id[path] for path in image_paths], points_list
+    elif device == "cpu" and g.SHARD_WORKERS > 1:
+        # * Target images are extracted and matched by worker processes
+        matched = process.shard_lightglue(
+            image_infos,
+            max_keypoints,
+            resize_value,
+            filter_threshold,
+            g.DOWNLOAD_WORKERS,
+            matcher_conf,
+        )
+    else:
+        # * Apply lightglue to group images as soon as each of them is downloaded
+        matched = process.stream_lightglue(
+            image_infos,
+            max_keypoints,
+            resize_value,
+            filter_threshold,
+            device,
+            g.DOWNLOAD_WORKERS,
+            matcher_conf,
+        )
+
+    group_ids, points_list = [], []
+    for img_id, ref_pts, img_pts in matched:
+        job.check_cancelled()
+        group_ids.append(img_id)
+        points_list.append((ref_pts, img_pts))
+        pbar.update(1)
+    return group_ids, points_list
+
+
+MATCH_QUEUE = JobQueue(run_match_job)
+STARTUP.on_ready(startup_finished)
+STARTUP.start(prepare_models)
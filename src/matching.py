@@ -0,0 +1,219 @@
+"""
+Matching of decoded images with loaded models and transposing of boxes with matched points.
+Used by the app and by worker processes of batch matching, so this module must not import
+modules with side effects (src.globals).
+"""
+
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+from lightglue.utils import numpy_image_to_torch
+import supervisely as sly
+from src.metrics import METRICS
+
+
+def bbox_from_array(points: np.array) -> sly.Rectangle:
+    """
+    Converts numpy array to Supervisely Rectangle object.
+    """
+    x_min = np.min(points[:, 0])
+    y_min = np.min(points[:, 1])
+    x_max = np.max(points[:, 0])
+    y_max = np.max(points[:, 1])
+
+    return sly.Rectangle(int(y_min), int(x_min), int(y_max), int(x_max))
+
+
+def bbox_to_array(geometry: sly.Rectangle) -> np.array:
+    """
+    Converts Supervisely Rectangle object to numpy array.
+    """
+    return np.array(
+        [
+            [geometry.left, geometry.top],  # Top-left corner
+            [geometry.right, geometry.top],  # Top-right corner
+            [geometry.right, geometry.bottom],  # Bottom-right
+            [geometry.left, geometry.bottom],  # Bottom-left
+        ]
+    ).astype(np.float32)
+
+
+def get_original_size(image: np.ndarray, image_info: sly.ImageInfo = None) -> Tuple[int, int]:
+    """
+    Returns (width, height) of the original image
+    """
+    if image_info is not None and image_info.width and image_info.height:
+        return image_info.width, image_info.height
+    return image.shape[1], image.shape[0]
+
+
+def extract_image_features(
+    extractor, image: np.ndarray, resize=None, device: str = "cpu", original_size=None
+) -> Dict[str, torch.Tensor]:
+    """
+    Extracts features of decoded image. If the image was decoded at reduced resolution,
+    keypoints are mapped back to the coordinates of the (width, height) `original_size` image.
+    """
+    with METRICS.span("extract"):
+        features = extractor.extract(numpy_image_to_torch(image).to(device), resize=resize)
+    METRICS.observe_keypoints(features["keypoints"].shape[1])
+    h, w = image.shape[:2]
+    if original_size is None or (w, h) == tuple(original_size):
+        return features
+    keypoints = features["keypoints"]
+    scales = torch.tensor([w / original_size[0], h / original_size[1]]).to(keypoints)
+    features["keypoints"] = (keypoints + 0.5) / scales - 0.5
+    features["image_size"] = torch.tensor(original_size)[None].to(keypoints).float()
+    return features
+
+
+def match_points(
+    matcher, ref_features: Dict[str, torch.Tensor], img_features: Dict[str, torch.Tensor]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Matches features of the reference and target images,
+    returns (ref_matched_pts, img_matched_pts)
+    """
+    with METRICS.span("match"), torch.inference_mode():
+        matches = matcher({"image0": ref_features, "image1": img_features})["matches"][0]
+    ref_matched_pts = ref_features["keypoints"][0][matches[..., 0]].cpu().numpy()
+    img_matched_pts = img_features["keypoints"][0][matches[..., 1]].cpu().numpy()
+    METRICS.observe_matches(len(ref_matched_pts))
+    return ref_matched_pts, img_matched_pts
+
+
+def enough_matches(ref_matched_pts: np.ndarray, img_matched_pts: np.ndarray, name: str) -> bool:
+    """
+    Returns False with a warning if there are too few matches to transpose boxes
+    """
+    if len(ref_matched_pts) < 4 or len(img_matched_pts) < 4:
+        sly.logger.warning(f"Not enough matches found for image {name}.")
+        return False
+    return True
+
+
+def match_decoded_images(
+    extractor,
+    matcher,
+    images: List[np.ndarray],
+    image_infos: List[sly.ImageInfo],
+    resize=None,
+    device: str = "cpu",
+) -> List[Tuple[int, np.ndarray, np.ndarray]]:
+    """
+    Matches decoded group images with the reference image (first one).
+    Images may be decoded at reduced resolution, keypoints are mapped to the sizes from infos.
+    Returns (image_id, ref_matched_pts, img_matched_pts) for successfully matched images.
+    """
+    ref_features = extract_image_features(
+        extractor, images[0], resize, device, get_original_size(images[0], image_infos[0])
+    )
+    results = []
+    for info, image in zip(image_infos[1:], images[1:]):
+        try:
+            img_features = extract_image_features(
+                extractor, image, resize, device, get_original_size(image, info)
+            )
+            ref_matched_pts, img_matched_pts = match_points(matcher, ref_features, img_features)
+        except Exception as e:
+            sly.logger.debug(f"Matching failed for image {info.name}: {e}")
+            continue
+        if enough_matches(ref_matched_pts, img_matched_pts, info.name):
+            results.append((info.id, ref_matched_pts, img_matched_pts))
+    return results
+
+
+class KeypointGrid:
+    """
+    Uniform grid over keypoints, used to select keypoints that may lie inside a set of boxes
+    """
+
+    def __init__(self, keypoints: np.ndarray, cells_per_side: int = 64):
+        self.keypoints = keypoints
+        self.origin = keypoints.min(axis=0)
+        extent = float(np.max(keypoints.max(axis=0) - self.origin))
+        self.cell_size = max(extent / cells_per_side, 1.0)
+        self.cells = np.floor((keypoints - self.origin) / self.cell_size).astype(np.int64)
+        self.shape = self.cells.max(axis=0) + 1  # (columns, rows)
+
+    def candidates(self, mins: np.ndarray, maxs: np.ndarray) -> np.ndarray:
+        """
+        Returns sorted indices of keypoints in the grid cells covered by any of the boxes
+        """
+        lo = np.floor((mins - self.origin) / self.cell_size).astype(np.int64)
+        hi = np.floor((maxs - self.origin) / self.cell_size).astype(np.int64)
+        covered = np.zeros((self.shape[1], self.shape[0]), dtype=bool)
+        for (x0, y0), (x1, y1) in zip(np.maximum(lo, 0), np.minimum(hi, self.shape - 1)):
+            if x0 <= x1 and y0 <= y1:
+                covered[y0 : y1 + 1, x0 : x1 + 1] = True
+        return np.flatnonzero(covered[self.cells[:, 1], self.cells[:, 0]])
+
+
+def transpose_bboxes(
+    bbox_labels: List[sly.Label],
+    points_list: List[Tuple[np.ndarray, np.ndarray]],
+    padding=0,
+) -> List[List[sly.Label]]:
+    """
+    Transposes bounding boxes to every image using its matched keypoints.
+    Returns a list of transposed labels for each (ref_keypoints, img_keypoints) pair,
+    boxes without keypoints inside are skipped, same as in `transpose_bbox_with_keypoints`.
+    """
+    if len(bbox_labels) == 0:
+        return [[] for _ in points_list]
+
+    box_points = np.stack([bbox_to_array(label.geometry) for label in bbox_labels])
+    mins = (box_points.min(axis=1) - padding).astype(np.float32)
+    maxs = (box_points.max(axis=1) + padding).astype(np.float32)
+
+    results = []
+    for ref_keypoints, img_keypoints in points_list:
+        if len(ref_keypoints) == 0:
+            results.append([])
+            continue
+
+        # * Keypoint index of first occurrence of each point, as lookup by value would return
+        _, first_idx, inverse = np.unique(
+            ref_keypoints, axis=0, return_index=True, return_inverse=True
+        )
+        source_idx = first_idx[inverse.reshape(-1)]
+
+        # * Find keypoints inside every box with one mask over the grid candidates
+        candidates = KeypointGrid(ref_keypoints).candidates(mins, maxs)
+        if len(candidates) == 0:
+            results.append([])
+            continue
+        cand_pts = ref_keypoints[candidates]
+        inside = (
+            (cand_pts[None, :, 0] >= mins[:, None, 0])
+            & (cand_pts[None, :, 0] <= maxs[:, None, 0])
+            & (cand_pts[None, :, 1] >= mins[:, None, 1])
+            & (cand_pts[None, :, 1] <= maxs[:, None, 1])
+        )
+        has_keypoints = inside.any(axis=1)
+
+        # * Nearest inside keypoint for every box corner and its offset in the target image
+        distances = np.linalg.norm(cand_pts[None, None] - box_points[:, :, None], axis=-1)
+        distances[~np.broadcast_to(inside[:, None], distances.shape)] = np.inf
+        nearest = candidates[np.argmin(distances, axis=-1)]
+        offsets = img_keypoints[source_idx[nearest]] - ref_keypoints[nearest]
+        new_box_points = box_points + offsets
+
+        results.append(
+            [
+                label.clone(bbox_from_array(points))
+                for label, points, keep in zip(bbox_labels, new_box_points, has_keypoints)
+                if keep
+            ]
+        )
+    return results
+
+
+def transpose_bbox_with_keypoints(
+    bbox_labels: List[sly.Label], ref_keypoints, img_keypoints, padding=0
+):
+    """
+    Generator function to transpose bounding boxes to images using keypoints
+    """
+    yield from transpose_bboxes(bbox_labels, [(ref_keypoints, img_keypoints)], padding)[0]
@@ -0,0 +1,271 @@
+import contextvars
+import os
+import resource
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import supervisely as sly
+from src.jobs import JobCancelled
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 4, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+# * Trace of the match click that is processed in the current context
+_CURRENT_TRACE: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar(
+    "match_trace", default=None
+)
+
+
+def rss_mb() -> float:
+    """
+    Returns resident memory of the process in MB.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    """
+    Returns peak resident memory of the process since its start in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _format_labels(labelnames: Sequence[str], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = defaultdict(float)
+        if len(self.labelnames) == 0:
+            self._values[()] = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] += amount
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Sequence[float],
+        labelnames: Sequence[str] = (),
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        # * Label values -> (bucket counts, sum, count)
+        self._values: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            state = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][idx] += 1
+            state[1] += value
+            state[2] += 1
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (bucket_counts, total, count) in self._values.items():
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Trace:
+    """
+    Stage timings and counters of one match click, logged as one JSON line when it is finished.
+    Time of a stage is summed over threads, so concurrent downloads may exceed the total time.
+    """
+
+    def __init__(self, **info):
+        self.info = info
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = defaultdict(float)
+        self.counters: Dict[str, float] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[stage] += seconds
+
+    def inc(self, name: str, amount: float = 1) -> None:
+        with self._lock:
+            self.counters[name] += amount
+
+    def summary(self) -> dict:
+        with self._lock:
+            summary = dict(self.info)
+            summary["total_ms"] = round((time.perf_counter() - self.started) * 1000, 1)
+            summary["stages_ms"] = {
+                stage: round(seconds * 1000, 1) for stage, seconds in self.stages.items()
+            }
+            summary.update(self.counters)
+        return summary
+
+
+class Metrics:
+    """
+    Process-wide counters and histograms of matching, rendered in Prometheus text format.
+    Stage spans and counters are also added to the trace of the current match click, if any.
+    """
+
+    def __init__(self):
+        self.stage_seconds = Histogram(
+            "match_stage_seconds", "Duration of matching stages", TIME_BUCKETS, ("stage",)
+        )
+        self.click_seconds = Histogram(
+            "match_click_seconds", "Duration of match clicks", TIME_BUCKETS, ("device", "status")
+        )
+        self.keypoints = Histogram(
+            "match_keypoints_per_image", "Keypoints extracted per image", COUNT_BUCKETS
+        )
+        self.matches = Histogram(
+            "match_matches_per_pair", "Matched keypoints per image pair", COUNT_BUCKETS
+        )
+        self.failed_pairs = Counter("match_failed_pairs_total", "Image pairs that failed matching")
+        self.boxes = Counter("match_boxes_produced_total", "Boxes transposed to group images")
+        self.cache_requests = Counter(
+            "match_cache_requests_total", "Feature and match cache lookups", ("cache", "result")
+        )
+        self.clicks = Counter("match_clicks_total", "Processed match clicks", ("device", "status"))
+        self.ann_chunk_seconds = Histogram(
+            "annotation_chunk_seconds",
+            "Duration of annotation requests sent in chunks",
+            TIME_BUCKETS,
+            ("operation",),
+        )
+        self.ann_chunk_retries = Counter(
+            "annotation_chunk_retries_total", "Retried annotation chunk requests", ("operation",)
+        )
+
+    @contextmanager
+    def span(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - start)
+
+    def observe_stage(self, stage: str, seconds: float) -> None:
+        """
+        Records duration of a stage measured elsewhere, e.g. in a worker process.
+        """
+        self.stage_seconds.observe(seconds, stage=stage)
+        trace = _CURRENT_TRACE.get()
+        if trace is not None:
+            trace.add_stage(stage, seconds)
+
+    def _trace_inc(self, name: str, amount: float = 1) -> None:
+        trace = _CURRENT_TRACE.get()
+        if trace is not None:
+            trace.inc(name, amount)
+
+    def observe_keypoints(self, count: int) -> None:
+        self.keypoints.observe(count)
+        self._trace_inc("images extracted")
+        self._trace_inc("keypoints", count)
+
+    def observe_matches(self, count: int) -> None:
+        self.matches.observe(count)
+        self._trace_inc("pairs matched")
+        self._trace_inc("matches", count)
+
+    def count_failed_pairs(self, count: int = 1) -> None:
+        if count <= 0:
+            return
+        self.failed_pairs.inc(count)
+        self._trace_inc("failed pairs", count)
+
+    def count_boxes(self, count: int) -> None:
+        self.boxes.inc(count)
+        self._trace_inc("boxes produced", count)
+
+    def observe_ann_chunk(self, operation: str, seconds: float, retries: int) -> None:
+        self.ann_chunk_seconds.observe(seconds, operation=operation)
+        self._trace_inc(f"{operation} chunks")
+        if retries > 0:
+            self.ann_chunk_retries.inc(retries, operation=operation)
+            self._trace_inc(f"{operation} retries", retries)
+
+    def count_cache(self, cache: str, hit: bool) -> None:
+        result = "hit" if hit else "miss"
+        self.cache_requests.inc(cache=cache, result=result)
+        self._trace_inc(f"{cache} cache {result}")
+
+    @contextmanager
+    def trace(self, device: str, **info):
+        """
+        Collects stages and counters of the match click and logs them as one summary line.
+        """
+        trace = Trace(device=device, **info)
+        token = _CURRENT_TRACE.set(trace)
+        status = "success"
+        try:
+            yield trace
+        except Exception as e:
+            status = "cancelled" if isinstance(e, JobCancelled) else "failed"
+            raise
+        finally:
+            _CURRENT_TRACE.reset(token)
+            seconds = time.perf_counter() - trace.started
+            self.click_seconds.observe(seconds, device=device, status=status)
+            self.clicks.inc(device=device, status=status)
+            trace.info["status"] = status
+            sly.logger.info("Match summary", extra=trace.summary())
+
+    def render(self) -> str:
+        lines = []
+        for metric in (
+            self.stage_seconds,
+            self.click_seconds,
+            self.keypoints,
+            self.matches,
+            self.failed_pairs,
+            self.boxes,
+            self.cache_requests,
+            self.clicks,
+            self.ann_chunk_seconds,
+            self.ann_chunk_retries,
+        ):
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
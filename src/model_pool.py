@@ -0,0 +1,139 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+import torch
+from lightglue import LightGlue, SuperPoint
+import supervisely as sly
+import src.globals as g
+from src.backends import load_models
+
+
+class ModelPool:
+    """
+    Keeps SuperPoint and LightGlue networks loaded between clicks.
+
+    Models are stored per (device, max_keypoints, filter_threshold, backend, matcher options) key.
+    Backend and int8 quantization default to the INFERENCE_BACKEND and QUANTIZE_MATCHER settings.
+    The least recently used configurations are evicted when the pool is full
+    or when they have not been requested for `idle_ttl` seconds.
+    """
+
+    def __init__(self, max_entries: int = 2, idle_ttl: float = 30 * 60):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self._models: Dict[Hashable, Tuple[SuperPoint, LightGlue]] = OrderedDict()
+        self._last_used: Dict[Hashable, float] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(
+        device: str,
+        max_num_keypoints: Optional[int],
+        filter_threshold: float,
+        backend: str = None,
+        quantize: bool = None,
+        **matcher_conf,
+    ) -> Tuple:
+        backend = backend or g.INFERENCE_BACKEND
+        quantize = g.QUANTIZE_MATCHER if quantize is None else quantize
+        return (str(device), max_num_keypoints, float(filter_threshold), backend, quantize) + tuple(
+            sorted(matcher_conf.items())
+        )
+
+    def _build(
+        self,
+        device: str,
+        max_num_keypoints: Optional[int],
+        filter_threshold: float,
+        backend: str = None,
+        quantize: bool = None,
+        **matcher_conf,
+    ) -> Tuple[SuperPoint, LightGlue]:
+        return load_models(
+            device,
+            max_num_keypoints,
+            filter_threshold,
+            g.MODEL_DIR,
+            backend or g.INFERENCE_BACKEND,
+            g.QUANTIZE_MATCHER if quantize is None else quantize,
+            g.INTRA_OP_THREADS,
+            **matcher_conf,
+        )
+
+    def _evict(self, keep_key: Hashable) -> None:
+        now = time.monotonic()
+        expired = [
+            key
+            for key, last_used in self._last_used.items()
+            if key != keep_key and now - last_used > self.idle_ttl
+        ]
+        for key in expired:
+            self._drop(key)
+        while len(self._models) > self.max_entries:
+            key = next(iter(self._models))
+            if key == keep_key:
+                break
+            self._drop(key)
+
+    def _drop(self, key: Hashable) -> None:
+        self._models.pop(key, None)
+        self._last_used.pop(key, None)
+        sly.logger.debug("Evicted models from the pool", extra={"key": str(key)})
+        if str(key[0]).startswith("cuda") and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def get(
+        self,
+        device: str,
+        max_num_keypoints: Optional[int],
+        filter_threshold: float,
+        backend: str = None,
+        quantize: bool = None,
+        **matcher_conf,
+    ) -> Tuple[SuperPoint, LightGlue]:
+        """
+        Returns (extractor, matcher) for the given configuration, building them if needed.
+        """
+        key = self.make_key(
+            device, max_num_keypoints, filter_threshold, backend, quantize, **matcher_conf
+        )
+        with self._lock:
+            models = self._models.get(key)
+            if models is None:
+                sly.logger.debug("Loading models into the pool", extra={"key": str(key)})
+                models = self._build(
+                    device, max_num_keypoints, filter_threshold, backend, quantize, **matcher_conf
+                )
+                self._models[key] = models
+            self._models.move_to_end(key)
+            self._last_used[key] = time.monotonic()
+            self._evict(key)
+        return models
+
+    def warmup(
+        self, device: str, max_num_keypoints: Optional[int], filter_threshold: float, **matcher_conf
+    ) -> threading.Thread:
+        """
+        Loads models for the given configuration on a background thread.
+        """
+
+        def _warmup():
+            try:
+                self.get(device, max_num_keypoints, filter_threshold, **matcher_conf)
+                sly.logger.info("Models are loaded and ready", extra={"device": device})
+            except Exception as e:
+                sly.logger.warning(f"Failed to warm up models: {e}")
+
+        thread = threading.Thread(target=_warmup, name="model-pool-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in list(self._models):
+                self._drop(key)
+
+
+MODEL_POOL = ModelPool()
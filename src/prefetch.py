@@ -0,0 +1,117 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+import supervisely as sly
+import src.process_funcs as process
+from src.globals import CACHE
+
+
+class PrefetchTask:
+    def __init__(self, image_id: int, dataset_id: int, params: dict, with_matches: bool):
+        self.image_id = image_id
+        self.dataset_id = dataset_id
+        self.params = params
+        self.with_matches = with_matches
+        self.cancelled = threading.Event()
+
+
+class Prefetcher:
+    """
+    Background worker that resolves the group of the selected image, downloads its images
+    and extracts their features before MATCH BBOXES is pressed.
+
+    Only the latest submitted image is prefetched, the previous task is cancelled.
+    The worker runs with lowered OS priority and waits while a match is processed.
+    """
+
+    def __init__(self, niceness: int = 10):
+        self.niceness = niceness
+        self._task: Optional[PrefetchTask] = None
+        self._has_task = threading.Condition()
+        self._not_paused = threading.Event()
+        self._not_paused.set()
+        self._thread: Optional[threading.Thread] = None
+
+    def _ensure_started(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="prefetch", daemon=True)
+            self._thread.start()
+
+    def submit(self, image_id: int, dataset_id: int, params: dict, with_matches: bool = False):
+        """
+        Schedules prefetching for the group of the image, cancelling the current task.
+        `params` are keyword arguments for `process.prefetch_group`.
+        """
+        with self._has_task:
+            if self._task is not None:
+                self._task.cancelled.set()
+            self._task = PrefetchTask(image_id, dataset_id, params, with_matches)
+            self._has_task.notify()
+        self._ensure_started()
+
+    def cancel(self) -> None:
+        with self._has_task:
+            if self._task is not None:
+                self._task.cancelled.set()
+                self._task = None
+
+    @contextmanager
+    def paused(self):
+        """
+        Pauses prefetching between images while the block is running.
+        """
+        self._not_paused.clear()
+        try:
+            yield
+        finally:
+            self._not_paused.set()
+
+    def _lower_priority(self) -> None:
+        try:
+            # * On Linux the priority of a single thread can be changed by its native id
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.niceness)
+        except (AttributeError, OSError) as e:
+            sly.logger.debug(f"Failed to lower prefetch thread priority: {e}")
+
+    def _run(self) -> None:
+        self._lower_priority()
+        while True:
+            with self._has_task:
+                while self._task is None:
+                    self._has_task.wait()
+                task = self._task
+            try:
+                self._process(task)
+            except Exception as e:
+                sly.logger.debug(f"Prefetching failed for image {task.image_id}: {e}")
+            with self._has_task:
+                if self._task is task:
+                    self._task = None
+
+    def _should_stop(self, task: PrefetchTask) -> bool:
+        while not self._not_paused.wait(timeout=0.5):
+            if task.cancelled.is_set():
+                return True
+        return task.cancelled.is_set()
+
+    def _process(self, task: PrefetchTask) -> None:
+        if self._should_stop(task):
+            return
+        image_infos = CACHE.get_group_image_infos(task.image_id, task.dataset_id)
+        if len(image_infos) < 2:
+            return
+        sly.logger.debug(
+            f"Prefetching {len(image_infos)} group images",
+            extra={"image_id": task.image_id, "with matches": task.with_matches},
+        )
+        process.prefetch_group(
+            image_infos,
+            with_matches=task.with_matches,
+            should_stop=lambda: self._should_stop(task),
+            **task.params,
+        )
+
+
+PREFETCHER = Prefetcher()
@@ -1,37 +1,378 @@
+import contextvars
 import cv2
 import numpy as np
-from lightglue import LightGlue, SuperPoint
-from lightglue.utils import load_image, rbd
+import torch
+from lightglue.utils import ImagePreprocessor, numpy_image_to_torch, rbd
 import supervisely as sly
-from typing import List
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional, Set, Tuple
 import src.globals as g
 from copy import deepcopy
+from src.model_pool import MODEL_POOL
+from src.feature_store import FEATURE_STORE, MATCH_STORE
+from src.metrics import METRICS
+from src.sharding import SHARD_POOL
+import src.image_io as image_io
+from src.matching import (
+    enough_matches,
+    extract_image_features,
+    get_original_size,
+    match_decoded_images,
+    match_points,
+    transpose_bboxes,
+)
 
 
-def bbox_from_array(points: np.array) -> sly.Rectangle:
+def get_feature_key(
+    image_info: sly.ImageInfo, resize: Optional[int], max_num_keypoints: Optional[int]
+) -> Tuple:
     """
-    Converts numpy array to Supervisely Rectangle object.
+    Key of the image features in the feature store
     """
-    x_min = np.min(points[:, 0])
-    y_min = np.min(points[:, 1])
-    x_max = np.max(points[:, 0])
-    y_max = np.max(points[:, 1])
+    return (image_info.id, image_info.hash, resize, max_num_keypoints)
 
-    return sly.Rectangle(int(y_min), int(x_min), int(y_max), int(x_max))
 
+def get_cached_feature_ids(
+    image_infos: List[sly.ImageInfo], resize: Optional[int], max_num_keypoints: Optional[int]
+) -> Set[int]:
+    """
+    Returns ids of the images, which features are already in the feature store
+    """
+    return {
+        info.id
+        for info in image_infos
+        if get_feature_key(info, resize, max_num_keypoints) in FEATURE_STORE
+    }
 
-def bbox_to_array(geometry: sly.Rectangle) -> np.array:
+
+def get_cached_match_ids(
+    image_infos: List[sly.ImageInfo],
+    resize: Optional[int],
+    max_num_keypoints: Optional[int],
+    filter_threshold: float,
+    matcher_conf: Optional[dict] = None,
+) -> Set[int]:
     """
-    Converts Supervisely Rectangle object to numpy array.
+    Returns ids of the target images, which matches with the reference image are already cached
     """
-    return np.array(
-        [
-            [geometry.left, geometry.top],  # Top-left corner
-            [geometry.right, geometry.top],  # Top-right corner
-            [geometry.right, geometry.bottom],  # Bottom-right
-            [geometry.left, geometry.bottom],  # Bottom-left
-        ]
-    ).astype(np.float32)
+    ref_info = image_infos[0]
+    return {
+        info.id
+        for info in image_infos[1:]
+        if get_match_key(
+            ref_info, info, resize, max_num_keypoints, filter_threshold, matcher_conf
+        )
+        in MATCH_STORE
+    }
+
+
+def get_match_key(
+    ref_info: sly.ImageInfo,
+    img_info: sly.ImageInfo,
+    resize: Optional[int],
+    max_num_keypoints: Optional[int],
+    filter_threshold: float,
+    matcher_conf: Optional[dict] = None,
+) -> Tuple:
+    """
+    Key of the matched points of (reference, target) images in the match store,
+    `matcher_conf` are LightGlue options the points are matched with
+    """
+    return (
+        ref_info.id,
+        ref_info.hash,
+        img_info.id,
+        img_info.hash,
+        resize,
+        max_num_keypoints,
+        filter_threshold,
+        tuple(sorted((matcher_conf or {}).items())),
+    )
+
+
+def get_batch_matcher_conf(matcher_conf: Optional[dict]) -> dict:
+    """
+    LightGlue options of batched matching: adaptive pruning works only for a single pair,
+    so it's disabled for batches
+    """
+    return {**(matcher_conf or {}), "depth_confidence": -1, "width_confidence": -1}
+
+
+def load_cached_matches(match_key: Tuple) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Returns (ref_matched_pts, img_matched_pts) from the match store or None if they are not cached
+    """
+    if match_key is None:
+        return None
+    cached = MATCH_STORE.get(match_key)
+    METRICS.count_cache("matches", cached is not None)
+    if cached is None:
+        return None
+    return np.array(cached["ref"]), np.array(cached["img"])
+
+
+def cache_matches(match_key: Tuple, ref_matched_pts: np.ndarray, img_matched_pts: np.ndarray):
+    if match_key is not None:
+        MATCH_STORE.put(match_key, {"ref": ref_matched_pts, "img": img_matched_pts})
+
+
+def compact_features(features: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """
+    Converts descriptors to half precision before caching, if FP16_DESCRIPTORS is set
+    """
+    if g.FP16_DESCRIPTORS and "descriptors" in features:
+        features = {**features, "descriptors": features["descriptors"].astype(np.float16)}
+    return features
+
+
+def features_to_numpy(features: Dict[str, torch.Tensor]) -> Dict[str, np.ndarray]:
+    return compact_features({k: v.detach().cpu().numpy() for k, v in features.items()})
+
+
+def features_to_torch(features: Dict[str, np.ndarray], device: str) -> Dict[str, torch.Tensor]:
+    tensors = {k: torch.from_numpy(np.array(v)).to(device) for k, v in features.items()}
+    # * Half precision descriptors are matched in float32
+    return {k: v.float() if v.dtype == torch.float16 else v for k, v in tensors.items()}
+
+
+def load_cached_features(feature_key: Tuple, device: str) -> Optional[Dict[str, torch.Tensor]]:
+    """
+    Returns image features from the feature store or None if they are not cached
+    """
+    if feature_key is None:
+        return None
+    cached = FEATURE_STORE.get(feature_key)
+    METRICS.count_cache("features", cached is not None)
+    if cached is None:
+        return None
+    return features_to_torch(cached, device)
+
+
+def load_group_image(
+    image_path: str, image_info: sly.ImageInfo = None, resize=None
+) -> np.ndarray:
+    """
+    Reads group image, decoding it at the lowest resolution that is still enough for `resize`
+    """
+    if image_info is not None and not sly.fs.file_exists(image_path):
+        # * Features or the file were evicted after the download was skipped, so download it now
+        image_path = g.IMAGE_CACHE.download(g.api, image_info.dataset_id, [image_info])[0]
+    reduction = 1
+    if image_info is not None:
+        reduction = image_io.get_reduction(image_info.width, image_info.height, resize)
+    with METRICS.span("decode"):
+        return image_io.read_image(image_path, reduction)
+
+
+def extract_features(
+    extractor,
+    image_path: str,
+    resize=None,
+    device: str = "cpu",
+    feature_key: Tuple = None,
+    image_info: sly.ImageInfo = None,
+) -> Dict[str, torch.Tensor]:
+    """
+    Extracts image features or takes them from the feature store if they were extracted before
+    """
+    features = load_cached_features(feature_key, device)
+    if features is not None:
+        return features
+
+    image = load_group_image(image_path, image_info, resize)
+    original_size = get_original_size(image, image_info)
+    features = extract_image_features(extractor, image, resize, device, original_size)
+    if feature_key is not None:
+        FEATURE_STORE.put(feature_key, features_to_numpy(features))
+    return features
+
+
+def download_group_image(image_info: sly.ImageInfo, resize=None) -> np.ndarray:
+    """
+    Downloads group image and decodes it at the lowest resolution that is still enough for `resize`
+    """
+    reduction = image_io.get_reduction(image_info.width, image_info.height, resize)
+    return image_io.download_image(g.api, image_info, reduction, g.IMAGE_CACHE)
+
+
+def download_target(
+    image_info: sly.ImageInfo, resize=None, max_num_keypoints: Optional[int] = None
+) -> Tuple[sly.ImageInfo, Optional[np.ndarray]]:
+    """
+    Returns (image_info, decoded image), the image is not downloaded if its features are cached
+    """
+    if get_feature_key(image_info, resize, max_num_keypoints) in FEATURE_STORE:
+        return image_info, None
+    return image_info, download_group_image(image_info, resize)
+
+
+def get_image_features(
+    extractor,
+    image_info: sly.ImageInfo,
+    image: Optional[np.ndarray],
+    resize=None,
+    max_num_keypoints: Optional[int] = None,
+    device: str = "cpu",
+    roi: Tuple[int, int, int, int] = None,
+) -> Dict[str, torch.Tensor]:
+    """
+    Takes image features from the feature store or extracts and caches them,
+    the image is downloaded if it's None. With `roi`, only features of the region are returned,
+    features extracted from the region are not cached.
+    """
+    feature_key = get_feature_key(image_info, resize, max_num_keypoints)
+    features = load_cached_features(feature_key, device)
+    if features is not None:
+        return features if roi is None else select_roi_features(features, roi)
+    if image is None:
+        image = download_group_image(image_info, resize)
+    original_size = get_original_size(image, image_info)
+    if roi is not None:
+        return extract_roi_features(extractor, image, roi, resize, device, original_size)
+    features = extract_image_features(extractor, image, resize, device, original_size)
+    FEATURE_STORE.put(feature_key, features_to_numpy(features))
+    return features
+
+
+def submit_in_context(executor: ThreadPoolExecutor, func: Callable, *args):
+    """
+    Submits the function to run in a copy of the current context,
+    so its stages are added to the trace of the current match click
+    """
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+
+def yield_cached_matches(
+    image_infos: List[sly.ImageInfo], cached_matches: Dict[int, Optional[Tuple]]
+):
+    """
+    Yields (image_id, ref_matched_pts, img_matched_pts) of images with cached matches,
+    images with not enough matches are skipped
+    """
+    for info in image_infos:
+        matched = cached_matches.get(info.id)
+        if matched is not None and enough_matches(*matched, info.name):
+            yield (info.id, *matched)
+
+
+def finish_pair(
+    image_info: sly.ImageInfo,
+    ref_matched_pts: np.ndarray,
+    img_matched_pts: np.ndarray,
+    match_key: Tuple = None,
+) -> Optional[Tuple[int, np.ndarray, np.ndarray]]:
+    """
+    Caches matched points of the pair, returns (image_id, ref_matched_pts, img_matched_pts)
+    or None if there are not enough matches
+    """
+    cache_matches(match_key, ref_matched_pts, img_matched_pts)
+    if not enough_matches(ref_matched_pts, img_matched_pts, image_info.name):
+        return None
+    return (image_info.id, ref_matched_pts, img_matched_pts)
+
+
+def extract_features_batch(
+    extractor,
+    images: List[torch.Tensor],
+    resize=None,
+    remove_borders: int = 4,
+    original_sizes: List[Tuple[int, int]] = None,
+) -> List[Dict[str, torch.Tensor]]:
+    """
+    Extracts features of several images with one SuperPoint forward pass.
+    Images are resized like in `extractor.extract` and padded to a common shape,
+    keypoints found in the padding are dropped and mapped back to original image coordinates.
+    Without the keypoints cap, images are extracted one by one.
+    """
+    if original_sizes is None:
+        original_sizes = [(img.shape[-1], img.shape[-2]) for img in images]
+    preprocessor = ImagePreprocessor(**{**extractor.preprocess_conf, "resize": resize})
+    prepared = [preprocessor(img[None]) for img in images]
+    max_h = max(img.shape[-2] for img, _ in prepared)
+    max_w = max(img.shape[-1] for img, _ in prepared)
+
+    def _extract_one_by_one():
+        return [{k: v[0] for k, v in extractor({"image": img}).items()} for img, _ in prepared]
+
+    with METRICS.span("extract"), torch.inference_mode():
+        if extractor.conf.max_num_keypoints is None:
+            # * Without the cap keypoint counts almost always differ, so the batch is not tried
+            raw_features = _extract_one_by_one()
+        else:
+            batch = prepared[0][0].new_zeros(
+                (len(prepared), prepared[0][0].shape[1], max_h, max_w)
+            )
+            for idx, (img, _) in enumerate(prepared):
+                batch[idx, :, : img.shape[-2], : img.shape[-1]] = img[0]
+            try:
+                outputs = extractor({"image": batch})
+                raw_features = [
+                    {k: v[idx] for k, v in outputs.items()} for idx in range(len(prepared))
+                ]
+            except RuntimeError:
+                # * Keypoint counts differ between images and can't be stacked, extract one by one
+                raw_features = _extract_one_by_one()
+
+    features_list = []
+    for orig_img, (img, scales), raw, (orig_w, orig_h) in zip(
+        images, prepared, raw_features, original_sizes
+    ):
+        h, w = img.shape[-2:]
+        keypoints = raw["keypoints"]
+        if h < max_h or w < max_w:
+            keep = (keypoints[:, 0] < w - remove_borders) & (keypoints[:, 1] < h - remove_borders)
+            raw = {k: v[keep] for k, v in raw.items()}
+            keypoints = raw["keypoints"]
+        # * Scales from the original image to the processed one, including reduced decoding
+        scales = scales.to(keypoints) * torch.tensor(
+            [orig_img.shape[-1] / orig_w, orig_img.shape[-2] / orig_h]
+        ).to(keypoints)
+        METRICS.observe_keypoints(len(keypoints))
+        features_list.append(
+            {
+                "keypoints": ((keypoints + 0.5) / scales[None] - 0.5)[None],
+                "keypoint_scores": raw["keypoint_scores"][None],
+                "descriptors": raw["descriptors"][None],
+                "image_size": torch.tensor([orig_w, orig_h])[None].to(keypoints).float(),
+            }
+        )
+    return features_list
+
+
+def match_features_batch(
+    matcher, ref_features: Dict[str, torch.Tensor], features_list: List[Dict[str, torch.Tensor]]
+) -> List[Optional[torch.Tensor]]:
+    """
+    Matches reference features with every features dict in the list.
+    Pairs with the same keypoints count are stacked and matched in one forward pass,
+    reference features are expanded without copying. Returns matches or None for failed pairs.
+    """
+    results = [None] * len(features_list)
+    idxs_by_count = defaultdict(list)
+    for idx, features in enumerate(features_list):
+        idxs_by_count[features["keypoints"].shape[1]].append(idx)
+
+    for idxs in idxs_by_count.values():
+        data0 = {k: v.expand(len(idxs), *v.shape[1:]) for k, v in ref_features.items()}
+        data1 = {k: torch.cat([features_list[idx][k] for idx in idxs]) for k in data0}
+        try:
+            with METRICS.span("match"), torch.inference_mode():
+                matches = matcher({"image0": data0, "image1": data1})["matches"]
+        except Exception as e:
+            sly.logger.debug(f"Batched matching failed, matching pairs one by one: {e}")
+            matches = []
+            for idx in idxs:
+                try:
+                    with METRICS.span("match"), torch.inference_mode():
+                        pair = {"image0": ref_features, "image1": features_list[idx]}
+                        matches.append(matcher(pair)["matches"][0])
+                except Exception as e:
+                    sly.logger.debug(f"Matching failed: {e}")
+                    matches.append(None)
+        for idx, pair_matches in zip(idxs, matches):
+            results[idx] = pair_matches
+    return results
 
 
 def apply_lightglue(
@@ -40,42 +381,92 @@ def apply_lightglue(
     resize=None,
     filter_threshold=0.3,
     device: str = "cpu",
+    path_to_info: Dict[str, sly.ImageInfo] = None,
+    batch_size: int = 1,
+    matcher_conf: dict = None,
 ):
     """
-    Generator function to apply LightGlue to image paths
+    Generator function to apply LightGlue to image paths.
+    If `path_to_info` is passed, features are cached per image and only missing ones are extracted.
+    If `batch_size` is greater than 1, target images are extracted and matched in mini-batches.
+    `matcher_conf` are additional LightGlue options, e.g. early exit confidences.
     """
+    path_to_info = path_to_info or {}
+
+    def _feature_key(path):
+        info = path_to_info.get(path)
+        if info is None:
+            return None
+        return get_feature_key(info, resize, max_num_keypoints)
 
     # * Get reference image path first
     reference_image_path = image_paths.pop(0)
+    matcher_conf = dict(matcher_conf or {})
+    if batch_size > 1:
+        matcher_conf = get_batch_matcher_conf(matcher_conf)
 
-    # * Initialize feature extractor and matcher
-    extractor = (
-        SuperPoint(max_num_keypoints=max_num_keypoints, model_dir=g.MODEL_DIR).eval().to(device)
-    )
-    matcher = (
-        LightGlue(
-            features="superpoint",
-            # depth_confidence=-1,
-            # width_confidence=-1,
-            filter_threshold=filter_threshold,
-            model_dir=g.MODEL_DIR,
+    def _match_key(path):
+        ref_info, img_info = path_to_info.get(reference_image_path), path_to_info.get(path)
+        if ref_info is None or img_info is None:
+            return None
+        return get_match_key(
+            ref_info, img_info, resize, max_num_keypoints, filter_threshold, matcher_conf
         )
-        .eval()
-        .to(device)
+
+    # * Matches cached on previous clicks are yielded first, the rest of images are matched after
+    cached_matches = {path: load_cached_matches(_match_key(path)) for path in image_paths}
+    cached_paths = [path for path in image_paths if cached_matches[path] is not None]
+    target_paths = [path for path in image_paths if cached_matches[path] is None]
+    image_paths[:] = cached_paths + target_paths
+    for img_path in cached_paths:
+        if not enough_matches(*cached_matches[img_path], img_path):
+            image_paths.remove(img_path)
+            continue
+        yield cached_matches[img_path]
+    if len(target_paths) == 0:
+        return
+
+    # * Get feature extractor and matcher from the pool of loaded models
+    extractor, matcher = MODEL_POOL.get(
+        device, max_num_keypoints, filter_threshold, **matcher_conf
     )
     # g.api.task.set_output_text(g.task_id, "Application is started.")
 
     # * Load the reference image and extract features
-    ref_image = load_image(reference_image_path).to(device)
-    ref_features = extractor.extract(ref_image, resize=resize)
+    ref_features = extract_features(
+        extractor,
+        reference_image_path,
+        resize,
+        device,
+        _feature_key(reference_image_path),
+        path_to_info.get(reference_image_path),
+    )
+
+    if batch_size > 1:
+        yield from _apply_lightglue_batched(
+            image_paths,
+            target_paths,
+            extractor,
+            matcher,
+            ref_features,
+            resize,
+            device,
+            batch_size,
+            _feature_key,
+            _match_key,
+            path_to_info,
+        )
+        return
 
-    for img_path in image_paths[:]:
+    for img_path in target_paths:
         ref_features_copy = deepcopy(ref_features)
-        img = load_image(img_path).to(device)
-        img_features = extractor.extract(img, resize=resize)
+        img_features = extract_features(
+            extractor, img_path, resize, device, _feature_key(img_path), path_to_info.get(img_path)
+        )
 
         try:
-            matches = matcher({"image0": ref_features_copy, "image1": img_features})
+            with METRICS.span("match"), torch.inference_mode():
+                matches = matcher({"image0": ref_features_copy, "image1": img_features})
         except Exception as e:
             sly.logger.debug(f"Matching failed for image {img_path}: {e}")
             image_paths.remove(img_path)
@@ -87,15 +478,75 @@ def apply_lightglue(
 
         ref_matched_pts = ref_features_copy["keypoints"][matches["matches"][..., 0]].cpu().numpy()
         img_matched_pts = img_features["keypoints"][matches["matches"][..., 1]].cpu().numpy()
+        del ref_features_copy, img_features, matches
+        cache_matches(_match_key(img_path), ref_matched_pts, img_matched_pts)
+        METRICS.observe_matches(len(ref_matched_pts))
 
-        if len(ref_matched_pts) < 4 or len(img_matched_pts) < 4:
-            sly.logger.warning(f"Not enough matches found for image {img_path}.")
+        if not enough_matches(ref_matched_pts, img_matched_pts, img_path):
             image_paths.remove(img_path)
             continue
 
         yield (ref_matched_pts, img_matched_pts)
 
 
+def _apply_lightglue_batched(
+    image_paths: List[str],
+    target_paths: List[str],
+    extractor,
+    matcher,
+    ref_features: Dict[str, torch.Tensor],
+    resize,
+    device: str,
+    batch_size: int,
+    feature_key_fn: Callable[[str], Tuple],
+    match_key_fn: Callable[[str], Tuple],
+    path_to_info: Dict[str, sly.ImageInfo],
+):
+    ref_keypoints = ref_features["keypoints"][0]
+    for start in range(0, len(target_paths), batch_size):
+        chunk = target_paths[start : start + batch_size]
+
+        # * Take cached features and extract the missing ones in one batch
+        chunk_features = {path: load_cached_features(feature_key_fn(path), device) for path in chunk}
+        missing = [path for path, features in chunk_features.items() if features is None]
+        if len(missing) > 0:
+            images = [load_group_image(path, path_to_info.get(path), resize) for path in missing]
+            original_sizes = [
+                get_original_size(image, path_to_info.get(path))
+                for path, image in zip(missing, images)
+            ]
+            images = [numpy_image_to_torch(image).to(device) for image in images]
+            batch_features = extract_features_batch(
+                extractor, images, resize, original_sizes=original_sizes
+            )
+            for path, features in zip(missing, batch_features):
+                chunk_features[path] = features
+                if feature_key_fn(path) is not None:
+                    FEATURE_STORE.put(feature_key_fn(path), features_to_numpy(features))
+            del images
+
+        features_list = [chunk_features[path] for path in chunk]
+        for img_path, features, matches in zip(
+            chunk, features_list, match_features_batch(matcher, ref_features, features_list)
+        ):
+            if matches is None:
+                sly.logger.debug(f"Matching failed for image {img_path}")
+                image_paths.remove(img_path)
+                continue
+
+            ref_matched_pts = ref_keypoints[matches[..., 0]].cpu().numpy()
+            img_matched_pts = features["keypoints"][0][matches[..., 1]].cpu().numpy()
+            cache_matches(match_key_fn(img_path), ref_matched_pts, img_matched_pts)
+            METRICS.observe_matches(len(ref_matched_pts))
+
+            if not enough_matches(ref_matched_pts, img_matched_pts, img_path):
+                image_paths.remove(img_path)
+                continue
+
+            yield (ref_matched_pts, img_matched_pts)
+        del chunk_features, features_list
+
+
 # def apply_transform_to_bboxes(bbox_labels: List[sly.Label], ref_matched_pts, img_matched_pts):
 #     # * Calculate the homography matrix between the reference and target image
 #     H, _ = cv2.findHomography(ref_matched_pts, img_matched_pts)
@@ -109,34 +560,438 @@ def apply_lightglue(
 #         yield orig_label.clone(bbox_from_array(transformed_pts))
 
 
-def transpose_bbox_with_keypoints(
-    bbox_labels: List[sly.Label], ref_keypoints, img_keypoints, padding=0
+def stream_lightglue(
+    image_infos: List[sly.ImageInfo],
+    max_num_keypoints: int = 1024,
+    resize=None,
+    filter_threshold=0.3,
+    device: str = "cpu",
+    num_workers: int = 4,
+    matcher_conf: dict = None,
 ):
     """
-    Generator function to transpose bounding boxes to images using keypoints
-    """
-    for orig_label in bbox_labels:
-        geometry = orig_label.geometry
-        box_points = bbox_to_array(geometry)
-        min_x, min_y = np.min(box_points, axis=0) - padding
-        max_x, max_y = np.max(box_points, axis=0) + padding
-        extended_bbox = np.array([[min_x, min_y], [max_x, min_y], [max_x, max_y], [min_x, max_y]])
-        in_bbox_keypoints = [
-            kp
-            for kp in ref_keypoints
-            if cv2.pointPolygonTest(extended_bbox.astype(np.float32), tuple(kp), False) >= 0
-        ]
-        if not in_bbox_keypoints:
+    Generator function to apply LightGlue to group images while they are being downloaded.
+    Images are downloaded concurrently and decoded in memory, images with cached features
+    are not downloaded at all. Reference image info must be the first one.
+    Yields (image_id, ref_matched_pts, img_matched_pts) in completion order,
+    matches cached on previous clicks are yielded first.
+    """
+    ref_info, target_infos = image_infos[0], image_infos[1:]
+
+    def _match_key(info: sly.ImageInfo):
+        return get_match_key(
+            ref_info, info, resize, max_num_keypoints, filter_threshold, matcher_conf
+        )
+
+    cached_matches = {info.id: load_cached_matches(_match_key(info)) for info in target_infos}
+    target_infos = [info for info in target_infos if cached_matches[info.id] is None]
+    extractor, matcher = None, None
+    if len(target_infos) > 0:
+        extractor, matcher = MODEL_POOL.get(
+            device, max_num_keypoints, filter_threshold, **(matcher_conf or {})
+        )
+
+    def _features(info: sly.ImageInfo, image: Optional[np.ndarray]):
+        return get_image_features(extractor, info, image, resize, max_num_keypoints, device)
+
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    futures = {}
+    if len(target_infos) > 0:
+        args = (resize, max_num_keypoints)
+        ref_future = submit_in_context(executor, download_target, ref_info, *args)
+        futures = {
+            submit_in_context(executor, download_target, info, *args): info
+            for info in target_infos
+        }
+    try:
+        yield from yield_cached_matches(image_infos[1:], cached_matches)
+        if len(target_infos) == 0:
+            return
+
+        ref_features = _features(*ref_future.result())
+
+        for future in as_completed(futures):
+            info = futures[future]
+            try:
+                _, image = future.result()
+                img_features = _features(info, image)
+                del image
+                ref_matched_pts, img_matched_pts = match_points(matcher, ref_features, img_features)
+            except Exception as e:
+                sly.logger.debug(f"Matching failed for image {info.name}: {e}")
+                continue
+            del img_features
+
+            result = finish_pair(info, ref_matched_pts, img_matched_pts, _match_key(info))
+            if result is not None:
+                yield result
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def shard_lightglue(
+    image_infos: List[sly.ImageInfo],
+    max_num_keypoints: int = 1024,
+    resize=None,
+    filter_threshold=0.3,
+    num_workers: int = 4,
+    matcher_conf: dict = None,
+    shard_workers: int = None,
+):
+    """
+    Generator function to apply LightGlue to group images on CPU in `shard_workers`
+    worker processes (SHARD_WORKERS by default). Reference features are extracted in the app
+    process, target images are downloaded and decoded here and extracted and matched
+    by the workers. Features and matches are cached the same way as in `stream_lightglue`
+    and matched points are the same as the serial path gives with eager models.
+    Yields (image_id, ref_matched_pts, img_matched_pts) in completion order,
+    matches cached on previous clicks are yielded first.
+    """
+    device = "cpu"
+    shard_workers = shard_workers or g.SHARD_WORKERS
+    matcher_conf = matcher_conf or {}
+    ref_info, target_infos = image_infos[0], image_infos[1:]
+
+    def _match_key(info: sly.ImageInfo):
+        return get_match_key(
+            ref_info, info, resize, max_num_keypoints, filter_threshold, matcher_conf
+        )
+
+    cached_matches = {info.id: load_cached_matches(_match_key(info)) for info in target_infos}
+    yield from yield_cached_matches(target_infos, cached_matches)
+    target_infos = [info for info in target_infos if cached_matches[info.id] is None]
+    if len(target_infos) == 0:
+        return
+    infos_by_id = {info.id: info for info in target_infos}
+
+    def _download(info: sly.ImageInfo):
+        features = load_cached_features(get_feature_key(info, resize, max_num_keypoints), device)
+        if features is not None:
+            return info.id, "features", features
+        image = download_group_image(info, resize)
+        return info.id, "image", (torch.from_numpy(image), get_original_size(image, info))
+
+    def _targets():
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                sly.logger.debug(f"Failed to download image: {e}")
+
+    # * Target images are downloaded while reference features are extracted
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    futures = [submit_in_context(executor, _download, info) for info in target_infos]
+    conf = (max_num_keypoints, filter_threshold, resize, tuple(sorted(matcher_conf.items())))
+    try:
+        # * Workers have eager models, so reference features are extracted with them too
+        extractor, _ = MODEL_POOL.get(
+            device, max_num_keypoints, filter_threshold, "eager", False, **matcher_conf
+        )
+        ref_features = get_image_features(
+            extractor, ref_info, None, resize, max_num_keypoints, device
+        )
+
+        for image_id, ref_matched_pts, img_matched_pts, features, stages, error in (
+            SHARD_POOL.match_group(
+                ref_features, _targets(), conf, shard_workers, g.MODEL_DIR, g.INTRA_OP_THREADS
+            )
+        ):
+            info = infos_by_id[image_id]
+            for stage, seconds in stages.items():
+                METRICS.observe_stage(stage, seconds)
+            if features is not None:
+                METRICS.observe_keypoints(features["keypoints"].shape[1])
+                feature_key = get_feature_key(info, resize, max_num_keypoints)
+                FEATURE_STORE.put(feature_key, compact_features(features))
+            if error is not None:
+                sly.logger.debug(f"Matching failed for image {info.name}: {error}")
+                continue
+
+            METRICS.observe_matches(len(ref_matched_pts))
+            result = finish_pair(info, ref_matched_pts, img_matched_pts, _match_key(info))
+            if result is not None:
+                yield result
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+# * Minimal margin around the region of interest in pixels, so small boxes keep some context
+ROI_MIN_PADDING = 32
+
+
+def expand_roi(
+    roi: Tuple[float, float, float, float], margin: float, width: int, height: int
+) -> Tuple[int, int, int, int]:
+    """
+    Expands (left, top, right, bottom) region on every side by `margin` of its size
+    and clips it to the image
+    """
+    left, top, right, bottom = roi
+    pad_x = max((right - left) * margin, ROI_MIN_PADDING)
+    pad_y = max((bottom - top) * margin, ROI_MIN_PADDING)
+    return (
+        int(max(left - pad_x, 0)),
+        int(max(top - pad_y, 0)),
+        int(np.ceil(min(right + pad_x, width))),
+        int(np.ceil(min(bottom + pad_y, height))),
+    )
+
+
+def get_roi(
+    geometry: sly.Rectangle, margin: float, width: int, height: int
+) -> Tuple[int, int, int, int]:
+    """
+    Returns (left, top, right, bottom) region of interest around the box
+    """
+    box = (geometry.left, geometry.top, geometry.right + 1, geometry.bottom + 1)
+    return expand_roi(box, margin, width, height)
+
+
+def project_roi(
+    roi: Tuple[int, int, int, int],
+    ref_pts: np.ndarray,
+    img_pts: np.ndarray,
+    margin: float,
+    width: int,
+    height: int,
+) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Projects the region of the reference image to the target image with the homography
+    estimated from matched points. Returns None if the target image can't be narrowed.
+    """
+    if len(ref_pts) < 4:
+        return None
+    H, _ = cv2.findHomography(
+        np.asarray(ref_pts, np.float32), np.asarray(img_pts, np.float32), cv2.RANSAC, 5.0
+    )
+    if H is None:
+        return None
+    left, top, right, bottom = roi
+    corners = np.array([[[left, top], [right, top], [right, bottom], [left, bottom]]], np.float32)
+    projected = cv2.perspectiveTransform(corners, H)[0]
+    if not np.isfinite(projected).all():
+        return None
+    (x0, y0), (x1, y1) = projected.min(axis=0), projected.max(axis=0)
+    if x1 <= 0 or y1 <= 0 or x0 >= width or y0 >= height:
+        return None
+    target_roi = expand_roi((x0, y0, x1, y1), margin, width, height)
+    # * Region close to the whole image is processed as the whole image, its features are cached
+    roi_area = (target_roi[2] - target_roi[0]) * (target_roi[3] - target_roi[1])
+    if roi_area >= 0.8 * width * height:
+        return None
+    return target_roi
+
+
+def select_roi_features(
+    features: Dict[str, torch.Tensor], roi: Tuple[int, int, int, int]
+) -> Dict[str, torch.Tensor]:
+    """
+    Returns features of the whole image with only keypoints inside the region
+    """
+    left, top, right, bottom = roi
+    keypoints = features["keypoints"][0]
+    keep = (
+        (keypoints[:, 0] >= left)
+        & (keypoints[:, 0] < right)
+        & (keypoints[:, 1] >= top)
+        & (keypoints[:, 1] < bottom)
+    )
+    return {k: v if k == "image_size" else v[:, keep] for k, v in features.items()}
+
+
+def extract_roi_features(
+    extractor,
+    image: np.ndarray,
+    roi: Tuple[int, int, int, int],
+    resize=None,
+    device: str = "cpu",
+    original_size=None,
+) -> Dict[str, torch.Tensor]:
+    """
+    Extracts features of the region of decoded image at the same scale, as the whole image
+    would be processed with `resize`. Keypoints are in the coordinates of the (width, height)
+    `original_size` image, so they are matched the same way as features of the whole image.
+    """
+    h, w = image.shape[:2]
+    orig_w, orig_h = original_size or (w, h)
+    scale_x, scale_y = w / orig_w, h / orig_h
+    left, top, right, bottom = roi
+    x0, y0 = int(left * scale_x), int(top * scale_y)
+    x1, y1 = int(np.ceil(right * scale_x)), int(np.ceil(bottom * scale_y))
+    crop = image[y0:y1, x0:x1]
+    crop_resize = None
+    if resize is not None and max(w, h) > resize:
+        crop_resize = max(int(round(max(crop.shape[:2]) * resize / max(w, h))), 1)
+
+    with METRICS.span("extract"):
+        features = extractor.extract(numpy_image_to_torch(crop).to(device), resize=crop_resize)
+    METRICS.observe_keypoints(features["keypoints"].shape[1])
+    keypoints = features["keypoints"]
+    offset = torch.tensor([x0, y0]).to(keypoints)
+    scales = torch.tensor([scale_x, scale_y]).to(keypoints)
+    features["keypoints"] = (keypoints + offset + 0.5) / scales - 0.5
+    features["image_size"] = torch.tensor([orig_w, orig_h])[None].to(keypoints).float()
+    return features
+
+
+def roi_lightglue(
+    image_infos: List[sly.ImageInfo],
+    roi: Tuple[int, int, int, int],
+    margin: float = 1.0,
+    narrow: bool = True,
+    max_num_keypoints: int = 1024,
+    resize=None,
+    filter_threshold=0.3,
+    device: str = "cpu",
+    num_workers: int = 4,
+    matcher_conf: dict = None,
+):
+    """
+    Generator function to apply LightGlue to the region of interest of the reference image,
+    `roi` is (left, top, right, bottom) region around the selected box.
+    If `narrow` is set, target images with cached matches of whole images are processed only
+    in the region the ROI is projected to, the rest of target images are processed whole.
+    Features of whole images are taken from the feature store, if they were extracted before.
+    Matches are not cached, as they are valid only for the region.
+    Yields (image_id, ref_matched_pts, img_matched_pts) in completion order.
+    """
+    ref_info, target_infos = image_infos[0], image_infos[1:]
+    extractor, matcher = MODEL_POOL.get(
+        device, max_num_keypoints, filter_threshold, **(matcher_conf or {})
+    )
+
+    target_rois = {}
+    for info in target_infos:
+        target_rois[info.id] = None
+        if narrow:
+            match_key = get_match_key(
+                ref_info, info, resize, max_num_keypoints, filter_threshold, matcher_conf
+            )
+            coarse_matches = load_cached_matches(match_key)
+            if coarse_matches is not None:
+                target_rois[info.id] = project_roi(
+                    roi, *coarse_matches, margin, info.width, info.height
+                )
+    sly.logger.debug(
+        "Matching region of interest",
+        extra={
+            "roi": roi,
+            "narrowed images": sum(region is not None for region in target_rois.values()),
+        },
+    )
+
+    def _features(info: sly.ImageInfo, image: Optional[np.ndarray], region):
+        return get_image_features(
+            extractor, info, image, resize, max_num_keypoints, device, region
+        )
+
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    args = (resize, max_num_keypoints)
+    ref_future = submit_in_context(executor, download_target, ref_info, *args)
+    futures = {
+        submit_in_context(executor, download_target, info, *args): info for info in target_infos
+    }
+    try:
+        ref_features = _features(*ref_future.result(), roi)
+        if ref_features["keypoints"].shape[1] < 4:
+            sly.logger.warning("Not enough keypoints around the box, matching whole images")
+            yield from stream_lightglue(
+                image_infos,
+                max_num_keypoints,
+                resize,
+                filter_threshold,
+                device,
+                num_workers,
+                matcher_conf,
+            )
+            return
+
+        for future in as_completed(futures):
+            info = futures[future]
+            try:
+                _, image = future.result()
+                img_features = _features(info, image, target_rois[info.id])
+                if img_features["keypoints"].shape[1] < 4:
+                    # * Projected region is wrong or has no texture, process the whole image
+                    img_features = _features(info, image, None)
+                del image
+                ref_matched_pts, img_matched_pts = match_points(matcher, ref_features, img_features)
+            except Exception as e:
+                sly.logger.debug(f"Matching failed for image {info.name}: {e}")
+                continue
+            del img_features
+
+            # * Matches of the region are not cached
+            result = finish_pair(info, ref_matched_pts, img_matched_pts)
+            if result is not None:
+                yield result
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def match_decoded_group(
+    images: List[np.ndarray],
+    image_infos: List[sly.ImageInfo],
+    max_num_keypoints: int = 1024,
+    resize=None,
+    filter_threshold=0.3,
+    device: str = "cpu",
+    backend: str = None,
+    quantize: bool = None,
+) -> List[Tuple[int, np.ndarray, np.ndarray]]:
+    """
+    Matches already decoded group images with the reference image (first one)
+    using models from the pool. `backend` and `quantize` override the inference backend settings.
+    Returns (image_id, ref_matched_pts, img_matched_pts) for successfully matched images.
+    """
+    extractor, matcher = MODEL_POOL.get(
+        device, max_num_keypoints, filter_threshold, backend, quantize
+    )
+    return match_decoded_images(extractor, matcher, images, image_infos, resize, device)
+
+
+def prefetch_group(
+    image_infos: List[sly.ImageInfo],
+    max_num_keypoints: int = 1024,
+    resize=None,
+    filter_threshold=0.3,
+    device: str = "cpu",
+    with_matches: bool = False,
+    should_stop: Callable[[], bool] = None,
+) -> None:
+    """
+    Extracts and caches features of group images in background,
+    optionally also matches them with the reference image (first image info).
+    `should_stop` is called before each image and stops prefetching if it returns True.
+    """
+    extractor, matcher = MODEL_POOL.get(device, max_num_keypoints, filter_threshold)
+    ref_info = image_infos[0]
+    ref_features = None
+    for info in image_infos:
+        if should_stop is not None and should_stop():
+            sly.logger.debug("Prefetching is stopped", extra={"image_id": ref_info.id})
+            return
+
+        match_key = get_match_key(ref_info, info, resize, max_num_keypoints, filter_threshold)
+        if with_matches and info is not ref_info and match_key in MATCH_STORE:
             continue
-        matched_idx = [
-            np.where((ref_keypoints == kp).all(axis=1))[0][0] for kp in in_bbox_keypoints
-        ]
-        matched_pts_ref = np.array(in_bbox_keypoints)
-        matched_pts_img = img_keypoints[matched_idx]
-        new_box_points = []
-        for box_point in box_points:
-            distances = np.linalg.norm(matched_pts_ref - box_point, axis=1)
-            nearest_idx = np.argmin(distances)
-            offset = matched_pts_img[nearest_idx] - matched_pts_ref[nearest_idx]
-            new_box_points.append(box_point + offset)
-        yield orig_label.clone(bbox_from_array(np.array(new_box_points)))
+
+        features = get_image_features(extractor, info, None, resize, max_num_keypoints, device)
+
+        if not with_matches:
+            continue
+        if info is ref_info:
+            ref_features = features
+            continue
+        try:
+            ref_matched_pts, img_matched_pts = match_points(matcher, ref_features, features)
+        except Exception as e:
+            sly.logger.debug(f"Prefetch matching failed for image {info.name}: {e}")
+            continue
+        cache_matches(match_key, ref_matched_pts, img_matched_pts)
@@ -0,0 +1,202 @@
+import itertools
+import os
+import queue
+import threading
+import time
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+import torch
+import torch.multiprocessing as mp
+import supervisely as sly
+from src.backends import load_models
+from src.matching import extract_image_features, match_points
+
+# * Workers are spawned, so this module must not import modules with side effects (src.globals)
+
+# * Seconds to wait for a result before checking that workers are alive
+POLL_INTERVAL = 1.0
+
+
+def _worker_loop(worker_idx: int, model_dir: str, num_threads: int, tasks, results) -> None:
+    torch.set_num_threads(num_threads)
+    models_key, extractor, matcher = None, None, None
+    group_seq, resize, ref_features = None, None, None
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        if task[0] == "group":
+            _, group_seq, conf, ref_features = task
+            max_num_keypoints, filter_threshold, resize, matcher_items = conf
+            if models_key != (max_num_keypoints, filter_threshold, matcher_items):
+                models_key = (max_num_keypoints, filter_threshold, matcher_items)
+                extractor, matcher = load_models(
+                    "cpu", max_num_keypoints, filter_threshold, model_dir, **dict(matcher_items)
+                )
+            continue
+
+        _, seq, image_id, kind, payload = task
+        stages, features_np = {}, None
+        try:
+            if seq != group_seq:
+                raise RuntimeError("Reference features of the group were not received")
+            if kind == "features":
+                img_features = payload
+            else:
+                image, original_size = payload
+                start = time.perf_counter()
+                img_features = extract_image_features(
+                    extractor, image.numpy(), resize, "cpu", original_size
+                )
+                stages["extract"] = time.perf_counter() - start
+                features_np = {k: v.detach().cpu().numpy() for k, v in img_features.items()}
+            start = time.perf_counter()
+            ref_pts, img_pts = match_points(matcher, ref_features, img_features)
+            stages["match"] = time.perf_counter() - start
+            results.put((worker_idx, seq, image_id, ref_pts, img_pts, features_np, stages, None))
+        except Exception as e:
+            results.put((worker_idx, seq, image_id, None, None, None, stages, str(e)))
+
+
+class ShardPool:
+    """
+    Worker processes that extract features of target images and match them on CPU.
+    Every worker holds its own SuperPoint and LightGlue with eager PyTorch.
+    Reference features are passed to every worker once per group through shared memory,
+    decoded images (or cached features) are sent to the least loaded worker as soon as
+    they are ready, and matched points are streamed back.
+    """
+
+    def __init__(self):
+        self._processes = []
+        self._tasks = []
+        self._results = None
+        self._load = []
+        self._config = None
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def num_workers(self) -> int:
+        return len(self._processes)
+
+    def _start(self, num_workers: int, model_dir: str, num_threads: int) -> None:
+        if num_threads <= 0:
+            num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        config = (num_workers, model_dir, num_threads)
+        if self._config == config and all(p.is_alive() for p in self._processes):
+            return
+        self._stop()
+        ctx = mp.get_context("spawn")
+        self._results = ctx.Queue()
+        self._tasks = [ctx.Queue() for _ in range(num_workers)]
+        self._processes = [
+            ctx.Process(
+                target=_worker_loop,
+                args=(idx, model_dir, num_threads, self._tasks[idx], self._results),
+                name=f"shard-worker-{idx}",
+                daemon=True,
+            )
+            for idx in range(num_workers)
+        ]
+        for process in self._processes:
+            process.start()
+        self._load = [0] * num_workers
+        self._config = config
+        sly.logger.info(
+            "Shard workers are started",
+            extra={"workers": num_workers, "threads per worker": num_threads},
+        )
+
+    def _stop(self) -> None:
+        for tasks in self._tasks:
+            tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self._processes, self._tasks, self._load, self._config = [], [], [], None
+
+    def _get_result(self, block: bool) -> Optional[tuple]:
+        while True:
+            try:
+                if block:
+                    return self._results.get(timeout=POLL_INTERVAL)
+                return self._results.get_nowait()
+            except queue.Empty:
+                if not all(p.is_alive() for p in self._processes):
+                    self._stop()
+                    raise RuntimeError("Shard worker process has died")
+                if not block:
+                    return None
+
+    def match_group(
+        self,
+        ref_features: Dict[str, torch.Tensor],
+        targets: Iterable[Tuple[int, str, object]],
+        conf: Tuple,
+        num_workers: int,
+        model_dir: str,
+        num_threads: int = 0,
+    ) -> Iterator[tuple]:
+        """
+        Generator function to match reference features with target images in worker processes.
+        `targets` yields (image_id, "image", (image, original_size)) or
+        (image_id, "features", features), `conf` is
+        (max_num_keypoints, filter_threshold, resize, sorted matcher options).
+        Yields (image_id, ref_matched_pts, img_matched_pts, extracted features or None,
+        stage seconds, error or None) in completion order.
+        """
+        with self._lock:
+            self._start(num_workers, model_dir, num_threads)
+            seq = next(self._seq)
+            shared_ref = {
+                k: v.detach().cpu().clone().share_memory_() for k, v in ref_features.items()
+            }
+            for tasks in self._tasks:
+                tasks.put(("group", seq, conf, shared_ref))
+
+            pending = 0
+            for image_id, kind, payload in targets:
+                worker_idx = min(range(self.num_workers), key=self._load.__getitem__)
+                self._load[worker_idx] += 1
+                self._tasks[worker_idx].put(("target", seq, image_id, kind, payload))
+                pending += 1
+                # * Results that are already received are yielded while images are downloading
+                while pending > 0:
+                    result = self._get_result(block=False)
+                    if result is None:
+                        break
+                    self._load[result[0]] -= 1
+                    if result[1] == seq:
+                        pending -= 1
+                        yield result[2:]
+            while pending > 0:
+                result = self._get_result(block=True)
+                self._load[result[0]] -= 1
+                if result[1] == seq:
+                    pending -= 1
+                    yield result[2:]
+
+    def warmup(self, num_workers: int, model_dir: str, num_threads: int = 0) -> threading.Thread:
+        """
+        Starts worker processes on a background thread, so the first click doesn't wait for them.
+        """
+
+        def _warmup():
+            try:
+                with self._lock:
+                    self._start(num_workers, model_dir, num_threads)
+            except Exception as e:
+                sly.logger.warning(f"Failed to start shard workers: {e}")
+
+        thread = threading.Thread(target=_warmup, name="shard-pool-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def shutdown(self) -> None:
+        with self._lock:
+            self._stop()
+
+
+SHARD_POOL = ShardPool()
@@ -0,0 +1,72 @@
+import threading
+import time
+from typing import Callable, List, Optional
+
+import supervisely as sly
+
+
+class Startup:
+    """
+    Runs the slow part of app startup on a background thread, so the UI is served right away:
+    modules that import torch, cv2 and LightGlue are imported and model weights are
+    loaded (and downloaded if they are missing) there.
+    Callbacks added with `on_ready` are called when it is finished, even if it failed,
+    as models are loaded again on the first click in that case.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.ready_at: Optional[float] = None
+        self.error: Optional[str] = None
+        self._ready = threading.Event()
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, prepare: Callable[[], None]) -> threading.Thread:
+        self._thread = threading.Thread(
+            target=self._run, args=(prepare,), name="app-startup", daemon=True
+        )
+        self._thread.start()
+        return self._thread
+
+    def _run(self, prepare: Callable[[], None]) -> None:
+        try:
+            prepare()
+        except Exception as e:
+            self.error = str(e)
+            sly.logger.warning(f"Failed to prepare models on startup: {e}", exc_info=True)
+        with self._lock:
+            self.ready_at = time.perf_counter()
+            self._ready.set()
+            callbacks, self._callbacks = self._callbacks, []
+        sly.logger.info(
+            "App is ready", extra={"seconds since start": round(self.seconds_to_ready, 2)}
+        )
+        for callback in callbacks:
+            callback()
+
+    @property
+    def seconds_to_ready(self) -> Optional[float]:
+        if self.ready_at is None:
+            return None
+        return self.ready_at - self.started_at
+
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._ready.wait(timeout)
+
+    def on_ready(self, callback: Callable[[], None]) -> None:
+        """
+        Calls `callback` when startup is finished, right away if it is finished already.
+        """
+        with self._lock:
+            if not self._ready.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+
+STARTUP = Startup()
@@ -9,17 +9,24 @@ from supervisely.app.widgets import (
     Text,
     InputNumber,
     Slider,
+    Progress,
 )
 
 match_bbox_button = Button("MATCH BBOXES", "success", icon="zmdi zmdi-collection-item")
 match_bbox_button.disable()
+match_progress = Progress(hide_on_finish=True)
+# * Models are loaded in background after the UI is served
+startup_status = Text("Loading models...", "info")
 match_bbox_card = Card(
     "Match Bounding Boxes",
     "Select bounding box/image with bounding boxes and press the button to process them",
     False,
-    match_bbox_button,
+    Container([startup_status, match_bbox_button, match_progress]),
+)
+# * Listing CUDA devices imports torch, so the list is filled in background on startup
+device_selector = SelectCudaDevice(
+    get_list_on_init=False, sort_by_free_ram=True, include_cpu_option=True
 )
-device_selector = SelectCudaDevice(sort_by_free_ram=True, include_cpu_option=True)
 device_selector_card = Card(
     "Select Computation Device", "Device which will be used for processing", True, device_selector
 )
@@ -47,11 +54,57 @@ filter_field = Field(
     "Keypoint filter threshold for inlier keypoints. "
     "Increase to get less keypoints which will be more accruate",
 )
+batch_size_inputnum = InputNumber(1, 1, 64, 1)
+batch_size_field = Field(
+    batch_size_inputnum,
+    "Batch size",
+    "Number of group images processed by SuperPoint and LightGlue in one pass. "
+    "Increase to speed up processing of large groups, "
+    "set 1 to process images one by one as soon as they are downloaded",
+)
+prefetch_check = Checkbox(Text("Prefetch group images"), False)
+prefetch_matches_check = Checkbox(Text("Also precompute matches"), False)
+prefetch_field = Field(
+    Container([prefetch_check, prefetch_matches_check], "horizontal"),
+    "Background prefetch",
+    "When an image from a group is selected, download group images and extract their features "
+    "in background, so pressing the button takes less time. Uses additional CPU/GPU resources",
+)
+latency_budget_check = Checkbox(Text("Auto-tune"), False)
+latency_budget_inputnum = InputNumber(5, 1, 300, 1)
+latency_budget_field = Field(
+    Container([latency_budget_check, latency_budget_inputnum], "horizontal"),
+    "Target latency, seconds",
+    "When enabled, resize, max keypoints and LightGlue early exit are chosen automatically "
+    "to match a group within the target time, based on the measured speed of the device, "
+    "group size and image size. Settings above are ignored and adjusted after every click",
+)
+roi_check = Checkbox(Text("Match around the box"), False)
+roi_margin_inputnum = InputNumber(1, 0, 10, 0.25, precision=2)
+roi_narrow_check = Checkbox(Text("Narrow group images with cached matches"), True)
+roi_field = Field(
+    Container([roi_check, roi_margin_inputnum, roi_narrow_check], "horizontal"),
+    "Region of interest",
+    "When a single box is selected, only the region around it is processed on the reference "
+    "image, the number sets the margin around the box relative to its size. If matches of "
+    "whole images are cached (e.g. by background prefetch), group images are also processed "
+    "only around the place where the box is expected",
+)
 lightglue_params = Card(
     "Advanced Settings",
     "Configure processing settings",
     True,
-    Container([max_keypoints_field, resize_field, filter_field]),
+    Container(
+        [
+            max_keypoints_field,
+            resize_field,
+            filter_field,
+            batch_size_field,
+            prefetch_field,
+            latency_budget_field,
+            roi_field,
+        ]
+    ),
 )
 lightglue_params.collapse()
 grouping_warning = NotificationBox(